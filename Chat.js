@@ -5,9 +5,32 @@ let activeUsers = [];
 let allRooms = {};
 let pmTargetUser = null; // Current user for private messaging
 
+// Virtualized message view: records live in a bounded store and only a
+// window of them is attached to the DOM at any time
+const MAX_STORED_MESSAGES = 2000; // Records kept in memory, oldest are dropped
+const RENDER_WINDOW = 120;        // Max message nodes attached to the DOM
+const PAGE_SIZE = 40;             // Records paged in/out per scroll step
+const SCROLL_EDGE_PX = 80;        // Distance from an edge that triggers paging
+const messageStore = {
+    records: [],  // Oldest first
+    firstId: 0,   // Id of records[0]
+    nextId: 0     // Id given to the next stored record
+};
+let viewStart = 0;     // Id of the first rendered record
+let viewEnd = 0;       // Id after the last rendered record
+let followTail = true; // Keep the view pinned to the newest message
+let scrollPending = false;
+let scrollCheckPending = false;
+let transferInfo = null; // Local upload route, fetched once from Python
+let activeDownloads = {}; // Download progress by transfer id
+const MAX_FILE_SIZE = 50 * 1024 * 1024; // 50MB per file
+const DEFAULT_UPLOAD_PARALLEL = 4;      // Uploads in flight if Python does not say
+
 // Initialize chat when page loads
 window.onload = function() {
     loadUserInfo();
+    document.getElementById('messagesContainer')
+        .addEventListener('scroll', handleMessagesScroll, { passive: true });
     scrollToBottom();
     // Request user list after a short delay to ensure connection is established
     setTimeout(() => {
@@ -86,7 +109,7 @@ function togglePMMode(username) {
 function updatePMIndicator() {
     const input = document.getElementById('messageInput');
     if (pmTargetUser) {
-        input.placeholder = 💬 Private message to ${pmTargetUser}... (Click PM button to disable);
+        input.placeholder = `💬 Private message to ${pmTargetUser}... (Click PM button to disable)`;
         input.style.borderColor = 'var(--warning-color)';
         input.style.background = 'rgba(254, 202, 87, 0.05)';
     } else {
@@ -106,7 +129,7 @@ async function sendMessage() {
     try {
         // If PM mode is active and message doesn't start with a command, prefix with /pm
         if (pmTargetUser && !message.startsWith('/')) {
-            message = /pm ${pmTargetUser} ${message};
+            message = `/pm ${pmTargetUser} ${message}`;
         }
         
         await eel.send_message(message)();
@@ -191,17 +214,16 @@ function hideUsersPanel() {
 // Display message in chat (called from Python)
 eel.expose(display_message);
 function display_message(messageData) {
-    const container = document.getElementById('messagesContainer');
-    const welcomeMsg = container.querySelector('.welcome-message');
-    if (welcomeMsg) {
-        welcomeMsg.remove();
-    }
-    
+    storeMessage('message', messageData);
+}
+
+// Build the DOM node for a chat, private or notification message
+function buildMessageElement(record) {
+    const messageData = record.data;
     const messageDiv = document.createElement('div');
     messageDiv.className = 'message';
     
-    const now = new Date();
-    const timeStr = now.toLocaleTimeString('en-US', { hour: '2-digit', minute: '2-digit' });
+    const timeStr = record.time;
     
     if (messageData.type === 'notification') {
         messageDiv.classList.add('notification');
@@ -240,8 +262,7 @@ function display_message(messageData) {
         `;
     }
     
-    container.appendChild(messageDiv);
-    scrollToBottom();
+    return messageDiv;
 }
 
 // Update room info (called from Python)
@@ -252,13 +273,13 @@ function update_room_info(roomData) {
     
     document.getElementById('currentRoomName').textContent = currentRoom;
     document.getElementById('chatRoomTitle').textContent = currentRoom;
-    document.getElementById('roomMembersCount').textContent = ${members.length} member${members.length !== 1 ? 's' : ''};
+    document.getElementById('roomMembersCount').textContent = `${members.length} member${members.length !== 1 ? 's' : ''}`;
     
     // Update active room highlight
     document.querySelectorAll('.room-item').forEach(item => {
         item.classList.remove('active');
     });
-    const activeRoomItem = document.querySelector(.room-item[onclick*="${currentRoom}"]);
+    const activeRoomItem = document.querySelector(`.room-item[onclick*="${currentRoom}"]`);
     if (activeRoomItem) {
         activeRoomItem.classList.add('active');
     }
@@ -352,7 +373,7 @@ function update_rooms_list(rooms) {
         if (roomName === 'lobby') continue;
         
         const roomItem = document.createElement('div');
-        roomItem.className = room-item ${currentRoom === roomName ? 'active' : ''};
+        roomItem.className = `room-item ${currentRoom === roomName ? 'active' : ''}`;
         roomItem.onclick = () => joinRoomByName(roomName);
         
         const icons = ['💬', '🎮', '📚', '🎵', '🎨', '⚽', '🍕', '🌟'];
@@ -376,16 +397,19 @@ function display_error(errorMsg) {
 
 // Helper function to display errors
 function displayError(message) {
-    const container = document.getElementById('messagesContainer');
+    storeMessage('error', { text: message });
+}
+
+// Build the DOM node for an error line
+function buildErrorElement(record) {
     const errorDiv = document.createElement('div');
     errorDiv.className = 'message notification';
     errorDiv.innerHTML = `
         <div class="message-content">
-            <div class="message-text" style="color: #f44336;">⚠ ${escapeHtml(message)}</div>
+            <div class="message-text" style="color: #f44336;">⚠ ${escapeHtml(record.data.text)}</div>
         </div>
     `;
-    container.appendChild(errorDiv);
-    scrollToBottom();
+    return errorDiv;
 }
 
 // Start private message with user
@@ -397,82 +421,15 @@ function startPrivateMessage(username) {
     input.focus();
 }
 
-// Send file to specific user
-function sendFileToUser(username) {
-    // Create a hidden file input for this user
-    const fileInput = document.createElement('input');
-    fileInput.type = 'file';
-    fileInput.style.display = 'none';
-    fileInput.onchange = (e) => handleFileSelectForUser(e, username);
-    document.body.appendChild(fileInput);
-    fileInput.click();
-    // Remove the input after selection
-    setTimeout(() => document.body.removeChild(fileInput), 1000);
-}
-
-// Handle file selection for specific user
-async function handleFileSelectForUser(event, targetUser) {
-    const file = event.target.files[0];
-    if (!file) return;
-    
-    // Check file size (limit to 50MB)
-    const maxSize = 50 * 1024 * 1024; // 50MB
-    if (file.size > maxSize) {
-        displayError('File too large. Maximum size is 50MB.');
-        return;
-    }
-    
-    // Show confirmation
-    const confirmed = confirm(Send file "${file.name}" (${formatFileSize(file.size)}) to ${targetUser}?);
-    if (!confirmed) {
-        return;
-    }
-    
-    try {
-        // Read file as ArrayBuffer
-        const reader = new FileReader();
-        reader.onload = async function(e) {
-            try {
-                // Convert ArrayBuffer to base64
-                const arrayBuffer = e.target.result;
-                const bytes = new Uint8Array(arrayBuffer);
-                let binary = '';
-                for (let i = 0; i < bytes.length; i++) {
-                    binary += String.fromCharCode(bytes[i]);
-                }
-                const base64 = btoa(binary);
-                
-                // Send file data through Python with target user
-                const result = await eel.send_file_data(file.name, base64, targetUser)();
-                
-                if (result.success) {
-                    displayLocalFile(file.name, file.size, targetUser);
-                } else {
-                    displayError(result.message || 'Failed to send file');
-                }
-            } catch (error) {
-                console.error('File send error:', error);
-                displayError('Failed to send file: ' + error.message);
-            }
-        };
-        
-        reader.onerror = function() {
-            displayError('Failed to read file');
-        };
-        
-        reader.readAsArrayBuffer(file);
-    } catch (error) {
-        console.error('File selection error:', error);
-        displayError('Failed to select file: ' + error.message);
-    }
-}
-
-// Scroll to bottom of messages
+// Scroll to bottom of messages (coalesced to one layout per frame)
 function scrollToBottom() {
-    const container = document.getElementById('messagesContainer');
-    setTimeout(() => {
+    if (scrollPending) return;
+    scrollPending = true;
+    requestAnimationFrame(() => {
+        scrollPending = false;
+        const container = document.getElementById('messagesContainer');
         container.scrollTop = container.scrollHeight;
-    }, 100);
+    });
 }
 
 // Escape HTML to prevent XSS
@@ -498,6 +455,7 @@ function sendFileToUser(username) {
     // Create a hidden file input for this user
     const fileInput = document.createElement('input');
     fileInput.type = 'file';
+    fileInput.multiple = true;
     fileInput.style.display = 'none';
     fileInput.onchange = (e) => handleFileSelectForUser(e, username);
     document.body.appendChild(fileInput);
@@ -508,134 +466,169 @@ function sendFileToUser(username) {
 
 // Handle file selection for specific user
 async function handleFileSelectForUser(event, targetUser) {
-    const file = event.target.files[0];
-    if (!file) return;
+    await sendFiles(Array.from(event.target.files), targetUser);
+}
+
+// Handle file (or folder) selection for room
+async function handleFileSelect(event) {
+    await sendFiles(Array.from(event.target.files), null);
     
-    // Check file size (limit to 50MB)
-    const maxSize = 50 * 1024 * 1024; // 50MB
-    if (file.size > maxSize) {
-        displayError('File too large. Maximum size is 50MB.');
-        return;
-    }
+    // Reset input
+    event.target.value = '';
+}
+
+// Confirm and send selected files, several files as one batch
+async function sendFiles(selected, targetUser) {
+    const files = [];
+    selected.forEach(file => {
+        if (file.size > MAX_FILE_SIZE) {
+            displayError(`File "${file.name}" too large. Maximum size is 50MB.`);
+        } else if (file.size > 0) {
+            files.push(file);
+        }
+    });
+    if (files.length === 0) return;
     
     // Show confirmation
-    const confirmed = confirm(Send file "${file.name}" (${formatFileSize(file.size)}) to ${targetUser}?);
+    const totalSize = files.reduce((sum, file) => sum + file.size, 0);
+    const what = files.length === 1 ? `file "${files[0].name}"` : `${files.length} files`;
+    const confirmed = confirm(`Send ${what} (${formatFileSize(totalSize)}) to ${targetUser || 'room'}?`);
     if (!confirmed) {
         return;
     }
     
     try {
-        // Read file as ArrayBuffer
-        const reader = new FileReader();
-        reader.onload = async function(e) {
-            try {
-                // Convert ArrayBuffer to base64
-                const arrayBuffer = e.target.result;
-                const bytes = new Uint8Array(arrayBuffer);
-                let binary = '';
-                for (let i = 0; i < bytes.length; i++) {
-                    binary += String.fromCharCode(bytes[i]);
-                }
-                const base64 = btoa(binary);
-                
-                // Send file data through Python with target user
-                const result = await eel.send_file_data(file.name, base64, targetUser)();
-                
-                if (result.success) {
-                    displayLocalFile(file.name, file.size, targetUser);
-                } else {
-                    displayError(result.message || 'Failed to send file');
-                }
-            } catch (error) {
-                console.error('File send error:', error);
-                displayError('Failed to send file: ' + error.message);
+        if (files.length === 1) {
+            const result = await uploadFile(files[0], targetUser);
+            if (result.success) {
+                displayLocalFile(files[0].name, files[0].size, targetUser);
+            } else {
+                displayError(result.message || 'Failed to send file');
             }
-        };
-        
-        reader.onerror = function() {
-            displayError('Failed to read file');
-        };
-        
-        reader.readAsArrayBuffer(file);
+        } else {
+            await uploadBatch(files, targetUser, totalSize);
+        }
     } catch (error) {
-        console.error('File selection error:', error);
-        displayError('Failed to select file: ' + error.message);
+        console.error('File send error:', error);
+        displayError('Failed to send file: ' + error.message);
+    } finally {
+        showUploadProgress(null);
     }
 }
 
-// Handle file selection for room (original function)
-async function handleFileSelect(event) {
-    const file = event.target.files[0];
-    if (!file) return;
-    
-    // Check file size (limit to 50MB)
-    const maxSize = 50 * 1024 * 1024; // 50MB
-    if (file.size > maxSize) {
-        displayError('File too large. Maximum size is 50MB.');
-        event.target.value = '';
-        return;
+// Send files as one group, a few uploads in flight at once so small files
+// do not each wait for the previous one
+async function uploadBatch(files, targetUser, totalSize) {
+    if (!transferInfo) {
+        transferInfo = await eel.get_transfer_info()();
     }
-    
-    // Show confirmation
-    const confirmed = confirm(Send file: ${file.name} (${formatFileSize(file.size)}) to room?);
-    if (!confirmed) {
-        event.target.value = '';
+    const started = await eel.start_file_group(files.length, totalSize, targetUser)();
+    if (!started.success) {
+        displayError(started.message || 'Failed to send files');
         return;
     }
     
-    try {
-        // Read file as ArrayBuffer
-        const reader = new FileReader();
-        reader.onload = async function(e) {
+    const loaded = new Array(files.length).fill(0);
+    let nextIndex = 0;
+    let sentCount = 0;
+    let sentSize = 0;
+    const report = () => showUploadProgress(loaded.reduce((sum, bytes) => sum + bytes, 0), totalSize, files.length);
+    
+    async function worker() {
+        while (nextIndex < files.length) {
+            const index = nextIndex++;
+            const file = files[index];
             try {
-                // Convert ArrayBuffer to base64
-                const arrayBuffer = e.target.result;
-                const bytes = new Uint8Array(arrayBuffer);
-                let binary = '';
-                for (let i = 0; i < bytes.length; i++) {
-                    binary += String.fromCharCode(bytes[i]);
-                }
-                const base64 = btoa(binary);
-                
-                // Send file data through Python
-                const result = await eel.send_file_data(file.name, base64, null)();
-                
+                const result = await uploadFile(file, targetUser, started.group, bytes => {
+                    loaded[index] = bytes;
+                    report();
+                });
                 if (result.success) {
-                    displayLocalFile(file.name, file.size);
+                    sentCount++;
+                    sentSize += file.size;
                 } else {
-                    displayError(result.message || 'Failed to send file');
+                    displayError(result.message || `Failed to send ${file.name}`);
                 }
             } catch (error) {
-                console.error('File send error:', error);
-                displayError('Failed to send file: ' + error.message);
+                displayError(`Failed to send ${file.name}: ${error.message}`);
             }
-        };
-        
-        reader.onerror = function() {
-            displayError('Failed to read file');
-        };
-        
-        reader.readAsArrayBuffer(file);
-        
-    } catch (error) {
-        console.error('File selection error:', error);
-        displayError('Failed to process file');
+            loaded[index] = file.size;
+            report();
+        }
     }
     
-    // Reset input
-    event.target.value = '';
+    const workers = [];
+    const parallel = Math.min(transferInfo.parallel || DEFAULT_UPLOAD_PARALLEL, files.length);
+    for (let i = 0; i < parallel; i++) {
+        workers.push(worker());
+    }
+    try {
+        await Promise.all(workers);
+    } finally {
+        await eel.finish_file_group(started.group)();
+    }
+    
+    if (sentCount > 0) {
+        displayLocalFile(`${sentCount} files`, sentSize, targetUser);
+    }
+}
+
+// Stream a file to Python through the local upload route (raw bytes, no base64),
+// or straight to the server when the page is served by its WebSocket gateway
+async function uploadFile(file, targetUser, group = null, onProgress = null) {
+    if (!transferInfo) {
+        transferInfo = await eel.get_transfer_info()();
+    }
+    if (!transferInfo.upload_url) {
+        return await eel.upload_file(file, targetUser, group, onProgress)();
+    }
+    
+    // XMLHttpRequest rather than fetch, for upload progress events
+    return new Promise((resolve, reject) => {
+        const xhr = new XMLHttpRequest();
+        xhr.open('POST', transferInfo.upload_url);
+        xhr.setRequestHeader('X-Upload-Token', transferInfo.token);
+        xhr.setRequestHeader('X-Filename', encodeURIComponent(file.name));
+        xhr.setRequestHeader('X-Target', targetUser ? encodeURIComponent(targetUser) : '');
+        if (group) {
+            xhr.setRequestHeader('X-Group', group);
+        }
+        if (onProgress) {
+            xhr.upload.onprogress = (e) => onProgress(e.loaded);
+        }
+        xhr.responseType = 'json';
+        xhr.onload = () => resolve(xhr.response || { success: false, message: `Upload failed (${xhr.status})` });
+        xhr.onerror = () => reject(new Error('Upload request failed'));
+        xhr.send(file);
+    });
+}
+
+// Show the progress of a batch being sent, or hide it (sent === null)
+function showUploadProgress(sent, total, count) {
+    const bar = document.getElementById('uploadProgress');
+    if (sent === null) {
+        bar.style.display = 'none';
+        return;
+    }
+    const percent = total ? Math.floor(sent * 100 / total) : 0;
+    bar.textContent = `⬆ Sending ${count} files - ${formatFileSize(sent)} / ${formatFileSize(total)} (${percent}%)`;
+    bar.style.display = 'block';
 }
 
 // Display file sent by current user
 function displayLocalFile(filename, filesize, targetUser = null) {
-    const container = document.getElementById('messagesContainer');
+    storeMessage('local_file', { filename: filename, filesize: filesize, targetUser: targetUser });
+}
+
+// Build the DOM node for a file sent by current user
+function buildLocalFileElement(record) {
+    const { filename, filesize, targetUser } = record.data;
     const messageDiv = document.createElement('div');
     messageDiv.className = 'message file';
     
-    const now = new Date();
-    const timeStr = now.toLocaleTimeString('en-US', { hour: '2-digit', minute: '2-digit' });
+    const timeStr = record.time;
     const initial = currentUsername.charAt(0).toUpperCase();
-    const recipient = targetUser ? to ${escapeHtml(targetUser)} : 'to room';
+    const recipient = targetUser ? `to ${escapeHtml(targetUser)}` : 'to room';
     
     messageDiv.innerHTML = `
         <div class="message-avatar">${initial}</div>
@@ -657,24 +650,22 @@ function displayLocalFile(filename, filesize, targetUser = null) {
         </div>
     `;
     
-    container.appendChild(messageDiv);
-    scrollToBottom();
+    return messageDiv;
 }
 
 // Display received file (called from Python)
 eel.expose(display_file);
 function display_file(fileData) {
-    const container = document.getElementById('messagesContainer');
-    const welcomeMsg = container.querySelector('.welcome-message');
-    if (welcomeMsg) {
-        welcomeMsg.remove();
-    }
-    
+    storeMessage('file', fileData);
+}
+
+// Build the DOM node for a received file
+function buildFileElement(record) {
+    const fileData = record.data;
     const messageDiv = document.createElement('div');
     messageDiv.className = 'message file';
     
-    const now = new Date();
-    const timeStr = now.toLocaleTimeString('en-US', { hour: '2-digit', minute: '2-digit' });
+    const timeStr = record.time;
     const sender = fileData.sender || 'Unknown';
     const initial = sender.charAt(0).toUpperCase();
     const filename = fileData.filename || 'unknown_file';
@@ -682,12 +673,20 @@ function display_file(fileData) {
     const filepath = fileData.filepath || '';
     const isImage = fileData.is_image || false;
     const fileUrl = fileData.file_url;
+    const previewUrl = fileData.thumbnail_url || fileUrl;
     
     let fileContent = '';
     if (isImage && fileUrl) {
         fileContent = `
-            <img src="${fileUrl}" class="file-image" alt="${escapeHtml(filename)}" 
-                 onclick="window.open(this.src, '_blank')">
+            <img src="${escapeHtml(previewUrl)}" class="file-image" alt="${escapeHtml(filename)}" 
+                 loading="lazy" data-full="${escapeHtml(fileUrl)}"
+                 onclick="window.open(this.dataset.full, '_blank')">
+        `;
+    } else if (fileUrl) {
+        fileContent = `
+            <div style="font-size: 0.9em; margin-top: 8px;">
+                <a href="${escapeHtml(fileUrl)}" download="${escapeHtml(filename)}">Download</a>
+            </div>
         `;
     } else {
         fileContent = `
@@ -717,8 +716,35 @@ function display_file(fileData) {
         </div>
     `;
     
-    container.appendChild(messageDiv);
-    scrollToBottom();
+    return messageDiv;
+}
+
+// Show download progress (called from Python)
+eel.expose(display_file_progress);
+function display_file_progress(progress) {
+    if (progress.done) {
+        delete activeDownloads[progress.id];
+    } else {
+        activeDownloads[progress.id] = progress;
+    }
+    
+    const bar = document.getElementById('transferProgress');
+    const downloads = Object.values(activeDownloads);
+    if (downloads.length === 0) {
+        bar.style.display = 'none';
+        return;
+    }
+    
+    let received = 0;
+    let total = 0;
+    downloads.forEach(d => {
+        received += d.received;
+        total += d.total;
+    });
+    const percent = total ? Math.floor(received * 100 / total) : 0;
+    const label = downloads.length === 1 ? downloads[0].filename : `${downloads.length} files`;
+    bar.textContent = `⬇ Receiving ${label} - ${formatFileSize(received)} / ${formatFileSize(total)} (${percent}%)`;
+    bar.style.display = 'block';
 }
 
 // Format file size
@@ -730,6 +756,155 @@ function formatFileSize(bytes) {
     return Math.round(bytes / Math.pow(k, i) * 100) / 100 + ' ' + sizes[i];
 }
 
+// ========== VIRTUALIZED MESSAGE VIEW ==========
+
+// Add a record to the store and render it if the view is at the tail
+function storeMessage(kind, data) {
+    const container = document.getElementById('messagesContainer');
+    const welcomeMsg = container.querySelector('.welcome-message');
+    if (welcomeMsg) {
+        welcomeMsg.remove();
+    }
+    
+    const record = {
+        id: messageStore.nextId++,
+        kind: kind,
+        data: data,
+        time: new Date().toLocaleTimeString('en-US', { hour: '2-digit', minute: '2-digit' })
+    };
+    messageStore.records.push(record);
+    trimMessageStore(container);
+    
+    // Only attach the node if the window ends at the tail; otherwise it is
+    // paged in when the user scrolls back down
+    if (viewEnd === record.id && (followTail || viewEnd - viewStart < RENDER_WINDOW)) {
+        container.appendChild(renderRecord(record));
+        viewEnd = record.id + 1;
+        if (followTail) {
+            removeFromTop(container, viewEnd - viewStart - RENDER_WINDOW, false);
+            scrollToBottom();
+        }
+    }
+}
+
+// Drop the oldest records once the store is a page over its limit
+function trimMessageStore(container) {
+    const records = messageStore.records;
+    if (records.length <= MAX_STORED_MESSAGES + PAGE_SIZE) return;
+    
+    const drop = records.length - MAX_STORED_MESSAGES;
+    records.splice(0, drop).forEach(releaseRecord);
+    messageStore.firstId += drop;
+    
+    if (viewEnd <= messageStore.firstId) {
+        // Everything on screen was evicted, jump back to the newest messages
+        container.innerHTML = '';
+        viewStart = viewEnd = messageStore.nextId - 1;
+        followTail = true;
+    } else if (viewStart < messageStore.firstId) {
+        removeFromTop(container, messageStore.firstId - viewStart, !followTail);
+    }
+}
+
+// Free the blobs behind a dropped file message; files received in the
+// browser are kept in memory until their URL is revoked
+function releaseRecord(record) {
+    if (record.kind !== 'file') return;
+    [record.data.file_url, record.data.thumbnail_url].forEach(url => {
+        if (url && url.startsWith('blob:')) {
+            URL.revokeObjectURL(url);
+        }
+    });
+}
+
+function getRecord(id) {
+    return messageStore.records[id - messageStore.firstId];
+}
+
+// Build the DOM node for a stored record
+function renderRecord(record) {
+    let element;
+    if (record.kind === 'error') {
+        element = buildErrorElement(record);
+    } else if (record.kind === 'local_file') {
+        element = buildLocalFileElement(record);
+    } else if (record.kind === 'file') {
+        element = buildFileElement(record);
+    } else {
+        element = buildMessageElement(record);
+    }
+    element.dataset.msgId = record.id;
+    return element;
+}
+
+function renderRange(from, to) {
+    const fragment = document.createDocumentFragment();
+    for (let id = from; id < to; id++) {
+        fragment.appendChild(renderRecord(getRecord(id)));
+    }
+    return fragment;
+}
+
+// Detach the first `count` rendered nodes, optionally keeping the visible
+// content where it was on screen
+function removeFromTop(container, count, keepPosition) {
+    if (count <= 0) return;
+    const heightBefore = container.scrollHeight;
+    for (let i = 0; i < count && container.firstElementChild; i++) {
+        container.firstElementChild.remove();
+        viewStart++;
+    }
+    if (keepPosition) {
+        container.scrollTop -= heightBefore - container.scrollHeight;
+    }
+}
+
+// Page older records in above the window and drop the same amount below
+function pageOlder(container) {
+    const from = Math.max(messageStore.firstId, viewStart - PAGE_SIZE);
+    if (from >= viewStart) return;
+    
+    const heightBefore = container.scrollHeight;
+    container.insertBefore(renderRange(from, viewStart), container.firstElementChild);
+    viewStart = from;
+    container.scrollTop += container.scrollHeight - heightBefore;
+    
+    while (viewEnd - viewStart > RENDER_WINDOW && container.lastElementChild) {
+        container.lastElementChild.remove();
+        viewEnd--;
+    }
+}
+
+// Page newer records in below the window and drop the same amount above
+function pageNewer(container) {
+    const to = Math.min(messageStore.nextId, viewEnd + PAGE_SIZE);
+    if (to <= viewEnd) return;
+    
+    container.appendChild(renderRange(viewEnd, to));
+    viewEnd = to;
+    removeFromTop(container, viewEnd - viewStart - RENDER_WINDOW, true);
+}
+
+// Scroll listener, throttled to one check per animation frame
+function handleMessagesScroll() {
+    if (scrollCheckPending) return;
+    scrollCheckPending = true;
+    requestAnimationFrame(() => {
+        scrollCheckPending = false;
+        const container = document.getElementById('messagesContainer');
+        const distanceToBottom = () => container.scrollHeight - container.scrollTop - container.clientHeight;
+        
+        if (container.scrollTop < SCROLL_EDGE_PX && viewStart > messageStore.firstId) {
+            followTail = false;
+            pageOlder(container);
+        } else if (distanceToBottom() < SCROLL_EDGE_PX && viewEnd < messageStore.nextId) {
+            pageNewer(container);
+        }
+        
+        followTail = distanceToBottom() < SCROLL_EDGE_PX && viewEnd === messageStore.nextId;
+    });
+}
+
 // ========== VOICE CALLING FUNCTIONS ==========
 
 let currentCaller = null;
@@ -773,7 +948,7 @@ function display_call_incoming(caller) {
     // Also show notification in chat
     display_message({
         type: 'notification',
-        text: 📞 Incoming call from ${caller}
+        text: `📞 Incoming call from ${caller}`
     });
 }
 
@@ -828,7 +1003,7 @@ function display_call_started(partner) {
     
     display_message({
         type: 'notification',
-        text: 📞 Call connected with ${partner}
+        text: `📞 Call connected with ${partner}`
     });
 }
 
@@ -842,7 +1017,7 @@ function display_call_ended(message) {
     
     display_message({
         type: 'notification',
-        text: 📞 ${message}
+        text: `📞 ${message}`
     });
 }
 
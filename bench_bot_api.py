@@ -0,0 +1,158 @@
+# bench_bot_api.py
+# Bot API benchmark: messages per second one bot posts through the bulk
+# endpoint, and how fast they reach the members of the room. The server runs
+# in a subprocess (with the bot rate limit lifted) so it does not share the
+# interpreter with the benchmark clients.
+#
+# Usage: python bench_bot_api.py [--seconds 5] [--batch 500] [--members 10]
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import protocol
+
+BOT_NAME = "bench"
+BOT_TOKEN = "bench-token"
+ROOM = "lobby"
+SERVER_START_TIMEOUT = 10
+
+
+def run_server(args):
+    """Body of the server subprocess"""
+    import server
+    server.INBOX_FILE = ':memory:'
+    server.WEB_PORT = None
+    server.BOT_MESSAGE_RATE = (1e9, 1e9)
+    server.BOT_API_PORT = args.bot_port
+    server.BOT_TOKENS = {BOT_TOKEN: BOT_NAME}
+    srv = server.open_server('127.0.0.1', args.port, args.udp_port)
+    try:
+        server.serve(srv)
+    finally:
+        server.stop_server()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Member:
+    """A logged-in client counting the bot messages it receives"""
+
+    def __init__(self, port, name):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.sendall(protocol.encode({"type": "login", "payload": name}))
+        self.received = 0
+        self.last_at = None
+        self.thread = threading.Thread(target=self.read, daemon=True)
+        self.thread.start()
+
+    def read(self):
+        buffer = bytearray()
+        while True:
+            try:
+                data = self.sock.recv(1 << 20)
+            except OSError:
+                return
+            if not data:
+                return
+            buffer += data
+            while (line := protocol.pop_frame(buffer)) is not None:
+                if b'"bot"' in line:
+                    self.received += 1
+                    self.last_at = time.perf_counter()
+
+    def close(self):
+        try:
+            self.sock.sendall(protocol.encode({"type": "logout", "payload": ""}))
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def post_batches(port, batch_size, seconds):
+    """Post batches for about the given time, return (messages accepted, elapsed seconds)"""
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    headers = {"Authorization": f"Bearer {BOT_TOKEN}", "Content-Type": "application/json"}
+    accepted = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        body = json.dumps({"messages": [
+            {"room": ROOM, "sender": "ci", "text": f"build {accepted + i} passed"} for i in range(batch_size)
+        ]})
+        conn.request("POST", "/bot/messages", body, headers)
+        response = conn.getresponse()
+        result = json.loads(response.read())
+        if response.status != 200:
+            raise RuntimeError(f"Bot API answered {response.status}: {result}")
+        accepted += result["accepted"]
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return accepted, elapsed, start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bulk message posting through the bot API")
+    parser.add_argument('--seconds', type=float, default=5, help="How long the bot posts")
+    parser.add_argument('--batch', type=int, default=500, help="Messages per request")
+    parser.add_argument('--members', type=int, default=10, help="Clients in the room")
+    # Internal: run as the server subprocess
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--udp-port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--bot-port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        run_server(args)
+        return
+
+    port, udp_port, bot_port = free_port(), free_port(), free_port()
+    command = [sys.executable, os.path.abspath(__file__), '--serve', '--port', str(port),
+               '--udp-port', str(udp_port), '--bot-port', str(bot_port)]
+    proc = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    members = []
+    try:
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', bot_port), 1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or proc.poll() is not None:
+                    raise RuntimeError("Server did not start")
+                time.sleep(0.1)
+
+        members = [Member(port, f"member{i}") for i in range(args.members)]
+        time.sleep(0.5)
+        accepted, elapsed, start = post_batches(bot_port, args.batch, args.seconds)
+
+        # Wait for the members to drain their share
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline and any(m.received < accepted for m in members):
+            time.sleep(0.05)
+        delivered = sum(m.received for m in members)
+        finished = max((m.last_at for m in members if m.last_at is not None), default=start + elapsed)
+    finally:
+        for member in members:
+            member.close()
+        proc.terminate()
+        proc.wait()
+
+    print(f"posted    {accepted:>10,} messages in {elapsed:.2f}s = {accepted / elapsed:>10,.0f} msg/s "
+          f"({args.batch} per request)")
+    print(f"delivered {delivered:>10,} of {accepted * args.members:,} to {args.members} members = "
+          f"{delivered / (finished - start):>10,.0f} msg/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# bench_codec.py
+# Codec benchmark: encode and decode cost per message type for every
+# installed backend (json always, orjson and msgspec when installed).
+# Decoding client messages includes schema validation, as in the server.
+#
+# Usage: python bench_codec.py [--seconds 0.2] [--codec json orjson msgspec]
+
+import argparse
+import time
+
+import protocol
+
+MEMBERS = [f"user{i}" for i in range(50)]
+
+# Client -> server messages, decoded with validation
+CLIENT_MESSAGES = {
+    "login": {"type": "login", "payload": "alice"},
+    "ping": {"type": "ping", "payload": ""},
+    "pong": {"type": "pong", "payload": ""},
+    "message": {"type": "message", "payload": "Hello everyone, how is it going today?"},
+    "private_message": {"type": "private_message", "target": "bob", "payload": "See you at five"},
+    "join_room": {"type": "join_room", "payload": "general"},
+    "list_rooms": {"type": "list_rooms", "payload": ""},
+    "call_request": {"type": "call_request", "payload": "bob"},
+    "call_accept": {"type": "call_accept", "payload": "alice"},
+    "call_reject": {"type": "call_reject", "payload": "alice"},
+    "call_end": {"type": "call_end", "payload": ""},
+    "file_transfer": {"type": "file_transfer", "filename": "report.pdf", "filesize": 482133, "target": None}
+}
+
+# Server -> client messages, decoded without validation like the client does
+SERVER_MESSAGES = {
+    "login_success": {"type": "login_success", "payload": "Welcome, alice!"},
+    "notification": {"type": "notification", "payload": "bob joined the chat!"},
+    "message (out)": {"type": "message", "sender": "alice", "room": "lobby",
+                      "payload": "Hello everyone, how is it going today?"},
+    "private_message (out)": {"type": "private_message", "sender": "alice", "payload": "See you at five"},
+    "user_list (50)": {"type": "user_list", "payload": MEMBERS},
+    "room_info (50)": {"type": "room_info", "payload": {"room": "lobby", "members": MEMBERS}},
+    "room_list": {"type": "room_list", "payload": {f"room{i}": MEMBERS[i::10] for i in range(10)}},
+    "file_incoming": {"type": "file_incoming", "sender": "alice", "filename": "report.pdf",
+                      "filesize": 482133, "target": None},
+    "error": {"type": "error", "payload": "Rate limit exceeded, request dropped"}
+}
+
+
+def time_per_call(func, arg, seconds):
+    """Nanoseconds per call, measured over about the given time"""
+    count = 1
+    while True:
+        start = time.perf_counter_ns()
+        for _ in range(count):
+            func(arg)
+        elapsed = time.perf_counter_ns() - start
+        if elapsed >= seconds * 1e9:
+            return elapsed / count
+        count *= 2
+
+
+def bench_codec(codec, seconds):
+    rows = []
+    for name, message in list(CLIENT_MESSAGES.items()) + list(SERVER_MESSAGES.items()):
+        frame = codec.encode(message)
+        line = frame.rstrip(b"\n")
+        validate = name in CLIENT_MESSAGES
+        encode_ns = time_per_call(codec.encode, message, seconds)
+        decode_ns = time_per_call(lambda data: codec.decode(data, validate), line, seconds)
+        rows.append((name, len(frame), encode_ns, decode_ns))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the protocol codecs per message type")
+    parser.add_argument('--seconds', type=float, default=0.2, help="Measuring time per message type and operation")
+    parser.add_argument('--codec', nargs='+', choices=list(protocol.AVAILABLE_CODECS), default=list(protocol.AVAILABLE_CODECS))
+    args = parser.parse_args()
+
+    results = {name: bench_codec(protocol.get_codec(name), args.seconds) for name in args.codec}
+
+    # One table: per message type, encode/decode ns for each codec
+    header = f"{'message':<24}{'bytes':>7}"
+    for name in args.codec:
+        header += f"{name + ' enc':>14}{name + ' dec':>14}"
+    print(header)
+    print("-" * len(header))
+
+    for index, (message_name, size, _, _) in enumerate(results[args.codec[0]]):
+        row = f"{message_name:<24}{size:>7}"
+        for name in args.codec:
+            _, _, encode_ns, decode_ns = results[name][index]
+            row += f"{encode_ns:>12,.0f}ns{decode_ns:>12,.0f}ns"
+        print(row)
+
+    if "json" in results and len(results) > 1:
+        print()
+        for name in args.codec:
+            if name == "json":
+                continue
+            speedup_enc = sum(r[2] for r in results["json"]) / sum(r[2] for r in results[name])
+            speedup_dec = sum(r[3] for r in results["json"]) / sum(r[3] for r in results[name])
+            print(f"{name}: {speedup_enc:.1f}x faster encode, {speedup_dec:.1f}x faster decode than json (summed over all types)")
+
+
+if __name__ == "__main__":
+    main()
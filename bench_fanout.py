@@ -0,0 +1,118 @@
+# bench_fanout.py
+# Room fan-out benchmark: how long a sender's thread spends in broadcast()
+# for a large room, and how long until every member has read the messages,
+# with broadcasts queued inline and through the fan-out workers. Members are
+# socketpairs in this process, read by one selector thread.
+#
+# Usage: python bench_fanout.py [--members 2000] [--messages 200] [--workers 4]
+
+import argparse
+import queue
+import selectors
+import socket
+import threading
+import time
+
+import server
+
+ROOM = "bench"
+
+
+class Members:
+    """Sessions in one room whose sockets are drained and counted by a reader thread"""
+
+    def __init__(self, count):
+        self.selector = selectors.DefaultSelector()
+        self.sessions = []
+        self.peers = []
+        self.received = 0
+        for i in range(count):
+            ours, theirs = socket.socketpair()
+            theirs.setblocking(False)
+            session = server.Session(f"member{i}", ours)
+            session.room = server.enter_room(ROOM, session)
+            self.sessions.append(session)
+            self.peers.append(theirs)
+            self.selector.register(theirs, selectors.EVENT_READ)
+        self.running = True
+        self.thread = threading.Thread(target=self.read, daemon=True)
+        self.thread.start()
+
+    def read(self):
+        while self.running:
+            for key, _ in self.selector.select(0.1):
+                try:
+                    data = key.fileobj.recv(1 << 16)
+                except BlockingIOError:
+                    continue
+                self.received += data.count(b"\n")
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        for session in self.sessions:
+            server.leave_room(session.room, session)
+            session.outbox.close()
+            session.socket.close()
+        for peer in self.peers:
+            peer.close()
+        self.selector.close()
+
+
+def run(members, messages, pooled, workers):
+    """Broadcast from the first member, return (seconds in broadcast(), seconds until all were read)"""
+    threads = []
+    if pooled:
+        server.fanout_queues = [queue.SimpleQueue() for _ in range(workers)]
+        for jobs in server.fanout_queues:
+            thread = threading.Thread(target=server.fanout_worker, args=(jobs,), daemon=True)
+            thread.start()
+            threads.append(thread)
+    else:
+        server.fanout_queues = None
+
+    room = server.get_room(ROOM)
+    sender = members.sessions[0]
+    expected = members.received + messages * (len(members.sessions) - 1)
+    text = "x" * 100
+    start = time.perf_counter()
+    for i in range(messages):
+        server.broadcast({"type": "message", "sender": sender.username, "payload": f"{i} {text}"},
+                         sender_id=sender.id, room=room)
+    queued = time.perf_counter() - start
+
+    # The sender also gets a room_seq frame per message
+    expected += messages
+    while members.received < expected:
+        time.sleep(0.001)
+    delivered = time.perf_counter() - start
+
+    queues, server.fanout_queues = server.fanout_queues, None
+    for jobs in queues or ():
+        jobs.put(None)
+    for thread in threads:
+        thread.join()
+    return queued, delivered
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark broadcasting to a large room")
+    parser.add_argument('--members', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=server.FANOUT_WORKERS)
+    args = parser.parse_args()
+
+    server.ROOM_HISTORY = args.messages
+    members = Members(args.members)
+    try:
+        for pooled in (False, True):
+            queued, delivered = run(members, args.messages, pooled, args.workers)
+            label = f"pooled ({args.workers} workers)" if pooled else "inline"
+            print(f"{label:<20} broadcast {queued / args.messages * 1e6:>8,.0f} us/message   "
+                  f"delivered {args.messages * (args.members - 1) / delivered:>10,.0f} frames/s")
+    finally:
+        members.close()
+
+
+if __name__ == "__main__":
+    main()
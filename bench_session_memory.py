@@ -0,0 +1,72 @@
+# bench_session_memory.py
+# Memory benchmark: Python heap bytes per idle session.
+# Builds N logged-in sessions the way the server does (Session object, room
+# membership, registration in server.clients) without real sockets, so the
+# number covers the server's own per-connection state. Kernel socket buffers
+# and the per-client handler thread stack are not included.
+#
+# Usage: python bench_session_memory.py [--sessions 50000] [--rooms 1]
+
+import argparse
+import gc
+import time
+import tracemalloc
+
+import server
+
+
+def read_rss():
+    """Resident set size in bytes, or None where /proc is not available"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def build_sessions(count, room_count):
+    for i in range(count):
+        # Names arrive as fresh strings from the JSON decoder, as in a real login
+        username = "".join(["user", str(i)])
+        session = server.Session(username, None)
+        with server.clients_lock:
+            server.clients[session.username] = session
+        session.room = server.enter_room(server.DEFAULT_ROOM if room_count <= 1 else f"room{i % room_count}", session)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure server memory per idle session")
+    parser.add_argument('--sessions', type=int, default=50000)
+    parser.add_argument('--rooms', type=int, default=1, help="Spread sessions over this many rooms")
+    args = parser.parse_args()
+
+    gc.collect()
+    rss_before = read_rss()
+    tracemalloc.start()
+    heap_before = tracemalloc.get_traced_memory()[0]
+
+    start = time.perf_counter()
+    build_sessions(args.sessions, args.rooms)
+    elapsed = time.perf_counter() - start
+
+    gc.collect()
+    heap_after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    rss_after = read_rss()
+
+    heap_per_session = (heap_after - heap_before) / args.sessions
+    print(f"sessions               {args.sessions:,}")
+    print(f"rooms                  {len(server.rooms):,}")
+    print(f"build time             {elapsed:.2f}s")
+    print(f"heap bytes/session     {heap_per_session:,.0f}")
+    print(f"heap total             {(heap_after - heap_before) / 1024 / 1024:,.1f} MiB")
+    if rss_before is not None and rss_after is not None:
+        # RSS includes tracemalloc's own bookkeeping, so it overstates a bit
+        print(f"rss bytes/session      {(rss_after - rss_before) / args.sessions:,.0f}")
+
+
+if __name__ == "__main__":
+    main()
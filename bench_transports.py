@@ -0,0 +1,264 @@
+# bench_transports.py
+# Transport benchmark: connection setup rate and file relay throughput over
+# TCP, Unix domain sockets and TLS. TLS setup is measured twice, with full
+# handshakes and with sessions resumed from tickets, as a reconnecting client
+# does. The server runs in a subprocess (with rate limits lifted) so it does
+# not share the interpreter with the benchmark clients.
+#
+# A connection setup is connect (plus TLS handshake), login, login_success
+# and logout. Throughput is one client uploading files that the server relays
+# to a second client in the same room.
+#
+# Usage: python bench_transports.py [--connections 300] [--megabytes 64]
+#                                   [--transport tcp unix tls] [--certfile cert.pem --keyfile key.pem]
+# Without a certificate a temporary self-signed one is made with openssl.
+
+import argparse
+import itertools
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import protocol
+import transport
+
+FILE_SIZE = 4 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+SERVER_START_TIMEOUT = 10
+TLS_HOSTNAME = "localhost"
+
+
+def run_server(args):
+    """Body of the server subprocess"""
+    import server
+    server.INBOX_FILE = ':memory:'
+    server.USER_FILE_BYTE_RATE = (1e12, 1e12)
+    server.WEB_PORT = None
+    server.TLS_CERTFILE = args.certfile
+    server.TLS_KEYFILE = args.keyfile
+    listen = [transport.format_url(transport.UNIX, args.unix_path)]
+    if args.certfile:
+        listen.append(transport.format_url(transport.TLS, ('127.0.0.1', args.tls_port)))
+    srv = server.open_server('127.0.0.1', args.port, args.udp_port, listen)
+    try:
+        server.serve(srv)
+    finally:
+        server.stop_server()
+
+
+def make_certificate(directory):
+    """Self-signed certificate for localhost, return (certfile, keyfile)"""
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.run([
+        'openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+        '-nodes', '-days', '1', '-subj', f'/CN={TLS_HOSTNAME}',
+        '-addext', f'subjectAltName=DNS:{TLS_HOSTNAME},IP:127.0.0.1',
+        '-keyout', keyfile, '-out', certfile
+    ], check=True, capture_output=True)
+    return certfile, keyfile
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Connection:
+    """A logged-in benchmark client on a raw socket"""
+
+    def __init__(self, url, name, ssl_context=None):
+        self.sock = transport.connect(url, 10, ssl_context, TLS_HOSTNAME)
+        self.buffer = bytearray()
+        self.credit = 0
+        self.sock.sendall(protocol.encode({"type": "login", "payload": name}))
+        message = self.wait_for("login_success", "error")
+        if message["type"] == "error":
+            raise RuntimeError(message.get("payload"))
+        self.credit = message.get("upload_window", 0)
+
+    def read_message(self):
+        while (line := protocol.pop_frame(self.buffer)) is None:
+            data = self.sock.recv(1 << 20)
+            if not data:
+                raise ConnectionError("Server closed the connection")
+            self.buffer += data
+        return protocol.decode(line, validate=False)
+
+    def wait_for(self, *types):
+        while True:
+            message = self.read_message()
+            if message["type"] == "file_credit":
+                self.credit += message["payload"]
+            if message["type"] in types:
+                return message
+
+    def upload(self, transfer_id, data):
+        """Send a file with the chunked upload protocol, within the server's credit"""
+        self.sock.sendall(protocol.encode({
+            "type": "file_transfer", "filename": "bench.bin", "filesize": len(data),
+            "target": None, "transfer_id": transfer_id
+        }))
+        view = memoryview(data)
+        for offset in range(0, len(data), CHUNK_SIZE):
+            chunk = view[offset:offset + CHUNK_SIZE]
+            while self.credit < len(chunk):
+                self.wait_for("file_credit")
+            self.credit -= len(chunk)
+            self.sock.sendall(protocol.encode_file_chunk(transfer_id, chunk))
+
+    def close(self):
+        try:
+            self.sock.sendall(protocol.encode({"type": "logout", "payload": ""}))
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def bench_connect(url, count, names, ssl_context=None, resume=False):
+    """Connection setups per second, and how many resumed a TLS session"""
+    resumed = 0
+    start = time.perf_counter()
+    for _ in range(count):
+        conn = Connection(url, next(names), ssl_context)
+        if getattr(conn.sock, 'session_reused', False):
+            resumed += 1
+        if resume:
+            transport.remember_session(conn.sock, url)
+        conn.close()
+    return count / (time.perf_counter() - start), resumed
+
+
+def receive_files(conn, total, done):
+    """Read relayed files until total file bytes have arrived"""
+    received = 0
+    while received < total:
+        message = conn.read_message()
+        if message["type"] != "file_incoming":
+            continue
+        remaining = struct.unpack('>I', conn_read(conn, 4))[0]
+        while remaining:
+            if conn.buffer:
+                taken = min(len(conn.buffer), remaining)
+                del conn.buffer[:taken]
+            else:
+                taken = len(conn.sock.recv(min(remaining, 1 << 20)))
+                if not taken:
+                    raise ConnectionError("Server closed the connection")
+            remaining -= taken
+            received += taken
+    done.set()
+
+
+def conn_read(conn, count):
+    while len(conn.buffer) < count:
+        data = conn.sock.recv(1 << 20)
+        if not data:
+            raise ConnectionError("Server closed the connection")
+        conn.buffer += data
+    data = bytes(conn.buffer[:count])
+    del conn.buffer[:count]
+    return data
+
+
+def bench_throughput(url, megabytes, names, ssl_context=None):
+    """MB/s of file data relayed from one client to another"""
+    sender = Connection(url, next(names), ssl_context)
+    receiver = Connection(url, next(names), ssl_context)
+    files = max(1, megabytes * 1024 * 1024 // FILE_SIZE)
+    data = os.urandom(FILE_SIZE)
+    done = threading.Event()
+    thread = threading.Thread(target=receive_files, args=(receiver, files * FILE_SIZE, done), daemon=True)
+    thread.start()
+
+    start = time.perf_counter()
+    for transfer_id in range(1, files + 1):
+        sender.upload(transfer_id, data)
+    done.wait()
+    elapsed = time.perf_counter() - start
+    sender.close()
+    receiver.close()
+    return files * FILE_SIZE / elapsed / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark connection setup and throughput per transport")
+    parser.add_argument('--connections', type=int, default=300, help="Connection setups measured per transport")
+    parser.add_argument('--megabytes', type=int, default=64, help="File data relayed per transport")
+    parser.add_argument('--transport', nargs='+', choices=transport.SCHEMES, default=list(transport.SCHEMES))
+    parser.add_argument('--certfile')
+    parser.add_argument('--keyfile')
+    # Internal: run as the server subprocess
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--udp-port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--tls-port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--unix-path', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        run_server(args)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if transport.TLS in args.transport and not args.certfile:
+            args.certfile, args.keyfile = make_certificate(tmp)
+        unix_path = os.path.join(tmp, 'chat.sock')
+        port, udp_port, tls_port = free_port(), free_port(), free_port()
+        urls = {
+            transport.TCP: transport.format_url(transport.TCP, ('127.0.0.1', port)),
+            transport.UNIX: transport.format_url(transport.UNIX, unix_path),
+            transport.TLS: transport.format_url(transport.TLS, ('127.0.0.1', tls_port)),
+        }
+
+        command = [sys.executable, os.path.abspath(__file__), '--serve', '--port', str(port),
+                   '--udp-port', str(udp_port), '--tls-port', str(tls_port), '--unix-path', unix_path]
+        if args.certfile:
+            command += ['--certfile', args.certfile]
+        if args.keyfile:
+            command += ['--keyfile', args.keyfile]
+        proc = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            deadline = time.monotonic() + SERVER_START_TIMEOUT
+            while True:
+                try:
+                    transport.connect(urls[transport.TCP], 1).close()
+                    break
+                except OSError:
+                    if time.monotonic() > deadline or proc.poll() is not None:
+                        raise RuntimeError("Server did not start")
+                    time.sleep(0.1)
+
+            names = (f"bench{i}" for i in itertools.count())
+            rows = []
+            for scheme in args.transport:
+                url = urls[scheme]
+                if scheme == transport.TLS:
+                    full_rate, _ = bench_connect(url, args.connections, names,
+                                                 transport.client_context(args.certfile))
+                    resume_context = transport.client_context(args.certfile)
+                    resumed_rate, resumed = bench_connect(url, args.connections, names, resume_context, resume=True)
+                    mbps = bench_throughput(url, args.megabytes, names, resume_context)
+                    rows.append(("tls (full handshake)", full_rate, None))
+                    rows.append((f"tls (resumed {resumed}/{args.connections})", resumed_rate, mbps))
+                else:
+                    rate, _ = bench_connect(url, args.connections, names)
+                    rows.append((scheme, rate, bench_throughput(url, args.megabytes, names)))
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    print(f"{'transport':<28}{'setups/s':>10}{'relay MB/s':>12}")
+    print("-" * 50)
+    for name, rate, mbps in rows:
+        print(f"{name:<28}{rate:>10,.0f}{mbps:>12,.1f}" if mbps is not None else f"{name:<28}{rate:>10,.0f}{'':>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+# bot_api.py
+# Local HTTP endpoint for bots (build status, alerts) to post messages into
+# rooms in bulk, instead of logging in and sending one message at a time:
+#
+#   POST /bot/messages
+#   Authorization: Bearer <token>
+#   {"messages": [{"room": "builds", "text": "main is green", "sender": "ci"}, ...]}
+#
+# Bots and their tokens are configured as "name=token,name=token" (the
+# server reads CHAT_BOT_TOKENS). What happens to a batch, including the
+# per-bot rate limit, is up to the post_batch callback the server passes
+# in; this module only speaks HTTP and checks requests. Connections are
+# kept alive, so a bot can post batch after batch without reconnecting.
+
+import hmac
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import protocol
+import transport
+
+BOT_PATH = "/bot/messages"
+MAX_BATCH = 1000                  # Messages per request
+MAX_BODY_BYTES = 4 * 1024 * 1024  # Request body size
+
+
+class BotApiError(Exception):
+    """A request rejected with an HTTP status (and a Retry-After for 429)"""
+
+    def __init__(self, status, message, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def parse_tokens(spec):
+    """{token: bot name} from "name=token,name=token" """
+    tokens = {}
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, sep, token = entry.partition("=")
+        if not sep or not name or not token:
+            raise ValueError(f"Bot token entry '{entry}' is not name=token")
+        tokens[token] = name
+    return tokens
+
+
+def parse_batch(body):
+    """Decode a request body into a list of (room, sender, text); sender may be None"""
+    try:
+        request = protocol.codec.loads(body)
+    except protocol.ProtocolError as e:
+        raise BotApiError(400, str(e)) from None
+    messages = request.get("messages") if isinstance(request, dict) else None
+    if not isinstance(messages, list):
+        raise BotApiError(400, "Body must be an object with a 'messages' list")
+    if len(messages) > MAX_BATCH:
+        raise BotApiError(413, f"At most {MAX_BATCH} messages per request")
+
+    batch = []
+    for index, message in enumerate(messages):
+        if not isinstance(message, dict):
+            raise BotApiError(400, f"Message {index} is not an object")
+        room = message.get("room")
+        text = message.get("text")
+        sender = message.get("sender")
+        if type(room) is not str or not room or type(text) is not str or not text:
+            raise BotApiError(400, f"Message {index} needs a non-empty 'room' and 'text'")
+        if sender is not None and (type(sender) is not str or not sender):
+            raise BotApiError(400, f"Message {index} has an invalid 'sender'")
+        batch.append((room, sender, text))
+    return batch
+
+
+class BotApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        try:
+            if self.path.split("?", 1)[0] != BOT_PATH:
+                raise BotApiError(404, "Not found")
+            bot = self.authenticate()
+            length = self.headers.get("Content-Length")
+            if length is None or not length.isdigit():
+                raise BotApiError(411, "Content-Length required")
+            if int(length) > MAX_BODY_BYTES:
+                self.close_connection = True  # The body is not read
+                raise BotApiError(413, f"Body larger than {MAX_BODY_BYTES} bytes")
+            batch = parse_batch(self.rfile.read(int(length)))
+            result = self.server.post_batch(bot, batch)
+        except BotApiError as e:
+            self.reply(e.status, {"error": str(e)}, e.retry_after)
+            return
+        self.reply(200, result)
+
+    def authenticate(self):
+        """Name of the bot the request's bearer token belongs to"""
+        scheme, _, given = self.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() == "bearer" and given:
+            given = given.strip().encode('utf-8')
+            # Every token is compared in constant time, so timing tells nothing
+            bot = None
+            for token, name in self.server.tokens.items():
+                if hmac.compare_digest(token.encode('utf-8'), given):
+                    bot = name
+            if bot is not None:
+                return bot
+        raise BotApiError(401, "Missing or unknown bot token")
+
+    def reply(self, status, body, retry_after=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if status == 401:
+            self.send_header("WWW-Authenticate", "Bearer")
+        if retry_after is not None:
+            self.send_header("Retry-After", str(retry_after))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Batches are logged by the chat server
+        pass
+
+
+class BotApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, tokens, post_batch):
+        super().__init__(address, BotApiHandler)
+        self.tokens = tokens
+        self.post_batch = post_batch
+
+    def get_request(self):
+        # Replies are written as headers and body; with Nagle the body would
+        # wait for the bot's delayed ACK on every request
+        sock, address = super().get_request()
+        transport.set_nodelay(sock)
+        return sock, address
+
+
+def start_bot_api(host, port, tokens, post_batch):
+    """Serve the bot endpoint from a daemon thread, return the HTTP server.
+
+    tokens is {token: bot name}; post_batch(bot, batch) is called with each
+    checked batch and returns the JSON response body, or raises BotApiError.
+    """
+    httpd = BotApiServer((host, port), tokens, post_batch)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd
+
+
+def stop_bot_api(httpd):
+    httpd.shutdown()
+    httpd.server_close()
@@ -0,0 +1,165 @@
+# chat_logging.py
+# Non-blocking logging for the chat server.
+# Callers only format a record and drop it on a bounded queue; a background
+# listener thread writes it to the console and to a rotating JSON log file.
+# When the queue is full records are dropped (and counted) instead of
+# stalling the thread that logged them.
+
+import atexit
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+
+import metrics
+
+LOG_FILE = os.path.join('logs', 'server.log')
+LOG_MAX_BYTES = 10 * 1024 * 1024  # Rotate the JSON log at this size
+LOG_BACKUPS = 5                   # Rotated files kept
+LOG_QUEUE_SIZE = 10000            # Records buffered before new ones are dropped
+SAMPLE_EVERY = 100                # Per-message records: only one in this many is kept
+
+LOG_RECORDS_DROPPED = metrics.Counter("chat_log_records_dropped_total", "Log records dropped because the log queue was full")
+LOG_RECORDS_SAMPLED_OUT = metrics.Counter("chat_log_records_sampled_out_total", "Per-message log records skipped by sampling")
+
+_listener = None
+
+
+class EventLogger:
+    """Logger for '[TAG] message' events with optional structured fields.
+
+    log.info("LOGIN", "%s logged in", username, user=username) produces the
+    console line "[LOGIN] alice logged in" and a JSON record carrying the tag,
+    message and fields. Pass sample=True for per-message events that only
+    need to be logged one in SAMPLE_EVERY times.
+    """
+
+    def __init__(self, name):
+        self.logger = logging.getLogger(name)
+
+    def log(self, level, tag, msg, *args, sample=False, **fields):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, msg, *args, extra={'tag': tag, 'fields': fields, 'sample': sample})
+
+    def debug(self, tag, msg, *args, **kwargs):
+        self.log(logging.DEBUG, tag, msg, *args, **kwargs)
+
+    def info(self, tag, msg, *args, **kwargs):
+        self.log(logging.INFO, tag, msg, *args, **kwargs)
+
+    def warning(self, tag, msg, *args, **kwargs):
+        self.log(logging.WARNING, tag, msg, *args, **kwargs)
+
+    def error(self, tag, msg, *args, **kwargs):
+        self.log(logging.ERROR, tag, msg, *args, **kwargs)
+
+
+def get_logger(name):
+    return EventLogger(name)
+
+
+class SampleFilter(logging.Filter):
+    """Keep one in every records marked sample=True, pass everything else"""
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = every
+        self.counter = itertools.count()
+
+    def filter(self, record):
+        if not getattr(record, 'sample', False) or self.every <= 1:
+            return True
+        if next(self.counter) % self.every == 0:
+            record.sample_rate = self.every
+            return True
+        LOG_RECORDS_SAMPLED_OUT.inc()
+        return False
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+class ConsoleFormatter(logging.Formatter):
+    """Format records like the old print lines: [TAG] message"""
+
+    def format(self, record):
+        tag = getattr(record, 'tag', None) or record.levelname
+        return f"[{tag}] {record.getMessage()}"
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "tag": getattr(record, 'tag', None),
+            "msg": record.getMessage()
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        sample_rate = getattr(record, 'sample_rate', None)
+        if sample_rate:
+            entry["sample_rate"] = sample_rate
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(log_file=LOG_FILE, console=True, level=logging.INFO, sample_every=SAMPLE_EVERY, handlers=()):
+    """Route the root logger through a bounded queue to a background writer.
+
+    Extra handlers (for example a GUI log view) are written to by the
+    listener thread as well. Calling this again is a no-op.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    outputs = list(handlers)
+    if console:
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(ConsoleFormatter())
+        outputs.append(console_handler)
+    if log_file:
+        log_dir = os.path.dirname(log_file)
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8'
+        )
+        file_handler.setFormatter(JsonFormatter())
+        outputs.append(file_handler)
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(SampleFilter(sample_every))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, *outputs, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    """Flush queued records and stop the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
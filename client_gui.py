@@ -1,10 +1,23 @@
 import socket
 import threading
-import json
 import eel
+import bottle
+import io
+import itertools
 import os
+import random
+import secrets
 import struct
 import base64
+import tempfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, unquote
+
+import protocol
+import transport
 
 # Try to import PyAudio for voice calling
 try:
@@ -14,32 +27,225 @@ except ImportError:
     PYAUDIO_AVAILABLE = False
     print("[WARNING] PyAudio not available. Voice calling will be disabled.")
 
+# Try to import Pillow for image thumbnails
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
 # Configuration
 HOST = '192.168.43.231'
 PORT = 5555
 UDP_PORT = 5556
+SERVER_URL = None  # transport URL of the chat connection (tcp://, tls:// or unix://)
+TLS_CAFILE = os.environ.get('CHAT_TLS_CA')  # CA for TLS servers, default the system CAs
+tls_context = None  # Kept for the client's life, so TLS sessions can be resumed
 
 username = ""
 current_room = "lobby"
 client_socket = None
 udp_socket = None
 connected = False
-file_receiving_mode = False
-file_info = {}
+compress = False  # Server accepted protocol.COMPRESSION_FEATURE
+file_compress = False  # Server accepted protocol.FILE_COMPRESSION_FEATURE
+
+# Session resumption: the token from login_success and the number of frames
+# received since login, so a dropped connection can pick up where it left off
+session_token = None
+resume_grace = 0
+received_seq = 0
+
+# The login frame, sent again when the server turned the connection away as
+# busy, and how many times that happened for this login
+login_frame = None
+busy_retries = 0
+
+# Room message numbering: the highest seq seen in the current room, the
+# missing seqs below it ({seq: when to ask for it}) and the last ack sent
+room_seq = 0
+missing_seqs = {}
+last_acked = 0
+last_ack_time = 0.0
+
+# Upload flow control: bytes of file data the server will still accept
+# (credited back with file_credit), uploads the server turned down, and a
+# generation bumped when a reconnect drops the uploads in progress
+upload_window = 0
+upload_credit = 0
+upload_cond = threading.Condition()
+upload_generation = 0
+rejected_uploads = set()
+rejected_groups = set()
+transfer_ids = itertools.count(1)
+
+# Upload throughput measured from the server's credits (bytes/s, None until
+# measured), which picks the compression level for files
+link_rate = None
+last_credit_time = 0.0
+
+# Batch uploads: ids for our own file groups, and the progress of groups
+# being received, by (sender, group)
+group_ids = itertools.count(1)
+incoming_groups = {}
+
+# Files arriving in chunk frames (protocol.FILE_CHUNKS_FEATURE): {transfer_id: Download}
+downloads = {}
 
 # Voice calling state
 in_call = False
 call_partner = ""
 p_audio = None
 
+# Downloads are served to the UI from the local Eel HTTP server
+DOWNLOADS_DIR = 'downloads'
+THUMBNAILS_DIR = os.path.join(DOWNLOADS_DIR, '.thumbnails')
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']
+THUMBNAIL_MIN_SIZE = 256 * 1024  # Images larger than this get a thumbnail
+THUMBNAIL_MAX_DIM = (480, 480)
+FILE_CHUNK_SIZE = 64 * 1024
+PROGRESS_INTERVAL = 0.25  # Seconds between download progress events to the UI
+KEEPALIVE_IDLE = 30       # TCP keepalive: idle time before the first probe
+KEEPALIVE_INTERVAL = 10   # TCP keepalive: time between probes
+KEEPALIVE_COUNT = 3       # TCP keepalive: failed probes before the connection drops
+RECONNECT_MIN_DELAY = 0.5 # Backoff between reconnect attempts, doubling up to the max
+RECONNECT_MAX_DELAY = 8.0
+RECONNECT_TIMEOUT = 5     # Seconds to connect and get an answer to a resume
+MAX_BUSY_RETRIES = 5      # Logins tried again after the server answered server_busy
+ACK_INTERVAL = 1.0        # Seconds between room acks (and resend requests)
+GAP_WAIT = 0.5            # Seconds a missing room message may be late before it is re-requested
+MAX_GAP = 100             # Missing room messages tracked at most
+SEND_COALESCE_BYTES = 64 * 1024  # Frames queued together are sent in one call up to this size
+LOGOUT_FLUSH_TIMEOUT = 1.0       # Seconds disconnect waits for the logout to be written
+CREDIT_WAIT = 1.0         # Seconds between connection checks while an upload waits for credit
+UPLOAD_PARALLEL = 4       # Files of a batch upload in flight at once
+
+# File compression: files that are already compressed are sent as they are,
+# recognised by extension or by their first bytes
+FILE_COMPRESS_MIN_SIZE = 4096
+COMPRESSED_EXTENSIONS = {
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst', '.lz4', '.br',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp3', '.aac', '.ogg', '.opus', '.flac', '.m4a', '.mp4', '.mkv', '.mov', '.webm', '.avi',
+    '.pdf', '.docx', '.xlsx', '.pptx', '.odt', '.jar', '.apk', '.epub', '.woff', '.woff2'
+}
+COMPRESSED_MAGIC = (
+    b'PK\x03\x04', b'\x1f\x8b', b'BZh', b'\xfd7zXZ\x00', b'7z\xbc\xaf\x27\x1c', b'Rar!', b'\x28\xb5\x2f\xfd',
+    b'\xff\xd8\xff', b'\x89PNG', b'GIF8', b'RIFF', b'OggS', b'fLaC', b'ID3', b'%PDF', b'\x1a\x45\xdf\xa3'
+)
+# Compression level by measured upload throughput (bytes/s): the faster the
+# link, the cheaper the level, so compressing never becomes the bottleneck
+FILE_COMPRESS_LEVELS = ((100e6, None), (25e6, 1), (5e6, 3), (1e6, 6))
+FILE_COMPRESS_SLOW_LEVEL = 9
+FILE_COMPRESS_DEFAULT_LEVEL = 6  # Until the throughput is measured
+CREDIT_SAMPLE_MAX = 1.0   # Credits further apart than this (idle link) are not measured
+
+# Token the UI must present to the local upload route
+UPLOAD_TOKEN = secrets.token_urlsafe(16)
+
+# Next duplicate suffix to try per download name
+download_suffixes = {}
+
 # Create downloads folder
-if not os.path.exists('downloads'):
-    os.makedirs('downloads')
+if not os.path.exists(THUMBNAILS_DIR):
+    os.makedirs(THUMBNAILS_DIR)
 
 # Initialize Eel with web folder
 eel.init('web')
 
 
+class SendQueue:
+    """Everything sent to the server, written in order by one writer thread.
+
+    UI calls only queue and return, and the receive thread never writes to
+    the socket itself. Frames queued together go out in one sendall. An item
+    may carry a callback, called from the writer thread with None once the
+    item is written or with the error if writing failed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.items = deque()  # (bytes or function writing to the socket, callback)
+        self.writer = None
+
+    def put(self, data, callback=None):
+        """Queue bytes, or a function that writes to the socket itself (file data)"""
+        with self.lock:
+            self.items.append((data, callback))
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._run, daemon=True)
+                self.writer.start()
+            else:
+                self.cond.notify()
+
+    def flush(self, timeout):
+        """Wait until everything queued so far is written or failed, False on timeout"""
+        done = threading.Event()
+        self.put(b"", lambda error: done.set())
+        return done.wait(timeout)
+
+    def _next_batch(self):
+        # Called with the lock held
+        data, callback = self.items.popleft()
+        if callable(data):
+            return data, [callback]
+        
+        batch, callbacks, total = [data], [callback], len(data)
+        while self.items and total < SEND_COALESCE_BYTES and not callable(self.items[0][0]):
+            data, callback = self.items.popleft()
+            batch.append(data)
+            callbacks.append(callback)
+            total += len(data)
+        return b"".join(batch), callbacks
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.items:
+                    self.cond.wait()
+                data, callbacks = self._next_batch()
+            
+            error = None
+            try:
+                sock = client_socket
+                if sock is None:
+                    raise ConnectionError("Not connected to server")
+                if callable(data):
+                    data(sock)
+                elif data:
+                    sock.sendall(data)
+            except Exception as e:
+                error = e
+            
+            for callback in callbacks:
+                if callback is None:
+                    continue
+                try:
+                    callback(error)
+                except Exception as e:
+                    print(f"[ERROR] Send callback failed: {e}")
+
+
+send_queue = SendQueue()
+
+
+class ServerBusy(Exception):
+    """The server turned the connection away; try again after retry_after seconds"""
+
+    def __init__(self, message):
+        super().__init__(message.get("payload") or "Server busy")
+        self.retry_after = message.get("retry_after") or 1
+
+
+def queue_message(msg_dict, action):
+    """Queue a message for the server, reporting a failure to the UI"""
+    def done(error):
+        if error is not None:
+            eel.display_error(f"Failed to {action}: {error}")
+    send_queue.put(encode_frame(msg_dict), done)
+
+
 def audio_send_thread():
     """Thread to capture and send audio via UDP"""
     global in_call, udp_socket, p_audio, username
@@ -172,109 +378,456 @@ def stop_voice_call():
     time.sleep(0.2)
 
 
+def enable_keepalive(sock):
+    """Turn on TCP keepalive with our probe timing where the platform allows it"""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_COUNT)
+    elif hasattr(socket, 'SIO_KEEPALIVE_VALS'):
+        # Windows takes milliseconds
+        sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, KEEPALIVE_IDLE * 1000, KEEPALIVE_INTERVAL * 1000))
+
+
+def recv_exact(count, buffer, view):
+    """Take count bytes from leftover buffer, reading more from the socket as needed"""
+    while len(buffer) < count:
+        nbytes = client_socket.recv_into(view)
+        if not nbytes:
+            raise ConnectionError("Connection lost during file transfer")
+        buffer += view[:nbytes]
+    
+    data = bytes(buffer[:count])
+    del buffer[:count]
+    return data
+
+
+def publish_download(temp_path, filename):
+    """Move a finished download into place under a free name without overwriting"""
+    safe_filename = os.path.basename(filename) or 'unknown_file'
+    base_name, ext = os.path.splitext(safe_filename)
+    counter = download_suffixes.get(safe_filename, 0)
+    
+    while True:
+        name = safe_filename if counter == 0 else f"{base_name}_{counter}{ext}"
+        filepath = os.path.join(DOWNLOADS_DIR, name)
+        try:
+            # Claim the name atomically, then replace the placeholder
+            os.close(os.open(filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            counter += 1
+            continue
+        
+        os.replace(temp_path, filepath)
+        download_suffixes[safe_filename] = counter + 1
+        return filepath
+
+
+class Download:
+    """An incoming file streamed to a temp file in downloads, moved into place once complete"""
+
+    def __init__(self, file_header, size):
+        self.filename = file_header.get('filename') or 'unknown_file'
+        self.sender = file_header.get('sender') or 'Unknown'
+        
+        # size is what arrives; for a compressed file that is the compressed
+        # size and filesize in the header the size of the file
+        self.size = size
+        self.received = 0
+        self.inflater = None
+        self.filesize = size
+        if file_header.get('encoding') == protocol.FILE_ENCODING:
+            self.inflater = zlib.decompressobj(-15)
+            self.filesize = file_header.get('filesize') or 0
+        self.written = 0
+        
+        # Files of a group count towards the group's progress
+        progress = incoming_groups.get((self.sender, file_header.get('group')))
+        if progress is None:
+            progress = {
+                "id": f"{self.sender}/{self.filename}/{time.monotonic()}",
+                "sender": self.sender,
+                "filename": self.filename,
+                "received": 0,
+                "total": self.filesize,
+                "done": False
+            }
+        self.progress = progress
+        self.base = progress["received"]
+        self.last_progress = time.monotonic()
+        
+        fd, self.temp_path = tempfile.mkstemp(dir=DOWNLOADS_DIR, prefix='.', suffix='.part')
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        """Store the next part of the file, at most what is still missing"""
+        data = data[:self.size - self.received]
+        self.received += len(data)
+        if self.inflater is not None:
+            # One byte past the announced size is enough to tell it is too long
+            data = self.inflater.decompress(data, self.filesize - self.written + 1)
+            if self.inflater.unconsumed_tail or self.written + len(data) > self.filesize:
+                raise ValueError("File is larger than announced")
+        self.file.write(data)
+        self.written += len(data)
+        
+        now = time.monotonic()
+        if now - self.last_progress >= PROGRESS_INTERVAL:
+            self.last_progress = now
+            self.progress["received"] = self.base + self.written
+            eel.display_file_progress(self.progress)
+
+    def complete(self):
+        return self.received >= self.size
+
+    def finish(self):
+        """Move the complete file into place and show it"""
+        self.file.close()
+        if self.written != self.filesize:
+            raise ValueError("File is smaller than announced")
+        filepath = publish_download(self.temp_path, self.filename)
+        
+        self.progress["received"] = self.base + self.filesize
+        if "group" not in self.progress:
+            self.progress["done"] = True
+        eel.display_file_progress(self.progress)
+        
+        # Previews are rendered off the receive thread
+        threading.Thread(
+            target=display_received_file,
+            args=(self.sender, self.filename, filepath, self.filesize),
+            daemon=True
+        ).start()
+
+    def abort(self, error):
+        self.file.close()
+        try:
+            os.unlink(self.temp_path)
+        except OSError:
+            pass
+        # Take the progress bar down; the rest of a group shows on its own
+        if "group" in self.progress:
+            incoming_groups.pop((self.sender, self.progress["group"]), None)
+        end_progress(self.progress)
+        eel.display_error(f"File transfer failed ({self.filename}): {error}")
+
+
+def end_progress(progress):
+    """Remove the progress of a transfer that will not complete"""
+    progress["done"] = True
+    eel.display_file_progress(progress)
+
+
+def receive_file(file_header, buffer, view):
+    """Receive a file whose data follows its header directly, partly in buffer already"""
+    # Read file size header (4 bytes)
+    expected_size = struct.unpack('>I', recv_exact(4, buffer, view))[0]
+    download = Download(file_header, expected_size)
+    try:
+        # Part of the file may already be buffered behind the header
+        received = min(len(buffer), expected_size)
+        if received:
+            download.write(buffer[:received])
+            del buffer[:received]
+        
+        while not download.complete():
+            nbytes = client_socket.recv_into(view, min(len(view), expected_size - download.received))
+            if not nbytes:
+                raise ConnectionError("Connection lost during file transfer")
+            download.write(view[:nbytes])
+        download.finish()
+    except Exception as e:
+        download.abort(e)
+        raise
+
+
+def start_download(file_header):
+    """Start a file whose data arrives in chunk frames"""
+    try:
+        download = Download(file_header, file_header.get('length') or 0)
+    except OSError as e:
+        eel.display_error(f"File transfer failed: {e}")
+        return
+    downloads[file_header.get('transfer_id')] = download
+    if download.complete():
+        end_download(file_header.get('transfer_id'))
+
+
+def receive_download_chunk(transfer_id, data):
+    """Store a chunk frame of a download, finishing it with its last chunk"""
+    download = downloads.get(transfer_id)
+    if download is None:
+        return
+    try:
+        download.write(data)
+    except Exception as e:
+        del downloads[transfer_id]
+        download.abort(e)
+        return
+    if download.complete():
+        end_download(transfer_id)
+
+
+def end_download(transfer_id):
+    download = downloads.pop(transfer_id)
+    try:
+        download.finish()
+    except Exception as e:
+        download.abort(e)
+
+
+def abort_downloads(reason):
+    """Drop the downloads in progress, whose remaining chunks will not come"""
+    for transfer_id in list(downloads):
+        downloads.pop(transfer_id).abort(reason)
+    # Groups between two files; files still to come show on their own
+    for key in list(incoming_groups):
+        end_progress(incoming_groups.pop(key))
+
+
+def encode_frame(message_dict):
+    """Encode a message for the server, compressed when negotiated and worthwhile"""
+    frame = protocol.encode(message_dict)
+    return protocol.compress_frame(frame) if compress else frame
+
+
+def open_connection(timeout):
+    """Connect to SERVER_URL over its transport, resuming the TLS session if there is one"""
+    global tls_context
+    ssl_context = None
+    if transport.parse_url(SERVER_URL)[0] == transport.TLS:
+        if tls_context is None:
+            tls_context = transport.client_context(TLS_CAFILE)
+        ssl_context = tls_context
+    
+    sock = transport.connect(SERVER_URL, timeout, ssl_context)
+    if transport.is_tcp(sock):
+        enable_keepalive(sock)
+    return sock
+
+
+def try_resume():
+    """Open a new connection and resume the session, return (socket, leftover bytes) or None"""
+    sock = open_connection(RECONNECT_TIMEOUT)
+    try:
+        resume_msg = {"type": "resume", "payload": session_token, "last_seq": received_seq}
+        sock.sendall(protocol.encode(resume_msg))
+        
+        buffer = bytearray()
+        while (line := protocol.pop_frame(buffer)) is None:
+            data = sock.recv(FILE_CHUNK_SIZE)
+            if not data:
+                raise ConnectionError("Connection closed during resume")
+            buffer += data
+        
+        message = protocol.decode(line, validate=False)
+        if message.get("code") == "server_busy":
+            raise ServerBusy(message)
+        if message.get("type") != "resume_success":
+            sock.close()
+            return None
+        transport.remember_session(sock, SERVER_URL)
+        sock.settimeout(None)
+        return sock, buffer
+    except BaseException:
+        sock.close()
+        raise
+
+
+def reset_upload_credit(window):
+    """Start over with a full upload window, failing the uploads in progress"""
+    global upload_window, upload_credit, upload_generation
+    with upload_cond:
+        upload_window = upload_credit = window
+        upload_generation += 1
+        rejected_uploads.clear()
+        rejected_groups.clear()
+        upload_cond.notify_all()
+
+
+def reconnect():
+    """Resume the session after the connection dropped, return leftover bytes or None on failure"""
+    global client_socket
+    eel.display_message({"type": "notification", "text": "Connection lost, reconnecting..."})
+    abort_downloads("connection lost")
+    
+    deadline = time.monotonic() + resume_grace
+    delay = RECONNECT_MIN_DELAY
+    while connected and time.monotonic() < deadline:
+        try:
+            result = try_resume()
+        except ServerBusy as e:
+            # Come back when the server said, spread out a little more
+            time.sleep(e.retry_after * random.uniform(1.0, 1.5))
+            continue
+        except (OSError, protocol.ProtocolError):
+            # Server unreachable for now; back off with jitter so many
+            # clients do not reconnect in lockstep
+            time.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            continue
+        
+        if result is None:
+            return None  # Session expired on the server
+        
+        old_socket = client_socket
+        client_socket, buffer = result
+        try:
+            old_socket.close()
+        except OSError:
+            pass
+        # The server forgot the uploads in progress along with their credit
+        reset_upload_credit(upload_window)
+        eel.display_message({"type": "notification", "text": "Reconnected"})
+        return buffer
+    return None
+
+
+def retry_login(retry_after):
+    """Log in again on a new connection after the server turned the login away as busy, False if not"""
+    global client_socket, busy_retries
+    if busy_retries >= MAX_BUSY_RETRIES:
+        return False
+    busy_retries += 1
+    eel.display_message({"type": "notification", "text": f"Server busy, trying again in {retry_after:g} seconds..."})
+    time.sleep(retry_after * random.uniform(1.0, 1.5))
+    if not connected:
+        return False
+    try:
+        sock = open_connection(10)
+    except OSError:
+        return False
+    sock.settimeout(None)
+    old_socket, client_socket = client_socket, sock
+    try:
+        old_socket.close()
+    except OSError:
+        pass
+    send_queue.put(login_frame)
+    return True
+
+
+def reset_room_seq(seq):
+    """Start counting room messages from seq, after joining a room"""
+    global room_seq, last_acked
+    room_seq = last_acked = seq
+    missing_seqs.clear()
+
+
+def track_room_seq(message):
+    """Note the seq of a room message, return False if it is a duplicate"""
+    global room_seq
+    seq = message.get("seq")
+    if seq is None or message.get("room") != current_room:
+        return True
+    
+    if seq <= room_seq:
+        # Either a late or re-requested message we were missing, or one we
+        # already have (resent after a reconnect)
+        return missing_seqs.pop(seq, None) is not None
+    
+    ask_at = time.monotonic() + GAP_WAIT
+    for missing in range(max(room_seq + 1, seq - MAX_GAP), seq):
+        missing_seqs[missing] = ask_at
+    room_seq = seq
+    return True
+
+
+def send_room_acks():
+    """Acknowledge room messages and re-request missing ones, at most every ACK_INTERVAL"""
+    global last_acked, last_ack_time
+    now = time.monotonic()
+    if now - last_ack_time < ACK_INTERVAL:
+        return
+    last_ack_time = now
+    
+    frames = []
+    acked = min(missing_seqs) - 1 if missing_seqs else room_seq
+    if acked != last_acked:
+        frames.append(protocol.encode({"type": "ack", "room": current_room, "payload": acked}))
+        last_acked = acked
+    
+    overdue = sorted(seq for seq, ask_at in missing_seqs.items() if ask_at <= now)
+    if overdue:
+        frames.append(protocol.encode({"type": "resend", "room": current_room, "payload": overdue}))
+        for seq in overdue:
+            missing_seqs[seq] = now + GAP_WAIT + ACK_INTERVAL
+    
+    if frames:
+        send_queue.put(b"".join(frames))
+
+
 def receive_messages():
     """Thread function to receive messages from server"""
-    global connected, current_room, file_receiving_mode, file_info, call_partner
-    buffer = ""
+    global connected, current_room, call_partner, compress, session_token, resume_grace, received_seq
+    global upload_credit, file_compress, link_rate, last_credit_time
+    buffer = bytearray()
+    view = memoryview(bytearray(FILE_CHUNK_SIZE))
     
     while connected:
         try:
-            # Check if we're in file receiving mode
-            if file_receiving_mode:
-                # Read file size header (4 bytes)
-                size_data = client_socket.recv(4)
-                if len(size_data) != 4:
-                    eel.display_error("Invalid file size header")
-                    file_receiving_mode = False
-                    continue
-                
-                expected_size = struct.unpack('>I', size_data)[0]
-                filename = file_info.get('filename', 'unknown_file')
-                sender = file_info.get('sender', 'Unknown')
-                
-                # Receive raw binary data
-                filedata = b''
-                remaining = expected_size
-                
-                while remaining > 0:
-                    chunk_size = min(4096, remaining)
-                    chunk = client_socket.recv(chunk_size)
-                    
-                    if not chunk:
-                        eel.display_error("Connection lost during file transfer")
-                        break
-                    
-                    filedata += chunk
-                    remaining -= len(chunk)
-                
-                # Save file to downloads folder
-                if len(filedata) == expected_size:
-                    safe_filename = os.path.basename(filename)
-                    filepath = os.path.join('downloads', safe_filename)
-                    
-                    # Handle duplicate filenames
-                    counter = 1
-                    base_name, ext = os.path.splitext(safe_filename)
-                    while os.path.exists(filepath):
-                        filepath = os.path.join('downloads', f"{base_name}_{counter}{ext}")
-                        counter += 1
-                    
-                    with open(filepath, 'wb') as f:
-                        f.write(filedata)
-                    
-                    # Convert to base64 for web display if it's an image
-                    file_ext = ext.lower()
-                    is_image = file_ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']
-                    
-                    file_url = None
-                    if is_image:
-                        file_url = f"data:image/{file_ext[1:]};base64,{base64.b64encode(filedata).decode('utf-8')}"
-                    
-                    # Display file received message
-                    eel.display_file({
-                        "type": "received",
-                        "sender": sender,
-                        "filename": filename,
-                        "filepath": filepath,
-                        "filesize": expected_size,
-                        "is_image": is_image,
-                        "file_url": file_url
-                    })
-                else:
-                    eel.display_error(f"File transfer incomplete ({len(filedata)}/{expected_size} bytes)")
-                
-                file_receiving_mode = False
-                file_info = {}
-                continue
+            nbytes = client_socket.recv_into(view)
+            if not nbytes:
+                raise ConnectionError("Connection to server lost")
             
-            data = client_socket.recv(1024).decode('utf-8')
-            if not data:
-                eel.display_error("Connection to server lost")
-                connected = False
-                break
-            
-            buffer += data
+            buffer += view[:nbytes]
             
-            # Process complete JSON messages (separated by newlines)
-            while "\n" in buffer:
-                line, buffer = buffer.split("\n", 1)
+            # Process complete frames: JSON (newline-terminated or
+            # compressed) and download chunks
+            while True:
+                if buffer and buffer[0] == protocol.FILE_CHUNK_MARKER:
+                    chunk = protocol.pop_file_chunk(buffer)
+                    if chunk is None:
+                        break
+                    receive_download_chunk(*chunk)
+                    continue
+                line = protocol.pop_frame(buffer)
+                if line is None:
+                    break
                 line = line.strip()
                 
                 if not line:
                     continue
                 
                 try:
-                    message = json.loads(line)
+                    message = protocol.decode(line, validate=False)
                     msg_type = message.get("type")
                     payload = message.get("payload")
+                    received_seq += 1
+                    
+                    if not track_room_seq(message):
+                        continue
                     
-                    if msg_type == "login_success":
+                    if msg_type == "ping":
+                        # Server heartbeat, answer so the session is not reaped
+                        pong_msg = {"type": "pong", "payload": payload}
+                        send_queue.put(protocol.encode(pong_msg))
+                    
+                    elif msg_type == "login_success":
+                        compress = protocol.COMPRESSION_FEATURE in (message.get("features") or ())
+                        file_compress = protocol.FILE_COMPRESSION_FEATURE in (message.get("features") or ())
+                        transport.remember_session(client_socket, SERVER_URL)
+                        session_token = message.get("token")
+                        resume_grace = message.get("resume_grace", 0)
+                        reset_upload_credit(message.get("upload_window", 0))
                         eel.display_message({
                             "type": "notification",
                             "text": payload
                         })
                         
                     elif msg_type == "error":
+                        if message.get("code") == "server_busy":
+                            raise ServerBusy(message)
+                        transfer_id = message.get("transfer_id")
+                        group = message.get("group")
+                        if transfer_id is not None or group is not None:
+                            with upload_cond:
+                                if transfer_id is not None:
+                                    rejected_uploads.add(transfer_id)
+                                if group is not None:
+                                    rejected_groups.add(group)
+                                upload_cond.notify_all()
                         eel.display_error(payload)
                         
                     elif msg_type == "notification":
@@ -301,17 +854,41 @@ def receive_messages():
                     
                     elif msg_type == "private_sent":
                         target = message.get("target", "Unknown")
+                        queued = " (offline, will be delivered)" if message.get("queued") else ""
                         eel.display_message({
                             "type": "private",
-                            "sender": f"You → {target}",
+                            "sender": f"You → {target}{queued}",
                             "text": payload
                         })
                     
+                    elif msg_type == "inbox":
+                        # Private messages sent while we were offline, oldest first
+                        for item in payload:
+                            sent_at = time.strftime("%d %b %H:%M", time.localtime(item["ts"]))
+                            eel.display_message({
+                                "type": "private",
+                                "sender": f"{item['sender']} (offline, {sent_at})",
+                                "text": item["payload"]
+                            })
+                        if payload:
+                            ack_msg = {"type": "inbox_ack", "payload": payload[-1]["id"]}
+                            send_queue.put(protocol.encode(ack_msg))
+                    
                     elif msg_type == "room_info":
                         room_data = payload
                         current_room = room_data['room']
+                        reset_room_seq(room_data.get('seq', 0))
                         eel.update_room_info(room_data)
                     
+                    elif msg_type == "room_seq":
+                        # Our own room message was numbered, nothing to show
+                        pass
+                    
+                    elif msg_type == "resend_unavailable":
+                        # Too old to be resent, stop waiting for them
+                        for seq in payload:
+                            missing_seqs.pop(seq, None)
+                    
                     elif msg_type == "room_list":
                         print(f"[DEBUG] Received room_list: {payload}")
                         eel.update_rooms_list(payload)
@@ -325,25 +902,70 @@ def receive_messages():
                             print(f"[ERROR] Failed to call eel.update_users_list: {e}")
                     
                     elif msg_type == "file_incoming":
-                        file_receiving_mode = True
-                        file_info = {
-                            'filename': message.get('filename'),
-                            'filesize': message.get('filesize'),
-                            'sender': message.get('sender')
-                        }
-                        # File will be received in next iteration
-                        continue
+                        if message.get("transfer_id") is not None:
+                            # The data follows in chunk frames
+                            start_download(message)
+                        else:
+                            # Binary body follows the header, partly in buffer already
+                            receive_file(message, buffer, view)
+                    
+                    elif msg_type == "file_credit":
+                        # The server consumed this much upload data; how fast
+                        # it does is the upload throughput
+                        now = time.monotonic()
+                        if now - last_credit_time < CREDIT_SAMPLE_MAX:
+                            sample = payload / max(now - last_credit_time, 1e-3)
+                            link_rate = sample if link_rate is None else 0.8 * link_rate + 0.2 * sample
+                        last_credit_time = now
+                        with upload_cond:
+                            upload_credit = min(upload_credit + payload, upload_window)
+                            upload_cond.notify_all()
                     
                     elif msg_type == "file_transfer_ready":
-                        # Server is ready to receive file
+                        # Data is already flowing on the credit we were given
                         pass
                     
                     elif msg_type == "file_sent_confirm":
+                        # Files of a batch are summed up when it completes
+                        if message.get("group") is None:
+                            eel.display_message({
+                                "type": "notification",
+                                "text": payload
+                            })
+                    
+                    elif msg_type == "file_group":
+                        # A batch of files follows, shown as one transfer
+                        sender = message.get("sender", "Unknown")
+                        count = message.get("count", 0)
+                        incoming_groups[(sender, message.get("group"))] = {
+                            "id": f"{sender}/group/{message.get('group')}/{time.monotonic()}",
+                            "sender": sender,
+                            "filename": f"{count} files",
+                            "group": message.get("group"),
+                            "received": 0,
+                            "total": message.get("filesize", 0),
+                            "done": False
+                        }
                         eel.display_message({
                             "type": "notification",
-                            "text": payload
+                            "text": f"{sender} is sending {count} files"
                         })
                     
+                    elif msg_type == "file_group_complete":
+                        sender = message.get("sender")
+                        if sender is None:
+                            # Our own batch
+                            eel.display_message({"type": "notification", "text": payload})
+                        else:
+                            progress = incoming_groups.pop((sender, message.get("group")), None)
+                            if progress is not None:
+                                progress["done"] = True
+                                eel.display_file_progress(progress)
+                            eel.display_message({
+                                "type": "notification",
+                                "text": f"{sender} sent {message.get('count', 0)} files"
+                            })
+                    
                     elif msg_type == "call_incoming":
                         # Incoming call notification
                         caller = payload
@@ -380,32 +1002,138 @@ def receive_messages():
                         stop_voice_call()
                         call_partner = ""
                         
-                except json.JSONDecodeError:
+                except protocol.ProtocolError:
                     print(f"[ERROR] Invalid JSON from server")
                     continue
+            
+            send_room_acks()
                     
         except Exception as e:
-            if connected:
-                print(f"[ERROR] {e}")
-                eel.display_error(f"Connection error: {str(e)}")
-                connected = False
+            if not connected:
+                break
+            
+            # Turned away before logging in: log in again when the server said
+            if isinstance(e, ServerBusy) and not session_token:
+                if retry_login(e.retry_after):
+                    buffer = bytearray()
+                    continue
+            
+            # Dropped connection: try to resume before giving up
+            if session_token and isinstance(e, OSError):
+                leftover = reconnect()
+                if leftover is not None:
+                    buffer = leftover
+                    continue
+            
+            print(f"[ERROR] {e}")
+            eel.display_error(f"Connection error: {str(e)}")
+            abort_downloads("connection lost")
+            connected = False
             break
 
 
+def make_thumbnail(filepath):
+    """Create a downscaled copy of a large image, return its file name or None"""
+    if not PIL_AVAILABLE:
+        return None
+    
+    thumb_name = os.path.basename(filepath) + '.thumb.png'
+    try:
+        with Image.open(filepath) as img:
+            img.thumbnail(THUMBNAIL_MAX_DIM)
+            img.save(os.path.join(THUMBNAILS_DIR, thumb_name), 'PNG')
+        return thumb_name
+    except Exception as e:
+        print(f"[WARNING] Thumbnail failed for {filepath}: {e}")
+        return None
+
+
+def display_received_file(sender, filename, filepath, filesize):
+    """Show a received file in the UI, linking images through the local HTTP routes"""
+    saved_name = os.path.basename(filepath)
+    is_image = os.path.splitext(saved_name)[1].lower() in IMAGE_EXTENSIONS
+    
+    file_url = None
+    thumbnail_url = None
+    if is_image:
+        file_url = f"/downloads/{quote(saved_name)}"
+        if filesize >= THUMBNAIL_MIN_SIZE:
+            thumb_name = make_thumbnail(filepath)
+            if thumb_name:
+                thumbnail_url = f"/thumbnails/{quote(thumb_name)}"
+    
+    eel.display_file({
+        "type": "received",
+        "sender": sender,
+        "filename": filename,
+        "filepath": filepath,
+        "filesize": filesize,
+        "is_image": is_image,
+        "file_url": file_url,
+        "thumbnail_url": thumbnail_url
+    })
+
+
+@bottle.route('/downloads/<filename>')
+def serve_download(filename):
+    """Serve a received file to the UI"""
+    return bottle.static_file(filename, root=DOWNLOADS_DIR)
+
+
+@bottle.route('/thumbnails/<filename>')
+def serve_thumbnail(filename):
+    """Serve an image thumbnail to the UI"""
+    return bottle.static_file(filename, root=THUMBNAILS_DIR)
+
+
+@bottle.post('/upload')
+def upload_file():
+    """Stream a file posted by the UI straight to the server"""
+    request = bottle.request
+    if request.get_header('X-Upload-Token') != UPLOAD_TOKEN:
+        bottle.response.status = 403
+        return {"success": False, "message": "Invalid upload token"}
+    
+    filename = os.path.basename(unquote(request.get_header('X-Filename', '')))
+    target_user = unquote(request.get_header('X-Target', '')) or None
+    group = request.get_header('X-Group') or None
+    filesize = request.content_length
+    
+    if not filename or filesize <= 0:
+        bottle.response.status = 400
+        return {"success": False, "message": "Invalid upload"}
+    
+    return send_file_stream(request.environ['wsgi.input'], filename, filesize, target_user, group)
+
+
+@eel.expose
+def get_transfer_info():
+    """Get the local upload route and its token"""
+    return {
+        "upload_url": "/upload",
+        "token": UPLOAD_TOKEN,
+        "parallel": UPLOAD_PARALLEL
+    }
+
+
 @eel.expose
-def connect_to_server(user, host, port):
-    """Connect to the chat server"""
-    global username, client_socket, udp_socket, connected, HOST, PORT
+def connect_to_server(user, host, port, transport_name=transport.TCP):
+    """Connect to the chat server over TCP, TLS or a Unix socket (host is then the socket path)"""
+    global username, client_socket, udp_socket, connected, compress, session_token, received_seq, HOST, PORT
+    global SERVER_URL, login_frame, busy_retries
     
     try:
-        # Store host and port for UDP
-        HOST = host
+        # Store host and port for UDP; a Unix socket server is on this host
+        if transport_name == transport.UNIX:
+            SERVER_URL = transport.format_url(transport.UNIX, host)
+            HOST = '127.0.0.1'
+        else:
+            SERVER_URL = transport.format_url(transport_name, (host, port))
+            HOST = host
         PORT = port
         
-        # Create TCP socket and connect to server
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.settimeout(10)
-        client_socket.connect((host, port))
+        # Connect to server
+        client_socket = open_connection(10)
         client_socket.settimeout(None)
         
         # Create UDP socket for voice
@@ -414,14 +1142,19 @@ def connect_to_server(user, host, port):
         
         username = user
         connected = True
+        compress = False
+        session_token = None
+        received_seq = 0
         
-        # Send login message
+        # Send login message, offering compression
         login_msg = {
             "type": "login",
-            "payload": username
+            "payload": username,
+            "features": [protocol.COMPRESSION_FEATURE, protocol.FILE_COMPRESSION_FEATURE, protocol.FILE_CHUNKS_FEATURE]
         }
-        json_message = json.dumps(login_msg) + "\n"
-        client_socket.send(json_message.encode('utf-8'))
+        login_frame = protocol.encode(login_msg)
+        busy_retries = 0
+        send_queue.put(login_frame)
         
         # Start receive thread
         receive_thread = threading.Thread(target=receive_messages, daemon=True)
@@ -512,8 +1245,7 @@ def send_message(message):
                 "text": message
             })
         
-        json_message = json.dumps(msg_dict) + "\n"
-        client_socket.send(json_message.encode('utf-8'))
+        queue_message(msg_dict, "send message")
         return True
         
     except Exception as e:
@@ -542,97 +1274,207 @@ def get_user_info():
     }
 
 
-@eel.expose
-def send_file(filepath, target_user=None):
-    """Send a file to room or specific user (for CLI compatibility)"""
+def wait_upload_credit(transfer_id, group, generation, nbytes):
+    """Block until nbytes of upload credit are available and take them, False if the upload is off"""
+    global upload_credit
+    with upload_cond:
+        while True:
+            if not connected or generation != upload_generation or transfer_id in rejected_uploads:
+                return False
+            if group is not None and group in rejected_groups:
+                return False
+            if upload_credit >= nbytes:
+                upload_credit -= nbytes
+                return True
+            upload_cond.wait(CREDIT_WAIT)
+
+
+def file_compress_level(filename, head):
+    """zlib level to send a file with, or None to send it as it is"""
+    if not file_compress or len(head) < FILE_COMPRESS_MIN_SIZE:
+        return None
+    if os.path.splitext(filename)[1].lower() in COMPRESSED_EXTENSIONS or head.startswith(COMPRESSED_MAGIC):
+        return None
+    
+    rate = link_rate
+    if rate is None:
+        return FILE_COMPRESS_DEFAULT_LEVEL
+    for min_rate, level in FILE_COMPRESS_LEVELS:
+        if rate >= min_rate:
+            return level
+    return FILE_COMPRESS_SLOW_LEVEL
+
+
+def read_file_data(stream, head, remaining, chunk_size, compressor):
+    """Yield the data to upload: the file read in chunks after head, compressed if a compressor is given"""
+    chunk = head
+    while True:
+        yield compressor.compress(chunk) if compressor else chunk
+        if not remaining:
+            break
+        chunk = stream.read(min(chunk_size, remaining))
+        if not chunk:
+            raise IOError("File ended early")
+        remaining -= len(chunk)
+    if compressor:
+        yield compressor.flush()
+
+
+def send_file_stream(stream, filename, filesize, target_user=None, group=None):
+    """Send a file read from a binary stream to room or specific user, optionally as part of a file group"""
     global client_socket, connected
     
     if not connected or not client_socket:
         return {"success": False, "message": "Not connected to server"}
     
+    transfer_id = next(transfer_ids)
+    with upload_cond:
+        generation = upload_generation
+        chunk_size = min(FILE_CHUNK_SIZE, upload_window)
+    
+    # Send file transfer header; the data follows right behind it as chunk
+    # frames, as far as the server's credit goes, so there is no round trip
+    # per file
+    file_header = {
+        "type": "file_transfer",
+        "filename": filename,
+        "filesize": filesize,
+        "target": target_user,
+        "transfer_id": transfer_id,
+        "group": group
+    }
+    
+    # The stream (e.g. the upload request body) is only valid during this
+    # call, so chunks are read here and wait for the writer to finish
+    done = threading.Event()
+    errors = []
+    
+    def finished(error):
+        errors.append(error)
+        done.set()
+    
+    def send_chunk(chunk, callback=None):
+        if not wait_upload_credit(transfer_id, group, generation, len(chunk)):
+            raise ConnectionError("Transfer cancelled")
+        send_queue.put(protocol.encode_file_chunk(transfer_id, chunk), callback)
+    
     try:
-        if not os.path.exists(filepath):
-            return {"success": False, "message": "File not found"}
-        
-        if not os.path.isfile(filepath):
-            return {"success": False, "message": "Not a file"}
-        
-        # Read file in binary mode
-        with open(filepath, 'rb') as f:
-            filedata = f.read()
-        
-        filename = os.path.basename(filepath)
-        filesize = len(filedata)
-        
-        # Send file transfer header
-        file_header = {
-            "type": "file_transfer",
-            "filename": filename,
-            "filesize": filesize,
-            "target": target_user
-        }
-        header_json = json.dumps(file_header) + "\n"
-        client_socket.send(header_json.encode('utf-8'))
-        
-        # Brief pause for server to process header
-        import time
-        time.sleep(0.1)
-        
-        # Send file size as 4-byte integer
-        client_socket.send(struct.pack('>I', filesize))
-        
-        # Send raw binary data in chunks
-        chunk_size = 4096
-        for i in range(0, filesize, chunk_size):
-            chunk = filedata[i:i + chunk_size]
-            client_socket.send(chunk)
-        
-        return {"success": True, "message": f"File '{filename}' sent successfully"}
+        if filesize == 0:
+            send_queue.put(encode_frame(file_header), finished)
+        else:
+            # The first chunk decides whether the file is worth compressing
+            head = stream.read(min(chunk_size, filesize))
+            if not head:
+                raise IOError("File ended early")
+            level = file_compress_level(filename, head)
+            compressor = None
+            if level is not None:
+                file_header["encoding"] = protocol.FILE_ENCODING
+                compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            send_queue.put(encode_frame(file_header))
+            
+            # Compressed output comes in uneven pieces, so the last chunk is
+            # only known at the end; it is the one reporting completion
+            pending = None
+            for data in read_file_data(stream, head, filesize - len(head), chunk_size, compressor):
+                for offset in range(0, len(data), chunk_size):
+                    if pending is not None:
+                        send_chunk(pending)
+                    pending = data[offset:offset + chunk_size]
+            send_chunk(pending, finished)
         
+        done.wait()
+        if errors[0] is not None:
+            raise errors[0]
     except Exception as e:
         return {"success": False, "message": f"Failed to send file: {str(e)}"}
+    finally:
+        with upload_cond:
+            rejected_uploads.discard(transfer_id)
+    
+    return {"success": True, "message": f"File '{filename}' sent successfully"}
 
 
 @eel.expose
-def send_file_data(filename, base64_data, target_user=None):
-    """Send file data from browser (base64 encoded)"""
-    global client_socket, connected
+def send_file(filepath, target_user=None):
+    """Send a file to room or specific user (for CLI compatibility)"""
+    if not os.path.exists(filepath):
+        return {"success": False, "message": "File not found"}
+    
+    if not os.path.isfile(filepath):
+        return {"success": False, "message": "Not a file"}
     
+    with open(filepath, 'rb') as f:
+        return send_file_stream(f, os.path.basename(filepath), os.path.getsize(filepath), target_user)
+
+
+@eel.expose
+def send_file_data(filename, base64_data, target_user=None):
+    """Send file data from browser (base64 encoded, prefer the /upload route)"""
+    filedata = base64.b64decode(base64_data)
+    return send_file_stream(io.BytesIO(filedata), filename, len(filedata), target_user)
+
+
+@eel.expose
+def start_file_group(count, filesize, target_user=None):
+    """Announce a batch of files sent as one group, return its id for the uploads"""
     if not connected or not client_socket:
         return {"success": False, "message": "Not connected to server"}
     
+    group = str(next(group_ids))
+    queue_message({
+        "type": "file_group",
+        "group": group,
+        "count": count,
+        "filesize": filesize,
+        "target": target_user
+    }, "send files")
+    return {"success": True, "group": group}
+
+
+@eel.expose
+def finish_file_group(group):
+    """Close a batch after its last upload"""
+    queue_message({"type": "file_group_end", "group": group}, "send files")
+    with upload_cond:
+        rejected_groups.discard(group)
+    return {"success": True}
+
+
+@eel.expose
+def send_files(paths, target_user=None):
+    """Send files and directories (recursively) as one group, several uploads in flight at once"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in sorted(names))
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            return {"success": False, "message": f"File not found: {path}"}
+    
+    files = [path for path in files if os.path.getsize(path) > 0]
+    if not files:
+        return {"success": False, "message": "No files to send"}
+    
+    started = start_file_group(len(files), sum(os.path.getsize(path) for path in files), target_user)
+    if not started["success"]:
+        return started
+    group = started["group"]
+    
+    def send_one(path):
+        with open(path, 'rb') as f:
+            return send_file_stream(f, os.path.basename(path), os.path.getsize(path), target_user, group)
+    
     try:
-        # Decode base64 to binary
-        filedata = base64.b64decode(base64_data)
-        filesize = len(filedata)
-        
-        # Send file transfer header
-        file_header = {
-            "type": "file_transfer",
-            "filename": filename,
-            "filesize": filesize,
-            "target": target_user
-        }
-        header_json = json.dumps(file_header) + "\n"
-        client_socket.send(header_json.encode('utf-8'))
-        
-        # Brief pause for server to process header
-        import time
-        time.sleep(0.1)
-        
-        # Send file size as 4-byte integer
-        client_socket.send(struct.pack('>I', filesize))
-        
-        # Send raw binary data in chunks
-        chunk_size = 4096
-        for i in range(0, filesize, chunk_size):
-            chunk = filedata[i:i + chunk_size]
-            client_socket.send(chunk)
-        
-        return {"success": True, "message": f"File '{filename}' sent successfully"}
-        
-    except Exception as e:
-        return {"success": False, "message": f"Failed to send file: {str(e)}"}
+        with ThreadPoolExecutor(UPLOAD_PARALLEL) as pool:
+            results = list(pool.map(send_one, files))
+    finally:
+        finish_file_group(group)
+    
+    sent = sum(1 for result in results if result["success"])
+    return {"success": sent == len(files), "sent": sent, "message": f"{sent} of {len(files)} files sent"}
 
 
 @eel.expose
@@ -651,8 +1493,7 @@ def start_call(target_user):
             "type": "call_request",
             "payload": target_user
         }
-        json_message = json.dumps(msg_dict) + "\n"
-        client_socket.send(json_message.encode('utf-8'))
+        queue_message(msg_dict, "start call")
         return {"success": True, "message": f"Calling {target_user}..."}
     except Exception as e:
         return {"success": False, "message": f"Failed to start call: {str(e)}"}
@@ -674,8 +1515,7 @@ def accept_call(caller):
             "type": "call_accept",
             "payload": caller
         }
-        json_message = json.dumps(msg_dict) + "\n"
-        client_socket.send(json_message.encode('utf-8'))
+        queue_message(msg_dict, "accept call")
         return {"success": True, "message": f"Call accepted with {caller}"}
     except Exception as e:
         return {"success": False, "message": f"Failed to accept call: {str(e)}"}
@@ -694,8 +1534,7 @@ def reject_call(caller):
             "type": "call_reject",
             "payload": caller
         }
-        json_message = json.dumps(msg_dict) + "\n"
-        client_socket.send(json_message.encode('utf-8'))
+        queue_message(msg_dict, "reject call")
         call_partner = ""
         return {"success": True, "message": "Call rejected"}
     except Exception as e:
@@ -718,8 +1557,7 @@ def end_call():
             "type": "call_end",
             "payload": call_partner
         }
-        json_message = json.dumps(msg_dict) + "\n"
-        client_socket.send(json_message.encode('utf-8'))
+        queue_message(msg_dict, "end call")
         
         stop_voice_call()
         call_partner = ""
@@ -731,9 +1569,14 @@ def end_call():
 @eel.expose
 def disconnect():
     """Disconnect from server"""
-    global connected, client_socket, udp_socket, p_audio
+    global connected, client_socket, udp_socket, p_audio, session_token
     
+    # Log out explicitly, so the server does not keep the session for a resume
+    if connected and client_socket:
+        send_queue.put(protocol.encode({"type": "logout", "payload": ""}))
+        send_queue.flush(LOGOUT_FLUSH_TIMEOUT)
     connected = False
+    session_token = None
     
     # Stop any active call
     stop_voice_call()
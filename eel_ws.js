@@ -0,0 +1,691 @@
+// eel_ws.js - Eel's JavaScript API on the server's WebSocket gateway
+// Served as /eel.js by ws_gateway.py, so login.html, chat.html and Chat.js
+// run in a plain browser: the calls client_gui.py exposes are implemented
+// here on the chat protocol itself, spoken over one WebSocket to the server.
+// Each page is a document of its own, so the session token is kept in
+// sessionStorage and chat.html resumes the session login.html started.
+(function() {
+    const FILE_CHUNK_MARKER = 1;
+    const FILE_CHUNKS_FEATURE = 'file-chunks-v1';
+    const UPLOAD_CHUNK_SIZE = 64 * 1024;
+    const UPLOAD_PARALLEL = 4;            // Uploads of a batch in flight at once
+    const PROGRESS_INTERVAL = 250;        // Milliseconds between download progress updates
+    const RECONNECT_DELAYS = [250, 500, 1000, 2000, 4000];
+    const MAX_BUSY_RETRIES = 5;           // Logins tried again after the server answered server_busy
+    const LOGIN_URL = 'login.html';
+    const IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'];
+
+    const encoder = new TextEncoder();
+    const decoder = new TextDecoder();
+    const exposed = {};    // Page functions the server's messages are shown with
+    const stored = {
+        get: (key) => JSON.parse(sessionStorage.getItem('chat.' + key)),
+        set: (key, value) => sessionStorage.setItem('chat.' + key, JSON.stringify(value)),
+        clear: () => ['username', 'room', 'token', 'resume_grace', 'upload_window']
+            .forEach(key => sessionStorage.removeItem('chat.' + key))
+    };
+
+    let ws = null;
+    let connected = false;
+    let username = stored.get('username') || '';
+    let currentRoom = stored.get('room') || 'lobby';
+    let receivedSeq = 0;
+    let pendingLogin = null;    // {resolve} until login_success or error
+    let busyUntil = 0;          // performance.now() before which the server asked us not to come back
+    let uploadWindow = stored.get('upload_window') || 0;
+    let uploadCredit = uploadWindow;
+    let uploadGeneration = 0;   // Bumped when a connection is lost, failing its uploads
+    let creditWaiters = [];
+    let nextTransferId = 1;
+    let nextGroupId = 1;
+    const rejectedUploads = new Set();
+    const rejectedGroups = new Set();
+    const incomingGroups = {};
+
+    // Received bytes not parsed yet, buffer[start:end]
+    let buffer = new Uint8Array(64 * 1024);
+    let start = 0;
+    let end = 0;
+    let incomingFile = null;    // File body being received
+    const downloads = new Map(); // Files arriving in chunk frames, by transfer_id
+
+    function sleep(milliseconds) {
+        return new Promise(resolve => setTimeout(resolve, Math.max(milliseconds, 0)));
+    }
+
+    function call(name, ...args) {
+        const func = exposed[name];
+        if (func) {
+            func(...args);
+        }
+    }
+
+    function send(message) {
+        ws.send(encoder.encode(JSON.stringify(message) + '\n'));
+    }
+
+    function open() {
+        const scheme = location.protocol === 'https:' ? 'wss:' : 'ws:';
+        ws = new WebSocket(`${scheme}//${location.host}/ws`);
+        ws.binaryType = 'arraybuffer';
+        buffer = new Uint8Array(64 * 1024);
+        start = end = 0;
+        incomingFile = null;
+        ws.onmessage = (event) => {
+            append(new Uint8Array(event.data));
+            parse();
+        };
+        return new Promise((resolve, reject) => {
+            ws.onopen = () => resolve();
+            ws.onerror = () => reject(new Error('Could not connect to the chat server'));
+        });
+    }
+
+    function append(data) {
+        if (end + data.length > buffer.length) {
+            const size = end - start;
+            if (size + data.length > buffer.length) {
+                const grown = new Uint8Array(Math.max(buffer.length * 2, size + data.length));
+                grown.set(buffer.subarray(start, end));
+                buffer = grown;
+            } else {
+                buffer.copyWithin(0, start, end);
+            }
+            start = 0;
+            end = size;
+        }
+        buffer.set(data, end);
+        end += data.length;
+    }
+
+    // Take complete frames off the buffer: newline-terminated JSON, and the
+    // length-prefixed body behind each file_incoming header
+    function parse() {
+        while (true) {
+            if (incomingFile) {
+                if (!readFileBody()) {
+                    return;
+                }
+                continue;
+            }
+            if (start < end && buffer[start] === FILE_CHUNK_MARKER) {
+                if (!readDownloadChunk()) {
+                    return;
+                }
+                continue;
+            }
+            const newline = buffer.subarray(start, end).indexOf(10);
+            if (newline < 0) {
+                return;
+            }
+            const line = decoder.decode(buffer.subarray(start, start + newline)).trim();
+            start += newline + 1;
+            if (!line) {
+                continue;
+            }
+            let message;
+            try {
+                message = JSON.parse(line);
+            } catch (error) {
+                console.error('Invalid JSON from server');
+                continue;
+            }
+            handleMessage(message);
+        }
+    }
+
+    function handleMessage(message) {
+        const payload = message.payload;
+        if (message.type !== 'resume_success') {
+            receivedSeq++;  // resume_success is sent before the numbering continues
+        }
+
+        switch (message.type) {
+        case 'ping':
+            send({ type: 'pong', payload: payload });
+            break;
+        case 'login_success':
+            stored.set('token', message.token);
+            stored.set('resume_grace', message.resume_grace || 0);
+            stored.set('upload_window', message.upload_window || 0);
+            uploadWindow = uploadCredit = message.upload_window || 0;
+            call('display_message', { type: 'notification', text: payload });
+            if (pendingLogin) {
+                pendingLogin.resolve({ success: true, message: 'Connected successfully' });
+                pendingLogin = null;
+            }
+            break;
+        case 'resume_success':
+            // Uploads in flight were lost with the old connection
+            uploadCredit = uploadWindow;
+            break;
+        case 'error':
+            if (message.code === 'server_busy') {
+                // Spread out a little more than the server already did
+                busyUntil = performance.now() + (message.retry_after || 1) * 1000 * (1 + Math.random() / 2);
+            }
+            if (message.transfer_id != null) {
+                rejectedUploads.add(message.transfer_id);
+            }
+            if (message.group != null) {
+                rejectedGroups.add(message.group);
+            }
+            wakeCreditWaiters();
+            if (pendingLogin) {
+                pendingLogin.resolve({ success: false, message: payload, busy: message.code === 'server_busy' });
+                pendingLogin = null;
+            } else if (message.code === 'server_busy') {
+                // A resume turned away; the reconnect waits until busyUntil
+            } else if (message.code === 'resume_failed') {
+                call('display_error', payload);
+                stored.clear();
+                setTimeout(() => { window.location.href = LOGIN_URL; }, 2000);
+            } else {
+                call('display_error', payload);
+            }
+            break;
+        case 'notification':
+        case 'call_ringing':
+            call('display_message', { type: 'notification', text: payload });
+            break;
+        case 'message':
+            call('display_message', { type: 'message', sender: message.sender || 'Unknown', text: payload });
+            break;
+        case 'private_message':
+            call('display_message', { type: 'private', sender: message.sender || 'Unknown', text: payload });
+            break;
+        case 'private_sent': {
+            const queued = message.queued ? ' (offline, will be delivered)' : '';
+            call('display_message', { type: 'private', sender: `You → ${message.target}${queued}`, text: payload });
+            break;
+        }
+        case 'inbox':
+            // Private messages sent while we were offline, oldest first
+            for (const item of payload) {
+                const sentAt = new Date(item.ts * 1000).toLocaleString();
+                call('display_message', { type: 'private', sender: `${item.sender} (offline, ${sentAt})`, text: item.payload });
+            }
+            if (payload.length) {
+                send({ type: 'inbox_ack', payload: payload[payload.length - 1].id });
+            }
+            break;
+        case 'room_info':
+            currentRoom = payload.room;
+            stored.set('room', currentRoom);
+            call('update_room_info', payload);
+            break;
+        case 'room_list':
+            call('update_rooms_list', payload);
+            break;
+        case 'user_list':
+            call('update_users_list', payload);
+            break;
+        case 'file_incoming':
+            if (message.transfer_id != null) {
+                // The data follows in chunk frames
+                const file = newDownload(message, message.length || 0);
+                if (file.size) {
+                    downloads.set(message.transfer_id, file);
+                } else {
+                    finishDownload(file);
+                }
+            } else {
+                incomingFile = { header: message, size: null };
+            }
+            break;
+        case 'file_credit':
+            uploadCredit = Math.min(uploadCredit + payload, uploadWindow);
+            wakeCreditWaiters();
+            break;
+        case 'file_sent_confirm':
+            // Files of a batch are summed up when it completes
+            if (message.group == null) {
+                call('display_message', { type: 'notification', text: payload });
+            }
+            break;
+        case 'file_group': {
+            const sender = message.sender || 'Unknown';
+            incomingGroups[`${sender}/${message.group}`] = {
+                id: `${sender}/group/${message.group}/${performance.now()}`,
+                sender: sender,
+                filename: `${message.count} files`,
+                group: message.group,
+                received: 0,
+                total: message.filesize || 0,
+                done: false
+            };
+            call('display_message', { type: 'notification', text: `${sender} is sending ${message.count} files` });
+            break;
+        }
+        case 'file_group_complete':
+            if (message.sender == null) {
+                call('display_message', { type: 'notification', text: payload });  // Our own batch
+            } else {
+                const key = `${message.sender}/${message.group}`;
+                const progress = incomingGroups[key];
+                if (progress) {
+                    delete incomingGroups[key];
+                    progress.done = true;
+                    call('display_file_progress', progress);
+                }
+                call('display_message', { type: 'notification', text: `${message.sender} sent ${message.count || 0} files` });
+            }
+            break;
+        case 'call_incoming':
+            call('display_call_incoming', payload);
+            break;
+        case 'call_started':
+            call('display_call_started', payload);
+            break;
+        case 'call_rejected':
+            call('display_message', { type: 'notification', text: payload });
+            break;
+        case 'call_ended':
+            call('display_call_ended', payload);
+            break;
+        }
+    }
+
+    // A file being received, size bytes of data in parts
+    function newDownload(header, size) {
+        const sender = header.sender || 'Unknown';
+        const progress = incomingGroups[`${sender}/${header.group}`] || {
+            id: `${sender}/${header.filename}/${performance.now()}`,
+            sender: sender,
+            filename: header.filename,
+            received: 0,
+            total: size,
+            done: false
+        };
+        return { header: header, size: size, parts: [], received: 0, reported: 0, progress: progress, base: progress.received };
+    }
+
+    function addDownloadPart(file, part) {
+        file.parts.push(part);
+        file.received += part.length;
+        const now = performance.now();
+        if (file.received < file.size && now - file.reported >= PROGRESS_INTERVAL) {
+            file.reported = now;
+            file.progress.received = file.base + file.received;
+            call('display_file_progress', file.progress);
+        }
+    }
+
+    function finishDownload(file) {
+        file.progress.received = file.base + file.size;
+        if (file.progress.group == null) {
+            file.progress.done = true;
+        }
+        call('display_file_progress', file.progress);
+
+        const filename = file.header.filename || 'unknown_file';
+        const dot = filename.lastIndexOf('.');
+        const isImage = dot >= 0 && IMAGE_EXTENSIONS.includes(filename.slice(dot).toLowerCase());
+        call('display_file', {
+            type: 'received',
+            sender: file.header.sender || 'Unknown',
+            filename: filename,
+            filepath: filename,
+            filesize: file.size,
+            is_image: isImage,
+            file_url: URL.createObjectURL(new Blob(file.parts)),
+            thumbnail_url: null
+        });
+    }
+
+    // Remove the progress of a file that will not complete
+    function endProgress(progress) {
+        progress.done = true;
+        call('display_file_progress', progress);
+    }
+
+    // Move the received part of a file body out of the buffer, return true
+    // once the whole file is in
+    function readFileBody() {
+        if (incomingFile.size === null) {
+            if (end - start < 4) {
+                return false;
+            }
+            const size = new DataView(buffer.buffer, start, 4).getUint32(0);
+            start += 4;
+            incomingFile = newDownload(incomingFile.header, size);
+        }
+
+        const file = incomingFile;
+        const count = Math.min(end - start, file.size - file.received);
+        if (count) {
+            addDownloadPart(file, buffer.slice(start, start + count));
+            start += count;
+        }
+        if (file.received < file.size) {
+            return false;
+        }
+        incomingFile = null;
+        finishDownload(file);
+        return true;
+    }
+
+    // Take the chunk frame at the start of the buffer, return false if it is incomplete
+    function readDownloadChunk() {
+        if (end - start < 9) {
+            return false;
+        }
+        const view = new DataView(buffer.buffer, start, 9);
+        const transferId = view.getUint32(1);
+        const length = view.getUint32(5);
+        if (end - start < 9 + length) {
+            return false;
+        }
+        const file = downloads.get(transferId);
+        if (file) {
+            addDownloadPart(file, buffer.slice(start + 9, start + 9 + length));
+            if (file.received >= file.size) {
+                downloads.delete(transferId);
+                finishDownload(file);
+            }
+        }
+        start += 9 + length;
+        return true;
+    }
+
+    // Dropped connection: resume the session while the server keeps it
+    async function reconnect() {
+        connected = false;
+        uploadGeneration++;
+        wakeCreditWaiters();
+        // Files being received will not complete, take their progress down;
+        // files of a batch still to come show on their own
+        for (const file of downloads.values()) {
+            endProgress(file.progress);
+        }
+        downloads.clear();
+        if (incomingFile && incomingFile.progress) {
+            endProgress(incomingFile.progress);
+        }
+        incomingFile = null;
+        for (const key of Object.keys(incomingGroups)) {
+            endProgress(incomingGroups[key]);
+            delete incomingGroups[key];
+        }
+        call('display_message', { type: 'notification', text: 'Connection lost, reconnecting...' });
+        const deadline = performance.now() + (stored.get('resume_grace') || 0) * 1000;
+        for (let attempt = 0; performance.now() < deadline; attempt++) {
+            await sleep(Math.max(RECONNECT_DELAYS[Math.min(attempt, RECONNECT_DELAYS.length - 1)], busyUntil - performance.now()));
+            if (await resume(receivedSeq)) {
+                call('display_message', { type: 'notification', text: 'Reconnected' });
+                return;
+            }
+        }
+        call('display_error', 'Connection error: connection to server lost');
+    }
+
+    async function resume(lastSeq) {
+        try {
+            await open();
+        } catch (error) {
+            return false;
+        }
+        connected = true;
+        receivedSeq = lastSeq;
+        watchClose();
+        send({ type: 'resume', payload: stored.get('token'), last_seq: lastSeq });
+        return true;
+    }
+
+    function watchClose() {
+        const socket = ws;
+        socket.onclose = () => {
+            if (socket !== ws || !connected) {
+                return;
+            }
+            if (pendingLogin) {
+                pendingLogin.resolve({ success: false, message: 'Connection closed by the server' });
+                pendingLogin = null;
+            }
+            if (stored.get('token')) {
+                reconnect();
+            } else {
+                connected = false;
+                call('display_error', 'Connection error: connection to server lost');
+            }
+        };
+    }
+
+    function wakeCreditWaiters() {
+        creditWaiters = creditWaiters.filter(check => !check());
+    }
+
+    // Wait until the server has given credit for nbytes more of upload data
+    function waitUploadCredit(transferId, group, generation, nbytes) {
+        return new Promise((resolve, reject) => {
+            const check = () => {
+                if (generation !== uploadGeneration || !connected) {
+                    reject(new Error('Connection lost'));
+                } else if (rejectedUploads.has(transferId) || (group && rejectedGroups.has(group))) {
+                    reject(new Error('Transfer cancelled'));
+                } else if (uploadCredit >= nbytes) {
+                    uploadCredit -= nbytes;
+                    resolve();
+                } else {
+                    return false;
+                }
+                return true;
+            };
+            if (!check()) {
+                creditWaiters.push(check);
+            }
+        });
+    }
+
+    function encodeFileChunk(transferId, data) {
+        const frame = new Uint8Array(9 + data.length);
+        const view = new DataView(frame.buffer);
+        view.setUint8(0, FILE_CHUNK_MARKER);
+        view.setUint32(1, transferId);
+        view.setUint32(5, data.length);
+        frame.set(data, 9);
+        return frame;
+    }
+
+    // Log in on a new WebSocket, resolving to {success, message, busy}
+    async function login(user) {
+        try {
+            await open();
+        } catch (error) {
+            return { success: false, message: error.message };
+        }
+        username = user;
+        stored.clear();
+        stored.set('username', user);
+        connected = true;
+        receivedSeq = 0;
+        watchClose();
+        const result = new Promise(resolve => { pendingLogin = { resolve: resolve }; });
+        send({ type: 'login', payload: user, features: [FILE_CHUNKS_FEATURE] });
+        const outcome = await result;
+        if (!outcome.success) {
+            connected = false;
+            stored.clear();
+            ws.close();
+        }
+        return outcome;
+    }
+
+    // Calls client_gui.py exposes, with the same arguments and results
+    const api = {
+        async connect_to_server(user, host, port, transportName) {
+            // The gateway is the server; host, port and transport do not apply.
+            // A login turned away as busy is tried again when the server said.
+            for (let attempt = 0; ; attempt++) {
+                const outcome = await login(user);
+                if (!outcome.busy || attempt >= MAX_BUSY_RETRIES) {
+                    return outcome;
+                }
+                await sleep(busyUntil - performance.now());
+            }
+        },
+
+        send_message(message) {
+            if (!connected) {
+                call('display_error', 'Not connected to server');
+                return false;
+            }
+            message = message.trim();
+            if (!message) {
+                return false;
+            }
+            let msg;
+            if (message.startsWith('/pm ')) {
+                const parts = message.split(' ');
+                if (parts.length < 3) {
+                    call('display_error', 'Usage: /pm <username> <message>');
+                    return false;
+                }
+                msg = { type: 'private_message', target: parts[1], payload: parts.slice(2).join(' ') };
+            } else if (message.startsWith('/join ')) {
+                msg = { type: 'join_room', payload: message.slice(6).trim() };
+            } else if (message === '/rooms') {
+                msg = { type: 'list_rooms', payload: '' };
+            } else if (message === '/help') {
+                call('display_message', { type: 'notification', text: 'Commands: /pm [user] [msg] | /join [room] | /rooms | /help' });
+                return true;
+            } else {
+                msg = { type: 'message', payload: message };
+                call('display_message', { type: 'message', sender: username, text: message });
+            }
+            send(msg);
+            return true;
+        },
+
+        join_room(roomName) {
+            return api.send_message(`/join ${roomName}`);
+        },
+
+        request_rooms_list() {
+            return api.send_message('/rooms');
+        },
+
+        get_user_info() {
+            return { username: username, room: currentRoom };
+        },
+
+        get_transfer_info() {
+            // No local upload route: files go up the WebSocket (upload_file)
+            return { upload_url: null, token: null, parallel: UPLOAD_PARALLEL };
+        },
+
+        start_file_group(count, filesize, targetUser) {
+            if (!connected) {
+                return { success: false, message: 'Not connected to server' };
+            }
+            const group = String(nextGroupId++);
+            send({ type: 'file_group', group: group, count: count, filesize: filesize, target: targetUser || null });
+            return { success: true, group: group };
+        },
+
+        finish_file_group(group) {
+            send({ type: 'file_group_end', group: group });
+            rejectedGroups.delete(group);
+            return { success: true };
+        },
+
+        // Send a File with the chunked upload protocol, within the server's credit
+        async upload_file(file, targetUser, group, onProgress) {
+            if (!connected) {
+                return { success: false, message: 'Not connected to server' };
+            }
+            const transferId = nextTransferId++;
+            const generation = uploadGeneration;
+            try {
+                send({
+                    type: 'file_transfer',
+                    filename: file.name,
+                    filesize: file.size,
+                    target: targetUser || null,
+                    transfer_id: transferId,
+                    group: group || null
+                });
+                for (let offset = 0; offset < file.size; offset += UPLOAD_CHUNK_SIZE) {
+                    const data = new Uint8Array(await file.slice(offset, offset + UPLOAD_CHUNK_SIZE).arrayBuffer());
+                    await waitUploadCredit(transferId, group, generation, data.length);
+                    ws.send(encodeFileChunk(transferId, data));
+                    if (onProgress) {
+                        onProgress(offset + data.length);
+                    }
+                }
+            } catch (error) {
+                return { success: false, message: `Failed to send file: ${error.message}` };
+            } finally {
+                rejectedUploads.delete(transferId);
+            }
+            return { success: true, message: `File '${file.name}' sent successfully` };
+        },
+
+        start_call(targetUser) {
+            return { success: false, message: 'Voice calls need the desktop client' };
+        },
+
+        accept_call(caller) {
+            return { success: false, message: 'Voice calls need the desktop client' };
+        },
+
+        reject_call(caller) {
+            send({ type: 'call_reject', payload: caller });
+            return { success: true, message: 'Call rejected' };
+        },
+
+        end_call() {
+            send({ type: 'call_end', payload: '' });
+            return { success: true, message: 'Call ended' };
+        },
+
+        disconnect() {
+            // Log out explicitly, so the server does not keep the session for a resume
+            if (connected) {
+                connected = false;
+                send({ type: 'logout', payload: '' });
+                ws.close();
+            }
+            stored.clear();
+            return true;
+        }
+    };
+
+    // eel.name(args)() returns a promise of the result, as with Eel
+    const eel = {
+        gateway: true,
+        expose(func, name) {
+            exposed[name || func.name] = func;
+        }
+    };
+    for (const [name, func] of Object.entries(api)) {
+        eel[name] = (...args) => () => Promise.resolve().then(() => func(...args));
+    }
+    window.eel = eel;
+
+    // Leaving the page drops the connection, not the session: the next page
+    // resumes it
+    window.addEventListener('pagehide', () => {
+        if (connected) {
+            connected = false;
+            ws.close();
+        }
+    });
+
+    // A page showing the chat (one that exposes display functions) picks up
+    // the session; the server resends what the previous page was sent
+    function resumeOnLoad() {
+        if (Object.keys(exposed).length && stored.get('token')) {
+            resume(0).then(resumed => {
+                if (!resumed) {
+                    reconnect();
+                }
+            });
+        }
+    }
+    if (document.readyState === 'loading') {
+        document.addEventListener('DOMContentLoaded', resumeOnLoad);
+    } else {
+        resumeOnLoad();
+    }
+})();
@@ -1,36 +1,78 @@
-# server_gui.py
-# GUI-based LAN chat server (integrated from original server.py)
-# Features: Start/stop server, monitor logs, handle clients with chat/file/call support.
-# GUI uses Tkinter for control and logging.
-
-import socket
+# file.py
+# Tk console for the chat server in server.py
+# Features: Start/stop the server in-process, live session/room/call and
+# throughput counters, and a capped view of the server log.
+# Counters are sampled from the server's metrics once a second and the log
+# view is refreshed from a ring buffer, so a flood of log lines never
+# reaches Tk one line at a time.
+
+import logging
 import threading
-import datetime
-import os
+import time
+import itertools
+from collections import deque
 import tkinter as tk
 from tkinter import scrolledtext, messagebox
-import queue
+
+import chat_logging
+import server as chat_server
 
 HOST = "127.0.0.1"
-PORT = 5555
-BUFFER = 4096
+PORT = chat_server.PORT
+UDP_PORT = chat_server.UDP_PORT
+
+LOG_VIEW_LINES = 1000      # Lines kept in the log view (and its ring buffer)
+LOG_REFRESH_MS = 250       # How often new log lines are moved into the view
+STATS_REFRESH_MS = 1000    # How often the counters are sampled
+
+
+class RingBufferHandler(logging.Handler):
+    """Logging handler keeping only the last maxlen formatted lines for the GUI to poll"""
+
+    def __init__(self, maxlen):
+        super().__init__()
+        self.lines = deque(maxlen=maxlen)
+        self.count = 0  # Lines emitted since start, so the GUI can tell what is new
+        self.setFormatter(chat_logging.ConsoleFormatter())
+
+    def emit(self, record):
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        self.lines.append(line)
+        self.count += 1
+
+    def since(self, seen):
+        """Return lines emitted after the first seen ones (at most maxlen) and the new count"""
+        with self.lock:
+            count = self.count
+            new = min(count - seen, len(self.lines))
+            lines = list(itertools.islice(self.lines, len(self.lines) - new, None))
+        return lines, count
 
-lock = threading.Lock()
-clients = {}   # username -> (conn, addr)
-groups = {}    # groupname -> set(usernames)
-call_state = {}  # username -> (calling_to_username or None)
 
 class ServerGUI:
     def __init__(self, root):
         self.root = root
         self.root.title("LAN Chat Server - Stopped")
-        self.root.geometry("700x500")
+        self.root.geometry("760x540")
 
         # Server variables
         self.server_thread = None
         self.server_socket = None
         self.running = False
 
+        # Log records reach the view through a ring buffer filled by the
+        # logging thread, never through the server's own threads
+        self.log_handler = RingBufferHandler(LOG_VIEW_LINES)
+        self.log_seen = 0
+        chat_logging.setup_logging(console=False, handlers=(self.log_handler,))
+
+        # Previous counter sample, for rates: (time, snapshot)
+        self.last_sample = None
+
         # GUI Elements
         # Config Frame
         config_frame = tk.Frame(root)
@@ -42,56 +84,100 @@ class ServerGUI:
         self.host_entry.grid(row=0, column=1)
 
         tk.Label(config_frame, text="Port:").grid(row=0, column=2)
-        self.port_entry = tk.Entry(config_frame, width=5)
+        self.port_entry = tk.Entry(config_frame, width=6)
         self.port_entry.insert(0, str(PORT))
         self.port_entry.grid(row=0, column=3)
 
+        tk.Label(config_frame, text="UDP Port:").grid(row=0, column=4)
+        self.udp_port_entry = tk.Entry(config_frame, width=6)
+        self.udp_port_entry.insert(0, str(UDP_PORT))
+        self.udp_port_entry.grid(row=0, column=5)
+
         self.start_btn = tk.Button(config_frame, text="Start Server", command=self.start_server)
-        self.start_btn.grid(row=0, column=4, padx=5)
+        self.start_btn.grid(row=0, column=6, padx=5)
 
         self.stop_btn = tk.Button(config_frame, text="Stop Server", command=self.stop_server, state=tk.DISABLED)
-        self.stop_btn.grid(row=0, column=5)
+        self.stop_btn.grid(row=0, column=7)
 
         self.clear_btn = tk.Button(config_frame, text="Clear Logs", command=self.clear_logs)
-        self.clear_btn.grid(row=0, column=6, padx=5)
+        self.clear_btn.grid(row=0, column=8, padx=5)
 
         # Status Label
         self.status_label = tk.Label(root, text="Server Status: Stopped", fg="red")
         self.status_label.pack(pady=5)
 
+        # Stats Frame: one label per counter
+        stats_frame = tk.Frame(root)
+        stats_frame.pack(pady=5)
+
+        self.stat_labels = {}
+        stats = [
+            ('sessions', "Sessions"),
+            ('rooms', "Rooms"),
+            ('calls', "Calls"),
+            ('messages_rate', "Msgs/s"),
+            ('file_rate', "Files KB/s"),
+            ('voice_rate', "Voice KB/s"),
+            ('dropped', "Dropped")
+        ]
+        for column, (key, title) in enumerate(stats):
+            tk.Label(stats_frame, text=title, fg="gray").grid(row=0, column=column, padx=8)
+            label = tk.Label(stats_frame, text="0", font=("TkDefaultFont", 12, "bold"))
+            label.grid(row=1, column=column, padx=8)
+            self.stat_labels[key] = label
+
         # Log Display
         self.log_area = scrolledtext.ScrolledText(root, wrap=tk.WORD, state=tk.DISABLED, height=20)
         self.log_area.pack(pady=5, padx=10, fill=tk.BOTH, expand=True)
 
-        # Message queue for thread-safe GUI updates
-        self.log_queue = queue.Queue()
-        self.root.after(100, self.process_queue)  # Check queue periodically
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.root.after(LOG_REFRESH_MS, self.refresh_log)
+        self.root.after(STATS_REFRESH_MS, self.refresh_stats)
+
+    def append_to_log(self, lines):
+        self.log_area.config(state=tk.NORMAL)
+        self.log_area.insert(tk.END, "\n".join(lines) + "\n")
+
+        # Keep at most LOG_VIEW_LINES lines (the last line is always empty)
+        excess = int(self.log_area.index("end-1c").split(".")[0]) - 1 - LOG_VIEW_LINES
+        if excess > 0:
+            self.log_area.delete("1.0", f"{excess + 1}.0")
 
-        # Override print to log to GUI
-        import builtins
-        original_print = builtins.print
-        builtins.print = self.gui_print
+        self.log_area.see(tk.END)  # Auto-scroll
+        self.log_area.config(state=tk.DISABLED)
 
-    def gui_print(self, *args, **kwargs):
-        text = " ".join(str(arg) for arg in args)
-        if kwargs:
-            text += " " + str(kwargs)
-        self.log_queue.put(text + "\n")
+    def refresh_log(self):
+        lines, self.log_seen = self.log_handler.since(self.log_seen)
+        if lines:
+            self.append_to_log(lines)
+        self.root.after(LOG_REFRESH_MS, self.refresh_log)
 
-    def append_to_log(self, text):
+    def clear_logs(self):
         self.log_area.config(state=tk.NORMAL)
-        self.log_area.insert(tk.END, text)
-        self.log_area.see(tk.END)  # Auto-scroll
+        self.log_area.delete("1.0", tk.END)
         self.log_area.config(state=tk.DISABLED)
 
-    def process_queue(self):
-        try:
-            while True:
-                msg = self.log_queue.get_nowait()
-                self.append_to_log(msg)
-        except queue.Empty:
-            pass
-        self.root.after(100, self.process_queue)
+    def refresh_stats(self):
+        now = time.monotonic()
+        snapshot = chat_server.stats_snapshot()
+
+        self.stat_labels['sessions'].config(text=str(snapshot['sessions']))
+        self.stat_labels['rooms'].config(text=str(snapshot['rooms']))
+        self.stat_labels['calls'].config(text=str(snapshot['calls']))
+        self.stat_labels['dropped'].config(text=str(snapshot['outbox_drops'] + snapshot['log_records_dropped']))
+
+        if self.last_sample is not None:
+            then, previous = self.last_sample
+            elapsed = max(now - then, 1e-6)
+            messages_rate = (snapshot['messages_received'] - previous['messages_received']) / elapsed
+            file_rate = (snapshot['file_bytes_relayed'] - previous['file_bytes_relayed']) / elapsed / 1024
+            voice_rate = (snapshot['voice_bytes_relayed'] - previous['voice_bytes_relayed']) / elapsed / 1024
+            self.stat_labels['messages_rate'].config(text=f"{messages_rate:.1f}")
+            self.stat_labels['file_rate'].config(text=f"{file_rate:.1f}")
+            self.stat_labels['voice_rate'].config(text=f"{voice_rate:.1f}")
+
+        self.last_sample = (now, snapshot)
+        self.root.after(STATS_REFRESH_MS, self.refresh_stats)
 
     def start_server(self):
         if self.running:
@@ -99,47 +185,47 @@ class ServerGUI:
             return
 
         host = self.host_entry.get().strip()
-        port_str = self.port_entry.get().strip()
         try:
-            port = int(port_str)
+            port = int(self.port_entry.get().strip())
+            udp_port = int(self.udp_port_entry.get().strip())
         except ValueError:
-            messagebox.showerror("Error", "Port must be a number.")
+            messagebox.showerror("Error", "Ports must be numbers.")
             return
 
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         try:
-            self.server_socket.bind((host, port))
-            self.server_socket.listen(100)
-            self.running = True
-            self.root.title(f"LAN Chat Server - Running on {host}:{port}")
-            self.status_label.config(text=f"Server Status: Running on {host}:{port}", fg="green")
-            self.start_btn.config(state=tk.DISABLED)
-            self.stop_btn.config(state=tk.NORMAL)
-            self.append_to_log(f"Starting server on {host}:{port}\n")
-
-            # Start server thread
-            self.server_thread = threading.Thread(target=self.server_main, daemon=True)
-            self.server_thread.start()
-
-        except Exception as e:
+            self.server_socket = chat_server.open_server(host, port, udp_port)
+        except OSError as e:
             messagebox.showerror("Error", f"Failed to start server: {e}")
-            self.server_socket.close()
-            self.server_socket = None
+            return
+
+        self.running = True
+        self.root.title(f"LAN Chat Server - Running on {host}:{port}")
+        self.status_label.config(text=f"Server Status: Running on {host}:{port}", fg="green")
+        self.start_btn.config(state=tk.DISABLED)
+        self.stop_btn.config(state=tk.NORMAL)
+
+        # Start server thread (the accept loop)
+        self.server_thread = threading.Thread(target=chat_server.serve, args=(self.server_socket,), daemon=True)
+        self.server_thread.start()
 
     def stop_server(self):
         if not self.running:
             return
 
         self.running = False
-        if self.server_socket:
-            try:
-                self.server_socket.close()
-            except:
-                pass
+        chat_server.stop_server()
         self.server_socket = None
         self.root.title("LAN Chat Server - Stopped")
         self.status_label.config(text="Server Status: Stopped", fg="red")
         self.start_btn.config(state=tk.NORMAL)
         self.stop_btn.config(state=tk.DISABLED)
-        self.append_to_log("Server stopped.\n")
+
+    def on_close(self):
+        self.stop_server()
+        self.root.destroy()
+
+
+if __name__ == "__main__":
+    root = tk.Tk()
+    ServerGUI(root)
+    root.mainloop()
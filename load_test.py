@@ -0,0 +1,609 @@
+# load_test.py
+# Headless load generator and benchmark runner for server.py.
+# Simulates many synthetic clients speaking the real protocol (login, message,
+# join_room, file_transfer and UDP voice calls) and reports throughput,
+# fan-out latency percentiles and server RSS/CPU.
+#
+# Examples:
+#   python load_test.py --spawn-server --scenario smoke
+#   python load_test.py --scenario rooms --clients 3000 --output run.json
+#   python load_test.py --scenario rooms --baseline run.json   (exit 1 on regression)
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+import protocol
+
+HOST = '127.0.0.1'
+PORT = 5555
+UDP_PORT = 5556
+
+# Marker at the start of synthetic chat payloads: LT|<send time ns>|<sender index>|
+PAYLOAD_MARKER = "LT|"
+
+# Presence lists grow with the client count and are not measured, so they are
+# skipped without being decoded
+SKIP_FRAME_TAG = b'"user_list"'
+
+# Voice frames match client_gui.py: 1024 samples of 16-bit mono at 16 kHz
+VOICE_FRAME_BYTES = 2048
+VOICE_FRAME_INTERVAL = 1024 / 16000
+
+CONNECT_RATE = 500.0    # New connections per second during ramp-up, unless the scenario sets one
+MAX_BUSY_RETRIES = 10   # Logins turned away as server_busy that a client tries again
+
+# Reproducible benchmark scenarios, any field can be overridden on the command line
+SCENARIOS = {
+    "smoke": {
+        "clients": 50, "rooms": 5, "room_distribution": "uniform",
+        "message_rate": 1.0, "message_size": 64,
+        "file_size": 64 * 1024, "file_rate": 0.02, "calls": 2, "duration": 15
+    },
+    "lobby": {
+        "clients": 500, "rooms": 1, "room_distribution": "uniform",
+        "message_rate": 0.15, "message_size": 64,
+        "file_size": 0, "file_rate": 0.0, "calls": 0, "duration": 30
+    },
+    "rooms": {
+        "clients": 2000, "rooms": 100, "room_distribution": "zipf",
+        "message_rate": 0.5, "message_size": 128,
+        "file_size": 0, "file_rate": 0.0, "calls": 0, "duration": 60
+    },
+    "files": {
+        "clients": 200, "rooms": 20, "room_distribution": "uniform",
+        "message_rate": 0.2, "message_size": 64,
+        "file_size": 512 * 1024, "file_rate": 0.05, "calls": 0, "duration": 60
+    },
+    "calls": {
+        "clients": 200, "rooms": 20, "room_distribution": "uniform",
+        "message_rate": 0.2, "message_size": 64,
+        "file_size": 0, "file_rate": 0.0, "calls": 50, "duration": 60
+    },
+    # Everyone reconnecting at once, as after a network blip: admission
+    # control turns part of them away and they come back after retry_after
+    "storm": {
+        "clients": 3000, "rooms": 30, "room_distribution": "zipf",
+        "message_rate": 0.1, "message_size": 64,
+        "file_size": 0, "file_rate": 0.0, "calls": 0, "duration": 15,
+        "connect_rate": 100000.0
+    }
+}
+
+# Report fields compared against a baseline: (field, higher_is_better)
+REGRESSION_FIELDS = [
+    ("deliveries_per_sec", True),
+    ("latency_p50_ms", False),
+    ("latency_p99_ms", False),
+    ("latency_p999_ms", False),
+    ("server_rss_max_mb", False),
+    ("server_cpu_avg_pct", False)
+]
+
+
+class Stats:
+    """Counters and latency samples shared by all synthetic clients"""
+
+    def __init__(self):
+        self.connected = 0
+        self.login_failures = 0
+        self.busy_rejections = 0
+        self.messages_sent = 0
+        self.deliveries = 0
+        self.latencies_ns = []
+        self.files_sent = 0
+        self.file_bytes_sent = 0
+        self.files_received = 0
+        self.file_bytes_received = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self.calls_started = 0
+        self.voice_packets_sent = 0
+        self.voice_packets_received = 0
+        self.disconnects = 0
+
+
+class Phase:
+    """Events that move all clients from ramp-up to steady state to shutdown"""
+
+    def __init__(self):
+        self.steady = asyncio.Event()
+        self.finished = asyncio.Event()
+
+
+class VoiceProtocol(asyncio.DatagramProtocol):
+    """Counts voice packets relayed back by the server"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def datagram_received(self, data, addr):
+        self.stats.voice_packets_received += 1
+
+
+def assign_rooms(count, rooms, distribution, rng):
+    """Pick a room index for every client"""
+    if distribution == "zipf":
+        weights = [1.0 / (rank + 1) for rank in range(rooms)]
+    else:
+        weights = [1.0] * rooms
+    return rng.choices(range(rooms), weights=weights, k=count)
+
+
+def room_name(index):
+    # Room 0 is the server's default room so no join is needed
+    return "lobby" if index == 0 else f"room-{index}"
+
+
+def encode(message_dict):
+    return protocol.encode(message_dict)
+
+
+class SyntheticClient:
+    """One simulated user: a TCP session plus optional UDP voice"""
+
+    def __init__(self, index, config, stats, room, phase):
+        self.index = index
+        self.config = config
+        self.stats = stats
+        self.room = room
+        self.phase = phase
+        self.username = f"{config['user_prefix']}{index}"
+        self.rng = random.Random(config['seed'] * 1000003 + index)
+        self.reader = None
+        self.writer = None
+        self.logged_in = asyncio.Event()
+        self.upload_credit = 0
+        self.credit_added = asyncio.Event()
+        self.call_started = asyncio.Event()
+        self.call_partner = None
+        self.is_caller = False
+        self.voice_task = None
+
+    async def log_in(self):
+        """Connect and log in, coming back after server_busy rejections; return False on failure"""
+        for _ in range(MAX_BUSY_RETRIES + 1):
+            try:
+                self.reader, self.writer = await asyncio.open_connection(
+                    self.config['host'], self.config['port'], limit=16 * 1024 * 1024)
+            except OSError:
+                return False
+            self.writer.write(encode({"type": "login", "payload": self.username}))
+
+            # Wait for the answer to the login; nothing else is measured yet
+            message = None
+            try:
+                while message is None or message.get("type") not in ("login_success", "error"):
+                    line = await asyncio.wait_for(self.reader.readline(), 30)
+                    if not line:
+                        break
+                    message = protocol.decode(line, validate=False)
+            except (asyncio.TimeoutError, ConnectionError, protocol.ProtocolError):
+                pass
+            if message is not None and message.get("type") == "login_success":
+                self.handle(message)
+                return True
+
+            self.writer.close()
+            if message is None or message.get("code") != "server_busy":
+                return False
+            self.stats.busy_rejections += 1
+            await asyncio.sleep(message.get("retry_after", 1) * self.rng.uniform(1, 1.5))
+        return False
+
+    async def run(self, call_target=None):
+        if not await self.log_in():
+            self.stats.login_failures += 1
+            return
+        self.stats.connected += 1
+
+        reader_task = asyncio.create_task(self.read_loop())
+        try:
+
+            if self.room != "lobby":
+                self.writer.write(encode({"type": "join_room", "payload": self.room}))
+
+            # Traffic only starts once every client is logged in
+            await self.phase.steady.wait()
+            tasks = []
+            if self.config['message_rate'] > 0:
+                tasks.append(asyncio.create_task(self.message_loop()))
+            if self.config['file_rate'] > 0 and self.config['file_size'] > 0:
+                tasks.append(asyncio.create_task(self.file_loop()))
+            if call_target:
+                self.is_caller = True
+                tasks.append(asyncio.create_task(self.call(call_target)))
+
+            await self.phase.finished.wait()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            reader_task.cancel()
+            if self.voice_task:
+                self.voice_task.cancel()
+            # Log out, or the server keeps the session around for a resume
+            if self.logged_in.is_set() and not self.writer.is_closing():
+                self.writer.write(encode({"type": "logout", "payload": ""}))
+            self.writer.close()
+
+    async def read_loop(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    self.stats.disconnects += 1
+                    return
+                if SKIP_FRAME_TAG in line[:32]:
+                    continue
+                message = protocol.decode(line, validate=False)
+                self.handle(message)
+
+                if message.get("type") == "file_incoming":
+                    body = await self.reader.readexactly(4 + message.get("filesize", 0))
+                    self.stats.files_received += 1
+                    self.stats.file_bytes_received += len(body) - 4
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.stats.disconnects += 1
+        except asyncio.CancelledError:
+            pass
+
+    def handle(self, message):
+        msg_type = message.get("type")
+        payload = message.get("payload")
+
+        if msg_type == "message" and isinstance(payload, str) and payload.startswith(PAYLOAD_MARKER):
+            sent_ns = int(payload.split("|", 2)[1])
+            self.stats.latencies_ns.append(time.monotonic_ns() - sent_ns)
+            self.stats.deliveries += 1
+        elif msg_type == "login_success":
+            self.upload_credit = message.get("upload_window", 0)
+            self.logged_in.set()
+        elif msg_type == "ping":
+            self.writer.write(encode({"type": "pong", "payload": payload}))
+        elif msg_type == "file_credit":
+            self.upload_credit += payload
+            self.credit_added.set()
+        elif msg_type == "call_incoming":
+            self.call_partner = payload
+            self.writer.write(encode({"type": "call_accept", "payload": payload}))
+        elif msg_type == "call_started":
+            self.call_partner = payload
+            self.call_started.set()
+            if not self.is_caller and self.voice_task is None:
+                # Callee streams back so the server learns its UDP address
+                self.voice_task = asyncio.create_task(self.voice_loop())
+        elif msg_type == "error":
+            if "Rate limit" in str(payload) or "busy" in str(payload):
+                self.stats.rate_limited += 1
+            else:
+                self.stats.errors += 1
+
+    async def message_loop(self):
+        padding = "x" * max(0, self.config['message_size'] - 32)
+        rate = self.config['message_rate']
+        while True:
+            await asyncio.sleep(self.rng.expovariate(rate))
+            payload = f"{PAYLOAD_MARKER}{time.monotonic_ns()}|{self.index}|{padding}"
+            self.writer.write(encode({"type": "message", "payload": payload}))
+            self.stats.messages_sent += 1
+
+    async def file_loop(self):
+        size = self.config['file_size']
+        body = self.rng.randbytes(size)
+        rate = self.config['file_rate']
+        chunk_size = protocol.MAX_FILE_CHUNK // 4
+        for transfer_id in itertools.count(1):
+            await asyncio.sleep(self.rng.expovariate(rate))
+            self.writer.write(encode({
+                "type": "file_transfer",
+                "filename": f"load-{self.index}.bin",
+                "filesize": size,
+                "target": None,
+                "transfer_id": transfer_id
+            }))
+            # Chunks follow the header straight away, within the server's credit
+            for offset in range(0, size, chunk_size):
+                chunk = body[offset:offset + chunk_size]
+                while self.upload_credit < len(chunk):
+                    self.credit_added.clear()
+                    await self.credit_added.wait()
+                self.upload_credit -= len(chunk)
+                self.writer.write(protocol.encode_file_chunk(transfer_id, chunk))
+            await self.writer.drain()
+            self.stats.files_sent += 1
+            self.stats.file_bytes_sent += size
+
+    async def call(self, target):
+        self.writer.write(encode({"type": "call_request", "payload": target}))
+        await self.call_started.wait()
+        self.stats.calls_started += 1
+        await self.voice_loop()
+
+    async def voice_loop(self):
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: VoiceProtocol(self.stats), remote_addr=(self.config['host'], self.config['udp_port']))
+        name = self.username.encode('utf-8')
+        header = struct.pack('>H', len(name)) + name
+        frame = header + bytes(VOICE_FRAME_BYTES)
+        try:
+            while True:
+                transport.sendto(frame)
+                self.stats.voice_packets_sent += 1
+                await asyncio.sleep(VOICE_FRAME_INTERVAL)
+        finally:
+            transport.close()
+
+
+class ServerSampler:
+    """Samples server RSS and CPU from /proc (or psutil when installed)"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.rss_samples = []
+        self.cpu_samples = []
+
+    def read(self):
+        """Return (rss bytes, cpu seconds) or None"""
+        try:
+            import psutil
+            proc = psutil.Process(self.pid)
+            times = proc.cpu_times()
+            return proc.memory_info().rss, times.user + times.system
+        except ImportError:
+            pass
+        except Exception:
+            return None
+
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            ticks = os.sysconf('SC_CLK_TCK')
+            cpu = (int(fields[11]) + int(fields[12])) / ticks
+            rss = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+            return rss, cpu
+        except (OSError, ValueError, IndexError):
+            return None
+
+    async def run(self, interval=1.0):
+        last = self.read()
+        last_time = time.monotonic()
+        while last is not None:
+            await asyncio.sleep(interval)
+            sample = self.read()
+            now = time.monotonic()
+            if sample is None:
+                return
+            self.rss_samples.append(sample[0])
+            self.cpu_samples.append(100.0 * (sample[1] - last[1]) / (now - last_time))
+            last, last_time = sample, now
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def raise_fd_limit():
+    """Thousands of clients need thousands of file descriptors"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+async def run_scenario(config, server_pid=None):
+    """Run one scenario and return its report dict"""
+    stats = Stats()
+    rng = random.Random(config['seed'])
+    rooms = assign_rooms(config['clients'], config['rooms'], config['room_distribution'], rng)
+
+    phase = Phase()
+    clients = [
+        SyntheticClient(i, config, stats, room_name(rooms[i]), phase)
+        for i in range(config['clients'])
+    ]
+
+    sampler = ServerSampler(server_pid) if server_pid else None
+    sampler_task = asyncio.create_task(sampler.run()) if sampler else None
+
+    # Callers are the even clients of the first pairs, callees the odd ones
+    ramp_start = time.monotonic()
+    tasks = []
+    for i, client in enumerate(clients):
+        call_target = None
+        if i % 2 == 0 and i // 2 < config['calls'] and i + 1 < len(clients):
+            call_target = clients[i + 1].username
+        tasks.append(asyncio.create_task(client.run(call_target)))
+        await asyncio.sleep(1.0 / config.get('connect_rate', CONNECT_RATE))
+
+    # Wait for every login to finish (login storms are part of the ramp, not
+    # of the measurement), then let the presence broadcasts settle
+    while stats.connected + stats.login_failures < len(clients):
+        await asyncio.sleep(0.1)
+    ramp_seconds = time.monotonic() - ramp_start
+    await asyncio.sleep(1.0)
+
+    # Measure steady state only
+    if sampler:
+        sampler.rss_samples.clear()
+        sampler.cpu_samples.clear()
+    steady_start = time.monotonic()
+    phase.steady.set()
+    await asyncio.sleep(config['duration'])
+    phase.finished.set()
+    elapsed = time.monotonic() - steady_start
+
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    if sampler_task:
+        sampler_task.cancel()
+
+    latencies = sorted(stats.latencies_ns)
+    report = {
+        "scenario": config['name'],
+        "config": {k: v for k, v in config.items() if k not in ('host', 'user_prefix')},
+        "clients_connected": stats.connected,
+        "login_failures": stats.login_failures,
+        "busy_rejections": stats.busy_rejections,
+        "disconnects": stats.disconnects,
+        "ramp_seconds": ramp_seconds,
+        "messages_per_sec": stats.messages_sent / elapsed,
+        "deliveries_per_sec": stats.deliveries / elapsed,
+        "latency_samples": len(latencies),
+        "latency_p50_ms": percentile(latencies, 50) / 1e6,
+        "latency_p99_ms": percentile(latencies, 99) / 1e6,
+        "latency_p999_ms": percentile(latencies, 99.9) / 1e6,
+        "latency_max_ms": (latencies[-1] / 1e6) if latencies else 0.0,
+        "rate_limited": stats.rate_limited,
+        "errors": stats.errors,
+        "files_sent": stats.files_sent,
+        "file_mb_sent": stats.file_bytes_sent / 1e6,
+        "files_received": stats.files_received,
+        "file_mb_received": stats.file_bytes_received / 1e6,
+        "calls_started": stats.calls_started,
+        "voice_packets_sent": stats.voice_packets_sent,
+        "voice_packets_received": stats.voice_packets_received
+    }
+    if sampler and sampler.rss_samples:
+        report["server_rss_max_mb"] = max(sampler.rss_samples) / 1e6
+        report["server_cpu_avg_pct"] = sum(sampler.cpu_samples) / len(sampler.cpu_samples)
+        report["server_cpu_max_pct"] = max(sampler.cpu_samples)
+    return report
+
+
+def print_report(report):
+    print("=" * 50)
+    print(f"Scenario: {report['scenario']}")
+    print("=" * 50)
+    for key, value in report.items():
+        if key in ("scenario", "config"):
+            continue
+        if isinstance(value, float):
+            print(f"  {key:<26} {value:,.2f}")
+        else:
+            print(f"  {key:<26} {value:,}")
+
+
+def compare_to_baseline(reports, baseline, tolerance):
+    """Print regressions against a baseline report file, return True if any"""
+    by_name = {r['scenario']: r for r in baseline}
+    regressed = False
+    for report in reports:
+        base = by_name.get(report['scenario'])
+        if not base:
+            continue
+        for field, higher_is_better in REGRESSION_FIELDS:
+            if field not in report or not base.get(field):
+                continue
+            change = (report[field] - base[field]) / base[field]
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                regressed = True
+                print(f"[REGRESSION] {report['scenario']}.{field}: {base[field]:.2f} -> {report[field]:.2f} ({change:+.0%})")
+    return regressed
+
+
+def spawn_server(host, port, udp_port):
+    """Start server.py from this directory on the given ports and wait until it accepts connections.
+
+    The browser gateway and the metrics endpoint are left off, so a server
+    already running on this machine does not get in the way.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+    command = [sys.executable, path, '--host', host, '--port', str(port), '--udp-port', str(udp_port),
+               '--no-web', '--no-metrics']
+    proc = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection((host, port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("Server did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator and benchmark for the chat server")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--udp-port', type=int, default=UDP_PORT)
+    parser.add_argument('--scenario', nargs='+', default=['smoke'], choices=sorted(SCENARIOS) + ['all'])
+    parser.add_argument('--clients', type=int)
+    parser.add_argument('--rooms', type=int)
+    parser.add_argument('--room-distribution', choices=['uniform', 'zipf'])
+    parser.add_argument('--message-rate', type=float, help="Messages per second per client")
+    parser.add_argument('--message-size', type=int, help="Chat payload size in bytes")
+    parser.add_argument('--file-size', type=int, help="Bytes per file transfer")
+    parser.add_argument('--file-rate', type=float, help="File transfers per second per client")
+    parser.add_argument('--calls', type=int, help="Concurrent voice calls (client pairs)")
+    parser.add_argument('--duration', type=float, help="Steady-state seconds after ramp-up")
+    parser.add_argument('--connect-rate', type=float,
+                        help=f"New connections per second during ramp-up (default {CONNECT_RATE:g})")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--server-pid', type=int, help="Sample RSS/CPU of this server process")
+    parser.add_argument('--spawn-server', action='store_true', help="Start a fresh server.py for each scenario")
+    parser.add_argument('--output', help="Write the reports as JSON to this file")
+    parser.add_argument('--baseline', help="Compare against a previous --output file")
+    parser.add_argument('--tolerance', type=float, default=0.15, help="Allowed relative change before a regression")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+
+    names = sorted(SCENARIOS) if 'all' in args.scenario else args.scenario
+    reports = []
+    for run, name in enumerate(names):
+        config = dict(SCENARIOS[name])
+        for key in ('clients', 'rooms', 'room_distribution', 'message_rate', 'message_size',
+                    'file_size', 'file_rate', 'calls', 'duration', 'connect_rate'):
+            value = getattr(args, key)
+            if value is not None:
+                config[key] = value
+        config.update({
+            'name': name,
+            'host': args.host,
+            'port': args.port,
+            'udp_port': args.udp_port,
+            'seed': args.seed,
+            'user_prefix': f"lt{os.getpid()}r{run}u"
+        })
+
+        server = spawn_server(args.host, args.port, args.udp_port) if args.spawn_server else None
+        try:
+            pid = server.pid if server else args.server_pid
+            report = asyncio.run(run_scenario(config, pid))
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+
+        print_report(report)
+        reports.append(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare_to_baseline(reports, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+# metrics.py
+# Lightweight in-process metrics for the chat server, exposed in Prometheus
+# text format on a local HTTP endpoint.
+# Counters and histograms are plain Python objects updated in place; values
+# that are cheap to read on demand (connection counts, queue depths) are
+# registered as callbacks and only computed when the endpoint is scraped.
+
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Every metric registers itself here in creation order
+REGISTRY = []
+
+# Default histogram buckets in seconds
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# Lock timing is measured on one acquisition out of this many
+LOCK_SAMPLE_EVERY = 8
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{escape_label(value)}"' for key, value in labels)
+    return "{" + pairs + "}"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    """Monotonically increasing value, optionally split by one label"""
+
+    def __init__(self, name, help_text, label=None):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.value = 0
+        self.children = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def total(self):
+        """Value summed over all label values"""
+        return self.value + sum(child.value for child in list(self.children.values()))
+
+    def labels(self, value):
+        """Get the child counter for one label value"""
+        child = self.children.get(value)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(value, _ChildCounter())
+        return child
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        if self.label is None:
+            lines.append(f"{self.name} {self.value}")
+        else:
+            for value, child in sorted(self.children.items()):
+                lines.append(f"{self.name}{format_labels([(self.label, value)])} {child.value}")
+        return lines
+
+
+class _ChildCounter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Gauge:
+    """Value that goes up and down, or is read from a callback at scrape time"""
+
+    def __init__(self, name, help_text, func=None):
+        self.name = name
+        self.help = help_text
+        self.func = func
+        self.value = 0
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def collect(self):
+        value = self.func() if self.func else self.value
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+class LabeledGauge:
+    """Gauge series produced by a callback returning [(label value, value), ...]"""
+
+    def __init__(self, name, help_text, label, func):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.func = func
+        REGISTRY.append(self)
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for label_value, value in self.func():
+            lines.append(f"{self.name}{format_labels([(self.label, label_value)])} {value}")
+        return lines
+
+
+class Histogram:
+    """Distribution of observed values in fixed cumulative buckets"""
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = 0
+        for bound, bucket_count in zip(self.bounds, counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {count}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {count}")
+        return lines
+
+
+class InstrumentedLock:
+    """threading.Lock that samples how long callers wait for it and hold it"""
+
+    def __init__(self, name):
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._acquired_at = None
+        self.wait_time = Histogram(f"chat_{name}_wait_seconds", f"Time spent waiting to acquire {name} (sampled)")
+        self.hold_time = Histogram(f"chat_{name}_hold_seconds", f"Time {name} is held (sampled)")
+
+    def __enter__(self):
+        # The counter is only used to pick samples, so races on it are harmless
+        self._calls += 1
+        if self._calls % LOCK_SAMPLE_EVERY:
+            self._lock.acquire()
+            return self
+
+        start = time.perf_counter()
+        self._lock.acquire()
+        self._acquired_at = time.perf_counter()
+        self.wait_time.observe(self._acquired_at - start)
+        return self
+
+    def __exit__(self, *exc_info):
+        acquired_at = self._acquired_at
+        if acquired_at is not None:
+            self._acquired_at = None
+            self.hold_time.observe(time.perf_counter() - acquired_at)
+        self._lock.release()
+
+    def acquire(self, *args, **kwargs):
+        return self._lock.acquire(*args, **kwargs)
+
+    def release(self):
+        self._lock.release()
+
+
+def render():
+    """Render every registered metric in Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a log line each
+        pass
+
+
+def start_metrics_server(host, port):
+    """Serve /metrics from a daemon thread, return the HTTP server"""
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd
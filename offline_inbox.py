@@ -0,0 +1,126 @@
+# offline_inbox.py
+# Durable store-and-forward inbox for private messages to offline users.
+# Messages live in a SQLite database (WAL mode) indexed by (recipient, id),
+# so storing, fetching a batch and trimming acknowledged messages touch only
+# the recipient's own rows, however many messages are queued in total.
+# Each inbox is capped at INBOX_MAX_MESSAGES and messages expire after
+# INBOX_TTL. Only users that have logged in within USER_TTL can receive
+# offline messages, so typos and made-up names do not fill the store.
+
+import os
+import sqlite3
+import threading
+import time
+
+INBOX_FILE = os.path.join('data', 'inbox.sqlite3')
+INBOX_MAX_MESSAGES = 1000          # Queued messages per recipient
+INBOX_TTL = 7 * 24 * 3600          # Seconds a queued message is kept
+USER_TTL = 30 * 24 * 3600          # Seconds a user stays known after their last login
+PURGE_BATCH = 10000                # Rows deleted per statement when purging
+
+# Results of OfflineInbox.store
+STORED = "stored"
+UNKNOWN_USER = "unknown"
+INBOX_FULL = "full"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    last_login REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS inbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipient TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS inbox_recipient ON inbox (recipient, id);
+CREATE INDEX IF NOT EXISTS inbox_created ON inbox (created);
+"""
+
+
+class OfflineInbox:
+    """Per-user offline message queues in one SQLite database, safe to share between threads"""
+
+    def __init__(self, path=INBOX_FILE, max_messages=INBOX_MAX_MESSAGES, ttl=INBOX_TTL, user_ttl=USER_TTL):
+        if path != ':memory:':
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        self.max_messages = max_messages
+        self.ttl = ttl
+        self.user_ttl = user_ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def remember_user(self, username):
+        """Record a login, making the user eligible for offline messages"""
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO users (username, last_login) VALUES (?, ?) "
+                "ON CONFLICT (username) DO UPDATE SET last_login = excluded.last_login",
+                (username, time.time())
+            )
+
+    def store(self, recipient, sender, payload):
+        """Queue a message, return STORED, UNKNOWN_USER or INBOX_FULL"""
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT last_login FROM users WHERE username = ?", (recipient,)).fetchone()
+            if row is None or row[0] < now - self.user_ttl:
+                return UNKNOWN_USER
+
+            # Bounded by max_messages, counted on the recipient index only
+            count = self.db.execute(
+                "SELECT COUNT(*) FROM inbox WHERE recipient = ? AND created >= ?", (recipient, now - self.ttl)
+            ).fetchone()[0]
+            if count >= self.max_messages:
+                return INBOX_FULL
+
+            self.db.execute(
+                "INSERT INTO inbox (recipient, sender, payload, created) VALUES (?, ?, ?, ?)",
+                (recipient, sender, payload, now)
+            )
+        return STORED
+
+    def fetch(self, recipient, limit, after_id=0):
+        """Oldest unexpired messages for recipient after after_id, as dicts"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, sender, payload, created FROM inbox "
+                "WHERE recipient = ? AND id > ? AND created >= ? ORDER BY id LIMIT ?",
+                (recipient, after_id, time.time() - self.ttl, limit)
+            ).fetchall()
+        return [{"id": row[0], "sender": row[1], "payload": row[2], "ts": row[3]} for row in rows]
+
+    def ack(self, recipient, last_id):
+        """Remove recipient's messages up to and including last_id, return how many"""
+        with self.lock:
+            cursor = self.db.execute("DELETE FROM inbox WHERE recipient = ? AND id <= ?", (recipient, last_id))
+        return cursor.rowcount
+
+    def purge_expired(self):
+        """Delete expired messages and forgotten users in small batches, return messages deleted"""
+        deleted = 0
+        now = time.time()
+        while True:
+            # Batches keep the lock short, so logins and stores are not held up
+            with self.lock:
+                cursor = self.db.execute(
+                    "DELETE FROM inbox WHERE id IN (SELECT id FROM inbox WHERE created < ? LIMIT ?)",
+                    (now - self.ttl, PURGE_BATCH)
+                )
+            deleted += cursor.rowcount
+            if cursor.rowcount < PURGE_BATCH:
+                break
+        with self.lock:
+            self.db.execute("DELETE FROM users WHERE last_login < ?", (now - self.user_ttl,))
+        return deleted
+
+    def close(self):
+        with self.lock:
+            self.db.close()
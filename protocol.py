@@ -0,0 +1,316 @@
+# protocol.py
+# Wire codec for the chat protocol: newline-terminated JSON frames.
+# Uses orjson or msgspec when one is installed and falls back to the standard
+# json module otherwise. Messages from clients are checked against
+# MESSAGE_SCHEMAS while they are decoded, so handlers can rely on field types.
+#
+# Set CHAT_CODEC=json|orjson|msgspec to force a backend.
+#
+# Connections that negotiated COMPRESSION_FEATURE at login may also carry
+# compressed frames: a 0x00 marker, the 4-byte big-endian length of the
+# compressed data, then a raw deflate stream (primed with ZDICT) holding one
+# ordinary newline-terminated JSON frame. Each frame is compressed on its own,
+# so one compressed broadcast can be sent to every recipient.
+#
+# File uploads announced with a transfer_id send their data as chunk frames
+# between the JSON frames: a 0x01 marker, the 4-byte transfer id and the
+# 4-byte length, then the raw bytes. The server hands out byte credits
+# (file_credit) so the client never has more than a window in flight.
+#
+# Connections that negotiated FILE_COMPRESSION_FEATURE may send and receive
+# file data as one raw deflate stream ("encoding": FILE_ENCODING in the
+# header); filesize stays the size of the file itself.
+#
+# Connections that negotiated FILE_CHUNKS_FEATURE receive files as chunk
+# frames too: the file_incoming header carries a transfer_id and the length
+# of the data, which follows in chunk frames for that id with other frames
+# in between. Otherwise the 4-byte length and the data follow the header
+# directly.
+
+import json
+import os
+import struct
+import typing
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+class ProtocolError(ValueError):
+    """Frame is not valid JSON or does not match its message schema"""
+
+
+# Field specs: the exact types a field may have. Fields whose spec includes
+# NoneType may be missing or null; fields not listed are not checked.
+STR = (str,)
+INT = (int,)
+OPTIONAL_INT = (int, type(None))
+OPTIONAL_STR = (str, type(None))
+LIST = (list,)
+OPTIONAL_LIST = (list, type(None))
+ANY = None
+
+# Messages clients send to the server: {type: {field: spec}}
+MESSAGE_SCHEMAS = {
+    "login": {"payload": STR, "features": OPTIONAL_LIST},
+    "resume": {"payload": STR, "last_seq": INT},
+    "logout": {"payload": ANY},
+    "ping": {"payload": ANY},
+    "pong": {"payload": ANY},
+    "message": {"payload": STR},
+    "private_message": {"target": STR, "payload": STR},
+    "join_room": {"payload": OPTIONAL_STR},
+    "list_rooms": {"payload": ANY},
+    "call_request": {"payload": STR},
+    "call_accept": {"payload": STR},
+    "call_reject": {"payload": STR},
+    "call_end": {"payload": ANY},
+    "file_transfer": {"filename": STR, "filesize": INT, "target": OPTIONAL_STR, "transfer_id": OPTIONAL_INT,
+                      "group": OPTIONAL_STR, "encoding": OPTIONAL_STR},
+    "file_group": {"group": STR, "count": INT, "filesize": INT, "target": OPTIONAL_STR},
+    "file_group_end": {"group": STR},
+    "inbox_ack": {"payload": INT},
+    "ack": {"room": STR, "payload": INT},
+    "resend": {"room": STR, "payload": LIST}
+}
+
+
+def check_message(message, msg_type):
+    """Check a decoded message against MESSAGE_SCHEMAS (unknown types pass)"""
+    schema = MESSAGE_SCHEMAS.get(msg_type)
+    if schema is None:
+        return
+    for field, spec in schema.items():
+        if spec is None:
+            continue
+        value = message.get(field)
+        # Exact type check, so True is not accepted as a file size
+        if type(value) not in spec:
+            raise ProtocolError(f"Invalid '{field}' for {msg_type} message")
+
+
+class JsonCodec:
+    """Standard library json"""
+
+    name = "json"
+
+    def encode(self, message):
+        return (json.dumps(message) + "\n").encode('utf-8')
+
+    def loads(self, data):
+        try:
+            return json.loads(data)
+        except ValueError as e:
+            raise ProtocolError(f"Invalid JSON: {e}") from None
+
+    def decode(self, data, validate=True):
+        """Decode one frame (without its newline) into a message dict"""
+        message = self.loads(data)
+        if not isinstance(message, dict):
+            raise ProtocolError("Message must be a JSON object")
+        msg_type = message.get("type")
+        if not isinstance(msg_type, str):
+            raise ProtocolError("Message type must be a string")
+        if validate:
+            self.check(message, msg_type)
+        return message
+
+    def check(self, message, msg_type):
+        check_message(message, msg_type)
+
+
+class OrjsonCodec(JsonCodec):
+    """orjson, validated with the schema table"""
+
+    name = "orjson"
+
+    def encode(self, message):
+        return orjson.dumps(message, option=orjson.OPT_APPEND_NEWLINE)
+
+    def loads(self, data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError as e:
+            raise ProtocolError(f"Invalid JSON: {e}") from None
+
+
+class MsgspecCodec(JsonCodec):
+    """msgspec, validated by converting into typed message structs"""
+
+    name = "msgspec"
+
+    def __init__(self):
+        self.encoder = msgspec.json.Encoder()
+        self.decoder = msgspec.json.Decoder()
+        self.structs = {msg_type: self.make_struct(msg_type, schema) for msg_type, schema in MESSAGE_SCHEMAS.items()}
+
+    @staticmethod
+    def make_struct(msg_type, schema):
+        fields = []
+        for field, spec in schema.items():
+            if spec is None:
+                fields.append((field, typing.Any, None))
+            elif type(None) in spec:
+                types = [t for t in spec if t is not type(None)]
+                fields.append((field, types[0] | None, None))
+            else:
+                fields.append((field, spec[0]))
+        # Required fields have to come first
+        fields.sort(key=len)
+        return msgspec.defstruct(f"{msg_type.title().replace('_', '')}Message", fields)
+
+    def encode(self, message):
+        return self.encoder.encode(message) + b"\n"
+
+    def loads(self, data):
+        try:
+            return self.decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise ProtocolError(f"Invalid JSON: {e}") from None
+
+    def check(self, message, msg_type):
+        struct = self.structs.get(msg_type)
+        if struct is None:
+            return
+        try:
+            msgspec.convert(message, struct, strict=True)
+        except msgspec.ValidationError as e:
+            raise ProtocolError(f"Invalid {msg_type} message: {e}") from None
+
+
+# Installed backends, fastest first
+AVAILABLE_CODECS = {}
+if orjson is not None:
+    AVAILABLE_CODECS["orjson"] = OrjsonCodec
+if msgspec is not None:
+    AVAILABLE_CODECS["msgspec"] = MsgspecCodec
+AVAILABLE_CODECS["json"] = JsonCodec
+
+
+def get_codec(name=None):
+    """Codec by name, or the preferred installed one"""
+    if name is None:
+        name = os.environ.get("CHAT_CODEC") or next(iter(AVAILABLE_CODECS))
+    if name not in AVAILABLE_CODECS:
+        raise ValueError(f"Codec '{name}' is not available (installed: {', '.join(AVAILABLE_CODECS)})")
+    return AVAILABLE_CODECS[name]()
+
+
+codec = get_codec()
+encode = codec.encode
+decode = codec.decode
+
+
+# Compression, negotiated by listing the feature in login/login_success
+COMPRESSION_FEATURE = "deflate-v1"
+COMPRESSED_MARKER = 0
+COMPRESS_MIN_BYTES = 256         # Smaller frames are sent as they are
+COMPRESS_LEVEL = 6
+FILE_COMPRESSION_FEATURE = "file-deflate-v1"
+FILE_ENCODING = "deflate"
+FILE_CHUNKS_FEATURE = "file-chunks-v1"
+SERVER_FEATURES = (COMPRESSION_FEATURE, FILE_COMPRESSION_FEATURE, FILE_CHUNKS_FEATURE)
+MAX_FRAME_BYTES = 1024 * 1024    # Longest frame accepted, compressed or not
+
+# Samples of typical frames; their canonical encoding primes the deflate
+# window on both ends. Changing them requires a new COMPRESSION_FEATURE.
+ZDICT_SAMPLES = [
+    {"type": "room_list", "payload": {"lobby": ["alice", "bob"], "general": ["carol"]}},
+    {"type": "room_info", "payload": {"room": "lobby", "members": ["alice", "bob", "carol"]}},
+    {"type": "user_list", "payload": ["alice", "bob", "carol", "dave", "user1", "user2"]},
+    {"type": "notification", "payload": "alice joined the chat!"},
+    {"type": "notification", "payload": "bob left the room"},
+    {"type": "private_message", "sender": "alice", "payload": "Thanks, see you there"},
+    {"type": "private_sent", "target": "bob", "payload": "Thanks, see you there"},
+    {"type": "error", "payload": "Rate limit exceeded, request dropped"},
+    {"type": "message", "sender": "alice", "room": "lobby", "payload": "Hello everyone, is the meeting still on for today? https://"},
+]
+ZDICT = b"".join(
+    (json.dumps(sample, separators=(",", ":")) + "\n").encode('utf-8') for sample in ZDICT_SAMPLES
+)
+
+
+def compress_frame(frame):
+    """Compressed form of an encoded frame, or the frame itself if too small to gain"""
+    if len(frame) < COMPRESS_MIN_BYTES:
+        return frame
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15, zdict=ZDICT)
+    data = compressor.compress(frame) + compressor.flush()
+    if len(data) + 5 >= len(frame):
+        return frame
+    return struct.pack('>BI', COMPRESSED_MARKER, len(data)) + data
+
+
+def decompress_frame(data):
+    """Inflate the body of a compressed frame back into the encoded frame"""
+    decompressor = zlib.decompressobj(-15, zdict=ZDICT)
+    try:
+        frame = decompressor.decompress(data, MAX_FRAME_BYTES)
+    except zlib.error as e:
+        raise ProtocolError(f"Invalid compressed frame: {e}") from None
+    if decompressor.unconsumed_tail:
+        raise ProtocolError("Compressed frame too long")
+    return frame
+
+
+def pop_frame(buffer):
+    """Remove the next complete frame from a bytearray and return it without its newline.
+
+    Handles both plain and compressed frames. Returns None when buffer does
+    not hold a complete frame yet and raises ProtocolError when the frame
+    is longer than MAX_FRAME_BYTES.
+    """
+    if buffer and buffer[0] == COMPRESSED_MARKER:
+        if len(buffer) < 5:
+            return None
+        length = struct.unpack_from('>I', buffer, 1)[0]
+        if length > MAX_FRAME_BYTES:
+            raise ProtocolError("Compressed frame too long")
+        if len(buffer) < 5 + length:
+            return None
+        data = bytes(buffer[5:5 + length])
+        del buffer[:5 + length]
+        return decompress_frame(data).rstrip(b"\n")
+
+    newline = buffer.find(b"\n")
+    if newline < 0:
+        if len(buffer) > MAX_FRAME_BYTES:
+            raise ProtocolError("Frame too long")
+        return None
+    line = bytes(buffer[:newline])
+    del buffer[:newline + 1]
+    return line
+
+
+# File data of chunked uploads, and of downloads with FILE_CHUNKS_FEATURE
+FILE_CHUNK_MARKER = 1
+MAX_FILE_CHUNK = 256 * 1024
+FILE_CHUNK_HEADER = struct.Struct('>BII')
+
+
+def encode_file_chunk(transfer_id, data):
+    """Frame one piece of a file's data"""
+    return FILE_CHUNK_HEADER.pack(FILE_CHUNK_MARKER, transfer_id, len(data)) + data
+
+
+def pop_file_chunk(buffer):
+    """Remove the file chunk frame at the start of buffer, return (transfer_id, data) or None if incomplete"""
+    if len(buffer) < FILE_CHUNK_HEADER.size:
+        return None
+    _, transfer_id, length = FILE_CHUNK_HEADER.unpack_from(buffer)
+    if length > MAX_FILE_CHUNK:
+        raise ProtocolError("File chunk too long")
+    end = FILE_CHUNK_HEADER.size + length
+    if len(buffer) < end:
+        return None
+    data = bytes(buffer[FILE_CHUNK_HEADER.size:end])
+    del buffer[:end]
+    return transfer_id, data
@@ -1,221 +1,1761 @@
+import argparse
 import socket
 import threading
-import json
 import os
 import struct
+import time
+import heapq
+import itertools
+import math
+import queue
+import random
+import secrets
+import sys
+import zlib
+from collections import deque
+
+try:
+    import fcntl
+    import termios
+except ImportError:
+    # Windows; sessions there are kept alive by inbound traffic alone
+    fcntl = termios = None
+
+import metrics
+import bot_api
+import chat_logging
+import offline_inbox
+import protocol
+import transport
+import ws_gateway
 
 # Server configuration
 HOST = '0.0.0.0'
 PORT = 5555
 UDP_PORT = 5556  # UDP port for voice data
+# Further listeners besides plain TCP on HOST:PORT, as transport URLs, e.g.
+# unix:///run/chat.sock or tls://0.0.0.0:5557 (TLS needs TLS_CERTFILE)
+LISTEN_URLS = []
+TLS_CERTFILE = None
+TLS_KEYFILE = None  # None when the key is in TLS_CERTFILE
+# WebSocket gateway serving the chat pages and /ws to browsers (https and
+# wss when TLS_CERTFILE is set); WEB_PORT None turns it off
+WEB_HOST = '0.0.0.0'
+WEB_PORT = 8000
+# Local HTTP endpoint for bots posting messages in bulk, only started when
+# bots are configured: CHAT_BOT_TOKENS="name=token,name=token"
+BOT_API_HOST = '127.0.0.1'
+BOT_API_PORT = 9200
+BOT_TOKENS = bot_api.parse_tokens(os.environ.get("CHAT_BOT_TOKENS", ""))  # {token: bot name}
 
-# Dictionary to keep track of all connected clients: {username: {'socket': socket, 'room': room_name, 'udp_addr': (ip, port)}}
+# Shared state and its locks. No lock is held while sending, and apart from
+# the documented orderings no lock is taken while another one is held:
+#   clients_lock   guards the clients dict (lookups, login, logout, snapshots)
+#   rooms_lock     guards the rooms dict; may be followed by one room.lock
+#   room.lock      guards one room's members; readers use the room's snapshots
+#   room.order_lock  held while a room broadcast is numbered and queued, so
+#                  members receive room messages in seq order; may be
+#                  followed by room.lock and outbox locks
+#   session lock   guards one session's call_partner, inbox_sent, online,
+#                  socket and detached_at; two session locks are always taken
+#                  in username order; may be followed by the inbox's lock and
+#                  the session's outbox lock
+# A session's room and udp_addr are only written by the thread that owns them
+# (its handler thread and the UDP relay respectively).
+
+# Dictionary to keep track of all logged-in clients, including ones waiting
+# to resume: {username: Session}
 clients = {}
-clients_lock = threading.Lock()
+clients_lock = metrics.InstrumentedLock('clients_lock')
+
+# Resume tokens handed out at login: {token: Session}, guarded by clients_lock
+resume_tokens = {}
 
-# Dictionary to track active calls: {caller: callee}
-active_calls = {}
-calls_lock = threading.Lock()
+# Dictionary of non-empty rooms: {room_name: Room}
+rooms = {}
+rooms_lock = threading.Lock()
+
+# Admitted connections and the ones of them not logged in yet, guarded by
+# admission_lock; accept_bucket limits the accept rate while serving
+open_connections = 0
+pending_logins = 0
+admission_lock = threading.Lock()
+accept_bucket = None
+
+# Small integer IDs for sessions, used internally instead of names; rooms
+# are referred to by their Room object
+session_ids = itertools.count(1)
+download_ids = itertools.count(1)  # transfer_id of files sent in chunk frames
+
+log = chat_logging.get_logger("server")
 
 # Default room for new users
 DEFAULT_ROOM = "lobby"
 
-# UDP socket for voice data
+# Listening sockets and the event that stops the background threads,
+# set up by open_server and torn down by stop_server
+server_socket = None
 udp_socket = None
+listeners = []  # transport.Listener for each of LISTEN_URLS
+web_gateway = None
+bot_server = None
+bot_buckets = {}  # {bot name: TokenBucket}, made by open_server
+fanout_queues = None  # One queue per fan-out worker while the server runs
+stop_event = None
+metrics_server = None
+inbox = None  # offline_inbox.OfflineInbox, opened by open_server
 
+# Outbound priority classes, lower values are sent first
+PRIORITY_SIGNAL = 0  # Call signalling and session control
+PRIORITY_CHAT = 1    # Chat, private messages and presence
+PRIORITY_BULK = 2    # File data
 
-def send_json(client_socket, message_dict):
-    """Send JSON message to a client"""
+MAX_OUTBOX_ITEMS = 1000        # Queued items per client before chat/bulk is dropped
+WRITER_IDLE_TIMEOUT = 5.0      # Seconds an idle writer thread lingers before exiting
+MAX_COALESCE_BYTES = 64 * 1024 # Small frames are written together with one send up to this size
+MAX_SEND_BUFFERS = 512         # Buffers passed to one sendmsg (IOV_MAX is 1024 on Linux)
+FILE_CHUNK_SIZE = 64 * 1024
+RECV_SIZE = 64 * 1024          # Bytes read from a client socket at a time
+
+# Chunked uploads: a client may have FILE_UPLOAD_WINDOW bytes of file data in
+# flight; consumed bytes are credited back in batches of UPLOAD_CREDIT_BATCH
+FILE_UPLOAD_WINDOW = 1024 * 1024
+UPLOAD_CREDIT_BATCH = 256 * 1024
+MAX_ACTIVE_UPLOADS = 8         # Uploads one client may have in progress at once
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024          # Largest file accepted, as in the UI
+MAX_PENDING_UPLOAD_BYTES = 4 * MAX_UPLOAD_BYTES  # Bytes one client may have announced but not sent yet
+MAX_ACTIVE_GROUPS = 4          # File groups (batch uploads) one client may have open at once
+MAX_GROUP_FILES = 10000        # Files announced for one group at most
+
+# Rate limits as (tokens per second, burst)
+USER_MESSAGE_RATE = (10, 20)                                # Chat/private messages per user
+USER_CONTROL_RATE = (5, 20)                                 # Room and call requests per user
+ROOM_MESSAGE_RATE = (100, 200)                              # Chat messages per room
+USER_FILE_BYTE_RATE = (5 * 1024 * 1024, 20 * 1024 * 1024)   # File bytes per user
+BOT_MESSAGE_RATE = (10000, 20000)                           # Messages per bot, instead of the room limit
+
+# Rooms with this many members have their broadcasts queued on the members'
+# outboxes by the fan-out workers, so the sender's thread goes back to
+# reading right away. Each worker owns the members whose session id falls
+# in its shard, which keeps every member's room messages in order.
+FANOUT_POOL_THRESHOLD = 256
+FANOUT_WORKERS = 4
+
+# Inbound message types that are rate limited, mapped to the user's bucket
+RATE_LIMITED_MESSAGES = {
+    "message": 'message_bucket',
+    "private_message": 'message_bucket',
+    "join_room": 'control_bucket',
+    "list_rooms": 'control_bucket',
+    "call_request": 'control_bucket',
+    "call_accept": 'control_bucket',
+    "call_reject": 'control_bucket',
+    "resend": 'control_bucket'
+}
+
+# Admission control, so a reconnect storm cannot use up the server's threads.
+# A connection over these limits is closed right after accept with a
+# "server_busy" error whose retry_after (seconds, spread at random so the
+# clients do not all come back at once) the clients wait out. TLS
+# connections are closed without it, sparing the handshake. The WebSocket
+# gateway applies the same limits when it accepts a socket, answering
+# plaintext browsers with an HTTP 503.
+MAX_CONNECTIONS = 10000         # Open connections, logged in or not
+MAX_PENDING_LOGINS = 256        # Connections still in their TLS handshake or login
+ACCEPT_RATE = (500, 1000)       # New connections per second, and burst
+LOGIN_TIMEOUT = 10              # Seconds a new connection has to log in
+LISTEN_BACKLOG = socket.SOMAXCONN
+BUSY_RETRY_AFTER = 2            # Least retry_after given; up to twice that
+
+# Liveness: idle clients are pinged, silent ones are reaped (seconds)
+HEARTBEAT_INTERVAL = 15
+DEAD_PEER_TIMEOUT = 45
+KEEPALIVE_IDLE = 30      # TCP keepalive: idle time before the first probe
+KEEPALIVE_INTERVAL = 10  # TCP keepalive: time between probes
+KEEPALIVE_COUNT = 3      # TCP keepalive: failed probes before the kernel drops the connection
+
+# Session resumption: a dropped client may reconnect within RESUME_GRACE
+# seconds and keep its room and call; frames it missed are resent
+RESUME_GRACE = 30
+REPLAY_FRAMES = 200             # Frames kept per session for resending
+
+# Room messages are numbered per room; the last ROOM_HISTORY are kept so
+# clients can ask for the ones they missed
+ROOM_HISTORY = 500
+MAX_RESEND = 100                # Messages one resend request may ask for
+
+# Offline private messages
+INBOX_FILE = offline_inbox.INBOX_FILE
+INBOX_BATCH = 200               # Offline messages per delivery frame
+INBOX_PURGE_INTERVAL = 3600     # Seconds between removals of expired messages
+
+# Metrics endpoint, Prometheus text format on http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9100
+MAX_QUEUE_DEPTH_SERIES = 20  # Only the deepest client send queues are exported by name
+
+CONNECTIONS_ACCEPTED = metrics.Counter("chat_connections_accepted_total", "Connections accepted, any transport")
+CONNECTIONS_REJECTED = metrics.Counter("chat_connections_rejected_total", "Connections turned away by admission control",
+                                       label="reason")
+CONNECTIONS_OPEN = metrics.Gauge("chat_connections_open", "Admitted connections, logged in or not",
+                                 func=lambda: open_connections)
+LOGINS_PENDING = metrics.Gauge("chat_logins_pending", "Connections still in their TLS handshake or login",
+                               func=lambda: pending_logins)
+TLS_HANDSHAKES = metrics.Counter("chat_tls_handshakes_total", "Completed TLS handshakes")
+TLS_RESUMED = metrics.Counter("chat_tls_sessions_resumed_total", "TLS handshakes that resumed a session from a ticket")
+WEBSOCKET_CONNECTIONS = metrics.Counter("chat_websocket_connections_total", "Browser connections through the WebSocket gateway")
+ACTIVE_SESSIONS = metrics.Gauge("chat_sessions_active", "Logged-in sessions", func=lambda: len(clients))
+MESSAGES_RECEIVED = metrics.Counter("chat_messages_received_total", "Messages received from clients", label="type")
+RATE_LIMITED = metrics.Counter("chat_rate_limited_total", "Requests rejected by rate limits", label="type")
+BROADCAST_SECONDS = metrics.Histogram("chat_broadcast_fanout_seconds",
+                                      "Time the broadcasting thread spends queuing a broadcast (handing it over for pooled rooms)")
+FANOUT_POOLED = metrics.Counter("chat_fanout_pooled_total", "Room broadcasts handed to the fan-out workers")
+BROADCAST_RECIPIENTS = metrics.Histogram(
+    "chat_broadcast_recipients", "Recipients per broadcast", buckets=(1, 2, 5, 10, 50, 100, 500, 1000, 5000)
+)
+OUTBOX_DEPTH_TOTAL = metrics.Gauge("chat_outbox_depth_total", "Items queued across all client send queues",
+                                   func=lambda: outbox_depth_total())
+OUTBOX_DEPTH = metrics.LabeledGauge("chat_outbox_depth", "Items queued for the clients with the deepest send queues",
+                                    "user", lambda: deepest_outboxes())
+OUTBOX_DROPS = metrics.Counter("chat_outbox_dropped_total", "Frames dropped because a client send queue was full")
+SEND_ERRORS = metrics.Counter("chat_send_errors_total", "Socket errors while sending to clients")
+ROOM_MESSAGES_RESENT = metrics.Counter("chat_room_messages_resent_total", "Room messages resent on client request")
+ACK_LAG = metrics.LabeledGauge("chat_ack_lag", "Room messages not yet acknowledged by the clients furthest behind",
+                               "user", lambda: laggiest_acks())
+FILE_BYTES_RECEIVED = metrics.Counter("chat_file_bytes_received_total", "File bytes uploaded by clients")
+FILE_BYTES_RELAYED = metrics.Counter("chat_file_bytes_relayed_total", "File bytes queued to recipients")
+UDP_PACKETS_RECEIVED = metrics.Counter("chat_udp_packets_received_total", "Voice packets received")
+UDP_PACKETS_FORWARDED = metrics.Counter("chat_udp_packets_forwarded_total", "Voice packets forwarded to a call partner")
+UDP_PACKETS_DROPPED = metrics.Counter("chat_udp_packets_dropped_total", "Voice packets malformed or without a partner")
+VOICE_BYTES_RELAYED = metrics.Counter("chat_voice_bytes_relayed_total", "Voice payload bytes forwarded")
+PINGS_SENT = metrics.Counter("chat_pings_sent_total", "Heartbeat pings sent to idle clients")
+SESSIONS_REAPED = metrics.Counter("chat_sessions_reaped_total", "Sessions closed for missing heartbeats")
+SESSIONS_RESUMED = metrics.Counter("chat_sessions_resumed_total", "Sessions resumed by a reconnecting client")
+SESSIONS_EXPIRED = metrics.Counter("chat_sessions_expired_total", "Dropped sessions not resumed within the grace period")
+FRAMES_REPLAYED = metrics.Counter("chat_frames_replayed_total", "Frames resent to resumed sessions")
+BOT_MESSAGES = metrics.Counter("chat_bot_messages_total", "Messages posted through the bot API", label="bot")
+INBOX_STORED = metrics.Counter("chat_inbox_stored_total", "Private messages queued for offline users")
+INBOX_DELIVERED = metrics.Counter("chat_inbox_delivered_total", "Offline messages sent to their recipients")
+COMPRESSED_FRAMES = metrics.Counter("chat_compressed_frames_total", "Frames compressed (once per broadcast)")
+COMPRESSION_SAVED_BYTES = metrics.Counter("chat_compression_saved_bytes_total", "Bytes saved by compressing frames (once per broadcast)")
+FILE_COMPRESSION_SAVED_BYTES = metrics.Counter("chat_file_compression_saved_bytes_total", "Upload bytes saved by file compression")
+
+
+class TokenBucket:
+    """Token bucket refilled at rate tokens per second, holding at most burst"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp', 'lock')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def consume(self, amount=1):
+        """Take tokens if available, return False when over the limit"""
+        with self.lock:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return True
+            return False
+
+    def reserve(self, amount):
+        """Take tokens even if that goes into debt, return seconds to wait it off"""
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def wait_time(self):
+        """Seconds until the debt left by reserve is paid off, 0 if there is none"""
+        with self.lock:
+            self._refill()
+            return max(0.0, -self.tokens / self.rate)
+
+    def is_full(self):
+        with self.lock:
+            self._refill()
+            return self.tokens >= self.burst
+
+
+class Room:
+    """Members of one room behind the room's own lock.
+
+    Broadcasts and member lists read an immutable snapshot of the members,
+    rebuilt on first use after a membership change, without taking the lock
+    again. A room that became empty is closed and removed; add() on a closed
+    room fails and the caller looks the room up again.
+    """
+
+    __slots__ = (
+        'name', 'lock', 'members', 'snapshot', 'shard_cache', 'closed', 'bucket', 'order_lock', 'seq', 'history',
+        'fanout_pending'
+    )
+
+    def __init__(self, name):
+        self.name = sys.intern(name)
+        self.lock = threading.Lock()
+        self.members = {}     # {session id: Session}
+        self.snapshot = None  # Tuple of members, None when stale
+        self.shard_cache = None  # Members split by fan-out worker, None when stale
+        self.closed = False
+        self.bucket = TokenBucket(*ROOM_MESSAGE_RATE)
+        self.order_lock = threading.Lock()
+        self.seq = 0          # Number of the last room message
+        self.history = deque(maxlen=ROOM_HISTORY)  # Frames of the last room messages
+        self.fanout_pending = 0  # Fan-out worker jobs not done yet, guarded by lock
+
+    def add(self, session):
+        with self.lock:
+            if self.closed:
+                return False
+            self.members[session.id] = session
+            self.snapshot = self.shard_cache = None
+            return True
+
+    def remove(self, session):
+        """Remove a member, return True if the room is now empty"""
+        with self.lock:
+            self.members.pop(session.id, None)
+            self.snapshot = self.shard_cache = None
+            return not self.members
+
+    def sessions(self):
+        """Current members as a tuple that callers may use without locking"""
+        snapshot = self.snapshot
+        if snapshot is None:
+            with self.lock:
+                snapshot = self.snapshot = tuple(self.members.values())
+        return snapshot
+
+    def shards(self, count):
+        """Members split into count tuples by session id, cached like the snapshot"""
+        shards = self.shard_cache
+        if shards is None or len(shards) != count:
+            members = self.sessions()
+            split = [[] for _ in range(count)]
+            for session in members:
+                split[session.id % count].append(session)
+            shards = tuple(tuple(shard) for shard in split)
+            with self.lock:
+                # Not cached if the members changed meanwhile
+                if self.snapshot is members:
+                    self.shard_cache = shards
+        return shards
+
+    def member_names(self):
+        return [session.username for session in self.sessions()]
+
+    def recent(self, seqs):
+        """Frames of the given room messages still in history, and the seqs that are not"""
+        found, missing = [], []
+        with self.order_lock:
+            first = self.seq - len(self.history) + 1
+            for seq in seqs:
+                if first <= seq <= self.seq:
+                    found.append(self.history[seq - first])
+                else:
+                    missing.append(seq)
+        return found, missing
+
+
+class Session:
+    """State of one logged-in client"""
+
+    __slots__ = (
+        'id', 'username', 'socket', 'room', 'outbox', 'message_bucket', 'control_bucket',
+        'file_bucket', 'last_seen', 'udp_addr', 'call_partner', 'online', 'reaped', 'compress', 'file_compress',
+        'file_chunks',
+        'inbox_sent', 'token', 'detached_at', 'acked_seq', 'uploads', 'credit_due', 'credit_timer', 'groups', 'lock'
+    )
+
+    def __init__(self, username, sock):
+        self.id = next(session_ids)
+        self.username = sys.intern(username)
+        self.socket = sock
+        self.room = None          # Room, set once the session enters one
+        self.outbox = Outbox(sock)
+        self.message_bucket = TokenBucket(*USER_MESSAGE_RATE)
+        self.control_bucket = TokenBucket(*USER_CONTROL_RATE)
+        self.file_bucket = TokenBucket(*USER_FILE_BYTE_RATE)
+        self.last_seen = time.monotonic()
+        self.udp_addr = None
+        self.call_partner = None  # Session on the other end of a call
+        self.online = True
+        self.reaped = False
+        self.compress = False     # Negotiated protocol.COMPRESSION_FEATURE
+        self.file_compress = False  # Negotiated protocol.FILE_COMPRESSION_FEATURE
+        self.file_chunks = False    # Negotiated protocol.FILE_CHUNKS_FEATURE
+        self.inbox_sent = 0       # Id of the last offline message sent to this session
+        self.token = secrets.token_urlsafe(16)
+        self.detached_at = None   # When the connection dropped, while waiting for a resume
+        self.acked_seq = None     # Last room message the client acknowledged, if it acks
+        self.uploads = None       # {transfer_id: Upload} while chunked uploads are in progress
+        self.credit_due = 0       # Upload bytes consumed but not yet credited back
+        self.credit_timer = None  # Sends withheld credit once the file rate limit allows
+        self.groups = None        # {group id: FileGroup} for open batch uploads
+        self.lock = threading.Lock()
+
+
+class Upload:
+    """A chunked file upload being received, compressed uploads are inflated as they arrive"""
+
+    __slots__ = ('filename', 'filesize', 'target', 'group', 'data', 'encoded', 'inflater')
+
+    def __init__(self, filename, filesize, target, group=None, encoding=None):
+        self.filename = filename
+        self.filesize = filesize
+        self.target = target
+        self.group = group
+        self.data = bytearray()   # Grows as chunks arrive, the announced size is not trusted
+        # The compressed stream is kept to relay as it is
+        self.encoded = bytearray() if encoding else None
+        self.inflater = zlib.decompressobj(-15) if encoding else None
+
+    def add(self, data):
+        """Store the next chunk, False if it is invalid or holds more than the announced size"""
+        if self.inflater is not None:
+            self.encoded += data
+            try:
+                # One byte past the announced size is enough to tell it is too long
+                data = self.inflater.decompress(data, self.remaining() + 1)
+            except zlib.error:
+                return False
+            if self.inflater.unconsumed_tail or self.inflater.unused_data:
+                # Too long, or data after the end of the stream
+                return False
+            if self.inflater.eof and len(data) != self.remaining():
+                # The stream ended short of the announced size
+                return False
+        
+        if len(data) > self.remaining():
+            return False
+        self.data += data
+        return True
+
+    def remaining(self):
+        """Announced bytes not received yet"""
+        return self.filesize - len(self.data)
+
+    def complete(self):
+        return len(self.data) == self.filesize and (self.inflater is None or self.inflater.eof)
+
+
+class FileGroup:
+    """Files a client uploads as one batch, relayed to recipients as one logical transfer"""
+
+    __slots__ = ('count', 'filesize', 'target', 'files')
+
+    def __init__(self, count, filesize, target):
+        self.count = count
+        self.filesize = filesize
+        self.target = target
+        self.files = 0            # Files relayed so far
+
+
+class FileBody:
+    """A file queued for a client that takes files in chunk frames.
+
+    Written one FILE_CHUNK_SIZE slice at a time, so frames of higher
+    priority go out between the slices instead of waiting for the whole
+    file. The data may be shared by the FileBody of every recipient.
+    """
+
+    __slots__ = ('header', 'transfer_id', 'data', 'offset')
+
+    def __init__(self, header, transfer_id, data):
+        self.header = header      # Encoded file_incoming frame, None once written
+        self.transfer_id = transfer_id
+        self.data = data
+        self.offset = 0           # Bytes of data written so far
+
+    def started(self):
+        return self.header is None
+
+    def done(self):
+        return self.header is None and self.offset >= len(self.data)
+
+    def next_chunks(self):
+        """Buffers of the next slice, the header before the first one"""
+        chunks = []
+        if self.header is not None:
+            chunks.append(self.header)
+            self.header = None
+        end = min(self.offset + FILE_CHUNK_SIZE, len(self.data))
+        if end > self.offset:
+            chunks.append(protocol.FILE_CHUNK_HEADER.pack(protocol.FILE_CHUNK_MARKER, self.transfer_id, end - self.offset))
+            chunks.append(memoryview(self.data)[self.offset:end])
+            self.offset = end
+        return chunks
+
+
+class Outbox:
+    """Per-client outbound queue with priority classes.
+
+    Items are written by a writer thread that is started on demand and exits
+    after WRITER_IDLE_TIMEOUT without work, so idle clients cost no thread and
+    a slow client never blocks the thread that queued the message. The queues
+    and the writer's condition only exist while the writer does, which keeps
+    idle sessions small.
+
+    Every frame written is numbered (seq) and the last REPLAY_FRAMES or more
+    are kept, so after a reconnect the frames the client did not receive can
+    be sent again. While the client is away (detached) items are queued but
+    not written.
+
+    drained_at is when the peer last acknowledged file data, so a client
+    that is busy taking a long download is not taken for a dead one. Other
+    frames do not count, the socket buffer of a dead peer takes those too.
+    """
+
+    __slots__ = (
+        'sock', 'lock', 'queues', 'size', 'cond', 'writer_running', 'closed', 'dropped', 'seq', 'replay',
+        'written', 'bulk_end', 'acked', 'drained_at'
+    )
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.queues = None
+        self.size = 0
+        self.cond = None
+        self.writer_running = False
+        self.closed = False
+        self.dropped = 0
+        self.seq = 0          # Frames written so far
+        self.replay = None    # Last written frames, None for bulk items
+        self.written = 0      # Bytes written to sock
+        self.bulk_end = 0     # written at the end of the last file data
+        self.acked = 0        # Bytes up to bulk_end the peer was seen to acknowledge
+        self.drained_at = 0.0  # time.monotonic() when the peer last took file data
+
+    def put(self, item, priority=PRIORITY_CHAT):
+        """Queue a frame (bytes), a bulk item (list of chunks sent back to back) or a FileBody"""
+        with self.lock:
+            if self.closed:
+                return False
+            if self.size >= MAX_OUTBOX_ITEMS and priority != PRIORITY_SIGNAL:
+                self.dropped += 1
+                OUTBOX_DROPS.inc()
+                return False
+            
+            if self.queues is None:
+                self.queues = (deque(), deque(), deque())
+            self.queues[priority].append(item)
+            self.size += 1
+            
+            if self.writer_running:
+                self.cond.notify()
+            elif self.sock is not None:
+                self._start_writer()
+        return True
+
+    def put_many(self, frames, priority=PRIORITY_CHAT):
+        """Queue several frames in order with one lock round trip, return how many were queued"""
+        with self.lock:
+            if self.closed:
+                return 0
+            if priority != PRIORITY_SIGNAL:
+                space = max(MAX_OUTBOX_ITEMS - self.size, 0)
+                if len(frames) > space:
+                    self.dropped += len(frames) - space
+                    OUTBOX_DROPS.inc(len(frames) - space)
+                    frames = frames[:space]
+            if not frames:
+                return 0
+            
+            if self.queues is None:
+                self.queues = (deque(), deque(), deque())
+            self.queues[priority].extend(frames)
+            self.size += len(frames)
+            
+            if self.writer_running:
+                self.cond.notify()
+            elif self.sock is not None:
+                self._start_writer()
+        return len(frames)
+
+    def _start_writer(self):
+        # Called with the lock held
+        self.writer_running = True
+        self.cond = threading.Condition(self.lock)
+        threading.Thread(target=self._run, args=(self.sock,), daemon=True).start()
+
+    def _record(self, frame):
+        # Called with the lock held, for every frame about to be written
+        self.seq += 1
+        if self.replay is None:
+            self.replay = []
+        self.replay.append(frame)
+        if len(self.replay) > 2 * REPLAY_FRAMES:
+            del self.replay[:REPLAY_FRAMES]
+
+    def _next_chunks(self):
+        """Pop the most urgent item, coalescing it with further small frames.
+
+        Returns the buffers to write and whether they are file data.
+        """
+        for queue in self.queues:
+            if not queue:
+                continue
+            
+            item = queue.popleft()
+            if isinstance(item, FileBody):
+                # One slice at a time; file data is not kept for replay
+                if not item.started():
+                    self._record(None)
+                chunks = item.next_chunks()
+                if item.done():
+                    self.size -= 1
+                else:
+                    queue.appendleft(item)
+                return chunks, True
+            
+            self.size -= 1
+            if isinstance(item, list):
+                # File data is not kept for replay
+                self._record(None)
+                return item, True
+            
+            self._record(item)
+            batch = [item]
+            total = len(item)
+            while total < MAX_COALESCE_BYTES:
+                queue = self.queues[PRIORITY_SIGNAL] or self.queues[PRIORITY_CHAT]
+                if not queue:
+                    break
+                frame = queue.popleft()
+                self.size -= 1
+                self._record(frame)
+                batch.append(frame)
+                total += len(frame)
+            return batch, False
+        return [], False
+
+    def _run(self, sock):
+        while True:
+            with self.lock:
+                # A detach or close hands the outbox over; leave it as it is
+                while not self.size and not self.closed and self.sock is sock:
+                    if not self.cond.wait(WRITER_IDLE_TIMEOUT) and not self.size and self.sock is sock:
+                        self._stop_writer()
+                        return
+                if self.sock is not sock:
+                    return
+                if self.closed:
+                    self._stop_writer()
+                    return
+                chunks, bulk = self._next_chunks()
+            
+            try:
+                for piece in split_buffers(chunks, FILE_CHUNK_SIZE):
+                    send_buffers(sock, piece)
+                    self.written += sum(len(data) for data in piece)
+                    if bulk:
+                        self.bulk_end = self.written
+                        self.note_drain(sock)
+            except OSError as e:
+                SEND_ERRORS.inc()
+                log.info("SEND ERROR", "%s", e, sample=True)
+                # Keep what is queued for a resumed connection and wake the
+                # reader so the session is detached
+                self.detach(sock)
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return
+
+    def note_drain(self, sock):
+        """Stamp drained_at if the peer acknowledged more file data since the last look.
+
+        Bytes after bulk_end do not count: the kernel of a peer that stopped
+        reading still acknowledges pings until its buffer is full.
+        """
+        written, bulk_end = self.written, self.bulk_end
+        queued = unacked_bytes(sock)
+        if queued is None:
+            return
+        acked = min(written - queued, bulk_end)
+        if acked > self.acked:
+            self.acked = acked
+            self.drained_at = time.monotonic()
+
+    def draining(self, sock, now):
+        """True if the peer took file data within DEAD_PEER_TIMEOUT before now"""
+        if sock is not None:
+            self.note_drain(sock)
+        return self.drained_at > now - DEAD_PEER_TIMEOUT
+
+    def _stop_writer(self):
+        # Called with the lock held, the next put() starts a fresh writer
+        self.writer_running = False
+        self.cond = None
+        if not self.size:
+            self.queues = None
+
+    def detach(self, sock):
+        """Stop writing to sock, keeping queued items and the replay frames"""
+        with self.lock:
+            if self.sock is not sock:
+                return
+            self.sock = None
+            # The client loses a file written in part; it is not continued
+            bulk = self.queues[PRIORITY_BULK] if self.queues is not None else None
+            if bulk and isinstance(bulk[0], FileBody) and bulk[0].started():
+                bulk.popleft()
+                self.size -= 1
+            if self.cond is not None:
+                self.cond.notify()
+            self.writer_running = False
+            self.cond = None
+
+    def attach(self, sock, last_seq):
+        """Write to sock from now on, resending the frames after last_seq first.
+
+        Returns how many frames are resent, or None if the frames after
+        last_seq are no longer kept; the client is then only sent new frames.
+        Numbering continues from last_seq either way.
+        """
+        with self.lock:
+            if self.closed:
+                return None
+            replay = self.replay or []
+            first = self.seq - len(replay) + 1
+            if first - 1 <= last_seq <= self.seq:
+                missed = [frame for frame in replay[last_seq - first + 1:] if frame is not None]
+                del replay[last_seq - first + 1:]
+                resent = len(missed)
+            else:
+                missed = []
+                replay.clear()
+                resent = None
+            self.seq = last_seq
+            
+            if missed:
+                if self.queues is None:
+                    self.queues = (deque(), deque(), deque())
+                self.queues[PRIORITY_SIGNAL].extendleft(reversed(missed))
+                self.size += len(missed)
+            
+            self.sock = sock
+            self.written = self.bulk_end = self.acked = 0
+            if self.size:
+                self._start_writer()
+        return resent
+
+    def close(self):
+        """Drop anything still queued and stop the writer"""
+        with self.lock:
+            self.closed = True
+            if self.queues is not None:
+                for queue in self.queues:
+                    queue.clear()
+            self.size = 0
+            self.replay = None
+            if self.cond is not None:
+                self.cond.notify()
+
+
+def send_buffers(sock, buffers):
+    """Write buffers back to back, with vectored sends (sendmsg) where the socket has them.
+
+    TLS sockets and WebSocket connections cannot send a vector, they get
+    one sendall per buffer.
+    """
+    if type(sock) is not socket.socket or not hasattr(sock, 'sendmsg'):
+        # Coalesced frames still go out as one write; file data as it is
+        if len(buffers) > 1 and sum(len(data) for data in buffers) <= 2 * MAX_COALESCE_BYTES:
+            buffers = [b"".join(buffers)]
+        for data in buffers:
+            sock.sendall(data)
+        return
+    
+    buffers = list(buffers)
+    index = 0
+    while index < len(buffers):
+        sent = sock.sendmsg(buffers[index:index + MAX_SEND_BUFFERS])
+        # Skip what went out; a partly sent buffer goes again from where it stopped
+        while index < len(buffers) and sent >= len(buffers[index]):
+            sent -= len(buffers[index])
+            index += 1
+        if sent:
+            buffers[index] = memoryview(buffers[index])[sent:]
+
+
+def split_buffers(buffers, size):
+    """Group buffers into writes, slicing the ones larger than size.
+
+    A file sent in the contiguous format is one buffer; written in slices the
+    writer can check the peer's progress while it goes out.
+    """
+    batch = []
+    for data in buffers:
+        if len(data) <= size:
+            batch.append(data)
+            continue
+        if batch:
+            yield batch
+            batch = []
+        view = memoryview(data)
+        for start in range(0, len(view), size):
+            yield [view[start:start + size]]
+    if batch:
+        yield batch
+
+
+def unacked_bytes(sock):
+    """Bytes written to sock that the peer has not acknowledged yet, None where unknown"""
+    if fcntl is None:
+        return None
     try:
-        message = json.dumps(message_dict) + "\n"
-        client_socket.send(message.encode('utf-8'))
-    except:
-        pass
+        return struct.unpack('i', fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b'\0\0\0\0'))[0]
+    except (OSError, ValueError):
+        return None
 
 
-def broadcast(message_dict, sender_username=None, room=None):
-    """Send JSON message to clients in a specific room or all clients"""
+def enable_keepalive(sock):
+    """Turn on TCP keepalive with our probe timing where the platform allows it"""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_COUNT)
+    elif hasattr(socket, 'SIO_KEEPALIVE_VALS'):
+        # Windows takes milliseconds
+        sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, KEEPALIVE_IDLE * 1000, KEEPALIVE_INTERVAL * 1000))
+
+
+def outbox_depth_total():
     with clients_lock:
-        for username, user_info in list(clients.items()):
-            # Skip sender
-            if username == sender_username:
-                continue
+        return sum(user_info.outbox.size for user_info in clients.values())
+
+
+def deepest_outboxes():
+    """(username, depth) for the clients with the most queued items"""
+    with clients_lock:
+        depths = [(username, user_info.outbox.size) for username, user_info in clients.items()]
+    return heapq.nlargest(MAX_QUEUE_DEPTH_SERIES, depths, key=lambda pair: pair[1])
+
+
+def laggiest_acks():
+    """(username, unacknowledged room messages) for the clients furthest behind"""
+    with clients_lock:
+        lags = [(username, user_info.room.seq - user_info.acked_seq) for username, user_info in clients.items()
+                if user_info.acked_seq is not None and user_info.room is not None]
+    return heapq.nlargest(MAX_QUEUE_DEPTH_SERIES, lags, key=lambda pair: pair[1])
+
+
+def enter_room(room_name, session):
+    """Add a session to a room (creating it if needed), return the Room"""
+    while True:
+        with rooms_lock:
+            room = rooms.get(room_name)
+            if room is None:
+                room = Room(room_name)
+                rooms[room_name] = room
+        if room.add(session):
+            return room
+        # The room emptied and closed in between, look it up again
+
+
+def leave_room(room, session):
+    """Remove a session from a room, dropping the room once it is empty"""
+    if not room.remove(session):
+        return
+    with rooms_lock:
+        with room.lock:
+            if not room.members and rooms.get(room.name) is room:
+                room.closed = True
+                del rooms[room.name]
+
+
+def get_room(room_name):
+    with rooms_lock:
+        return rooms.get(room_name)
+
+
+def get_session(username):
+    with clients_lock:
+        return clients.get(username)
+
+
+def start_call(caller_info, callee_info):
+    """Pair two sessions in a call, return False if either is already in one"""
+    if caller_info is callee_info:
+        return False
+    first, second = sorted((caller_info, callee_info), key=lambda info: info.username)
+    with first.lock, second.lock:
+        if not (caller_info.online and callee_info.online):
+            return False
+        if caller_info.call_partner is not None or callee_info.call_partner is not None:
+            return False
+        caller_info.call_partner = callee_info
+        callee_info.call_partner = caller_info
+        return True
+
+
+def end_call(user_info):
+    """Unpair a session from its call partner, return the partner's session (or None)"""
+    while True:
+        partner_info = user_info.call_partner
+        if partner_info is None:
+            return None
+        first, second = sorted((user_info, partner_info), key=lambda info: info.username)
+        with first.lock, second.lock:
+            # Retry if the call changed before both locks were held
+            if user_info.call_partner is partner_info:
+                user_info.call_partner = None
+                if partner_info.call_partner is user_info:
+                    partner_info.call_partner = None
+                return partner_info
+
+
+def encode_message(message_dict):
+    """Encode a message as a newline-terminated JSON frame"""
+    return protocol.encode(message_dict)
+
+
+def compress_for(session, frame):
+    """Frame as it should be sent to one session"""
+    return compress_frame(frame) if session.compress else frame
+
+
+def compress_frame(frame):
+    """Compress a frame once for any number of compression-enabled recipients"""
+    compressed = protocol.compress_frame(frame)
+    if compressed is not frame:
+        COMPRESSED_FRAMES.inc()
+        COMPRESSION_SAVED_BYTES.inc(len(frame) - len(compressed))
+    return compressed
+
+
+def read_frame(sock, buffer):
+    """Read until buffer holds a complete frame, return it without the newline.
+
+    Returns None if the connection closes or the frame is too long or
+    corrupt. Bytes after the frame stay in buffer.
+    """
+    while True:
+        try:
+            line = protocol.pop_frame(buffer)
+        except protocol.ProtocolError:
+            return None
+        if line is not None:
+            return line
+        data = sock.recv(RECV_SIZE)
+        if not data:
+            return None
+        buffer += data
+
+
+def send_json(client_socket, message_dict):
+    """Send JSON message directly on a socket (only before the client has an outbox), False on failure"""
+    try:
+        client_socket.sendall(encode_message(message_dict))
+        return True
+    except OSError as e:
+        SEND_ERRORS.inc()
+        log.info("SEND ERROR", "%s to %s: %s", message_dict.get("type"), client_socket, e, sample=True)
+        return False
+
+
+def queue_json(user_info, message_dict, priority=PRIORITY_CHAT):
+    """Queue JSON message on a logged-in client's outbox"""
+    return user_info.outbox.put(compress_for(user_info, encode_message(message_dict)), priority)
+
+
+def broadcast(message_dict, sender_id=None, room=None, priority=PRIORITY_CHAT):
+    """Send JSON message to clients in a specific room (Room or name) or all clients.
+
+    Room messages get the room's next seq and are kept for resends; the
+    skipped sender is sent just the new seq, so it sees no gap.
+    """
+    start = time.perf_counter()
+    
+    # If room is specified, only send to users in that room (skip sender)
+    if room is not None:
+        room_obj = room if isinstance(room, Room) else get_room(room)
+        if room_obj is None:
+            return
+        with room_obj.order_lock:
+            room_obj.seq += 1
+            message_dict = dict(message_dict, room=room_obj.name, seq=room_obj.seq)
+            frame = encode_message(message_dict)
+            room_obj.history.append(frame)
             
-            # If room is specified, only send to users in that room
-            if room is not None:
-                if user_info['room'] == room:
-                    send_json(user_info['socket'], message_dict)
+            sender_frame = None
+            if sender_id is not None:
+                sender_frame = encode_message({"type": "room_seq", "room": room_obj.name, "seq": room_obj.seq})
+            recipients = fan_out_room(room_obj, [frame], sender_id, priority, sender_frame)
+    else:
+        frame = encode_message(message_dict)
+        with clients_lock:
+            sessions = list(clients.values())
+        targets = [session for session in sessions if session.id != sender_id]
+        fan_out(targets, frame, priority)
+        recipients = len(targets)
+    
+    BROADCAST_SECONDS.observe(time.perf_counter() - start)
+    BROADCAST_RECIPIENTS.observe(recipients)
+
+
+def broadcast_batch(room, message_dicts, priority=PRIORITY_CHAT):
+    """Send several messages to every member of a Room, return the number of members.
+
+    The messages are numbered and kept for resends like single room
+    messages, but each member's outbox takes the whole batch at once.
+    """
+    start = time.perf_counter()
+    with room.order_lock:
+        frames = []
+        for message_dict in message_dicts:
+            room.seq += 1
+            message_dict["room"] = room.name
+            message_dict["seq"] = room.seq
+            frame = encode_message(message_dict)
+            room.history.append(frame)
+            frames.append(frame)
+        recipients = fan_out_room(room, frames, priority=priority)
+    
+    BROADCAST_SECONDS.observe(time.perf_counter() - start)
+    BROADCAST_RECIPIENTS.observe(recipients)
+    return recipients
+
+
+class FanoutJob:
+    """Frames of one room broadcast, shared by the fan-out workers delivering it"""
+
+    __slots__ = ('room', 'frames', 'sender_id', 'sender_frame', 'priority', 'compressed', 'lock')
+
+    def __init__(self, room, frames, sender_id, sender_frame, priority):
+        self.room = room
+        self.frames = frames
+        self.sender_id = sender_id
+        self.sender_frame = sender_frame
+        self.priority = priority
+        self.compressed = None
+        self.lock = threading.Lock()
+
+    def compressed_frames(self):
+        """The frames compressed, done once by whichever worker needs them first"""
+        with self.lock:
+            if self.compressed is None:
+                self.compressed = [compress_frame(frame) for frame in self.frames]
+            return self.compressed
+
+
+def fan_out_room(room, frames, sender_id=None, priority=PRIORITY_CHAT, sender_frame=None):
+    """Queue a room's new frames for its members, return the number of recipients.
+
+    Called with room.order_lock held. The member sender_id gets sender_frame
+    (if any) instead. Rooms of FANOUT_POOL_THRESHOLD members and more are
+    split into shards for the fan-out workers, as are smaller ones while
+    earlier jobs for them are pending, so the frames never overtake each
+    other.
+    """
+    members = room.sessions()
+    workers = fanout_queues
+    if workers is None or (len(members) < FANOUT_POOL_THRESHOLD and not room.fanout_pending):
+        targets = []
+        for session in members:
+            if session.id != sender_id:
+                targets.append(session)
+            elif sender_frame is not None:
+                session.outbox.put(compress_for(session, sender_frame), PRIORITY_CHAT)
+        if len(frames) == 1:
+            fan_out(targets, frames[0], priority)
+        else:
+            fan_out_many(targets, frames, priority)
+        return len(targets)
+    
+    job = FanoutJob(room, frames, sender_id, sender_frame, priority)
+    shards = [(worker, shard) for worker, shard in zip(workers, room.shards(len(workers))) if shard]
+    with room.lock:
+        room.fanout_pending += len(shards)
+    for worker, shard in shards:
+        worker.put((job, shard))
+    FANOUT_POOLED.inc()
+    return len(members) - (sender_id in room.members)
+
+
+def queue_in_room_order(room, session, frame):
+    """Queue a frame for one member behind the room's frames already on their way to it.
+
+    Called with room.order_lock held. While fan-out jobs for the room are
+    pending, the frame goes through the worker that serves the member's shard.
+    """
+    workers = fanout_queues
+    if workers is None or not room.fanout_pending:
+        session.outbox.put(compress_for(session, frame), PRIORITY_CHAT)
+        return
+    
+    job = FanoutJob(room, (), session.id, frame, PRIORITY_CHAT)
+    with room.lock:
+        room.fanout_pending += 1
+    workers[session.id % len(workers)].put((job, (session,)))
+
+
+def fanout_worker(jobs):
+    """Queue room broadcasts on the outboxes of one shard of members, until given None"""
+    while True:
+        item = jobs.get()
+        if item is None:
+            return
+        job, shard = item
+        try:
+            if len(job.frames) <= 1:
+                # Without frames the job only carries sender_frame
+                frame = job.frames[0] if job.frames else None
+                compressed = None
+                for session in shard:
+                    if session.id == job.sender_id:
+                        if job.sender_frame is not None:
+                            session.outbox.put(compress_for(session, job.sender_frame), PRIORITY_CHAT)
+                        continue
+                    if session.compress:
+                        if compressed is None:
+                            compressed = job.compressed_frames()[0]
+                        session.outbox.put(compressed, job.priority)
+                    else:
+                        session.outbox.put(frame, job.priority)
             else:
-                # Send to all users (for global notifications)
-                send_json(user_info['socket'], message_dict)
+                # Batches have no sender
+                fan_out_many(shard, job.frames, job.priority, job.compressed_frames)
+        except Exception as e:
+            log.error("ERROR", "Fan-out to %s failed: %s", job.room.name, e)
+        finally:
+            with job.room.lock:
+                job.room.fanout_pending -= 1
+
+
+def fan_out_many(sessions, frames, priority, compressed_frames=None):
+    """Queue several frames in order on many outboxes, one put per outbox"""
+    compressed = None
+    for session in sessions:
+        if session.compress:
+            if compressed is None:
+                compressed = compressed_frames() if compressed_frames else [compress_frame(frame) for frame in frames]
+            session.outbox.put_many(compressed, priority)
+        else:
+            session.outbox.put_many(frames, priority)
+
+
+def fan_out(sessions, frame, priority):
+    """Queue one encoded frame on many outboxes, compressing it at most once"""
+    compressed = None
+    for session in sessions:
+        if session.compress:
+            if compressed is None:
+                compressed = compress_frame(frame)
+            session.outbox.put(compressed, priority)
+        else:
+            session.outbox.put(frame, priority)
 
 
 def broadcast_active_users():
     """Send the list of active users to all connected clients"""
     with clients_lock:
         user_list = list(clients.keys())
+        targets = list(clients.values())
     
     user_list_message = {
         "type": "user_list",
         "payload": user_list
     }
-    
-    with clients_lock:
-        for user_info in clients.values():
-            send_json(user_info['socket'], user_list_message)
+    fan_out(targets, encode_message(user_list_message), PRIORITY_CHAT)
 
 
-def send_room_info(client_socket, username):
+def send_room_info(username):
     """Send current room info and room members to a specific client"""
-    with clients_lock:
-        if username not in clients:
-            return
-        
-        user_room = clients[username]['room']
-        room_members = [uname for uname, info in clients.items() if info['room'] == user_room]
-    
-    room_info_msg = {
-        "type": "room_info",
-        "payload": {
-            "room": user_room,
-            "members": room_members
+    user_info = get_session(username)
+    if user_info is None:
+        return
+    
+    user_room = user_info.room
+    # Queued in order with the room's messages, so seq is where the client
+    # starts counting: the messages up to it are ahead of room_info, the
+    # later ones behind it
+    with user_room.order_lock:
+        room_info_msg = {
+            "type": "room_info",
+            "payload": {
+                "room": user_room.name,
+                "members": user_room.member_names(),
+                "seq": user_room.seq
+            }
         }
-    }
-    send_json(client_socket, room_info_msg)
+        queue_in_room_order(user_room, user_info, encode_message(room_info_msg))
 
 
 def send_private_message(sender, target, message):
-    """Send a private message from sender to target"""
-    with clients_lock:
-        if target in clients:
-            private_msg = {
-                "type": "private_message",
-                "sender": sender,
-                "payload": message
-            }
-            send_json(clients[target]['socket'], private_msg)
-            return True
+    """Send a private message from sender to target, False if target is offline"""
+    target_info = get_session(target)
+    if target_info is None or target_info.socket is None:
+        # Waiting for a resume counts as offline, so the message is kept
+        # in the inbox even if the session expires
         return False
+    
+    private_msg = {
+        "type": "private_message",
+        "sender": sender,
+        "payload": message
+    }
+    queue_json(target_info, private_msg)
+    return True
 
 
-def change_user_room(username, new_room):
-    """Change a user's room"""
-    with clients_lock:
-        if username in clients:
-            old_room = clients[username]['room']
-            clients[username]['room'] = new_room
-            return old_room
-        return None
+def store_private_message(sender, target, message):
+    """Queue a private message for an offline user, return an offline_inbox result"""
+    if inbox is None:
+        return offline_inbox.UNKNOWN_USER
+    result = inbox.store(target, sender, message)
+    if result == offline_inbox.STORED:
+        INBOX_STORED.inc()
+        # The target may have logged in and fetched its inbox meanwhile
+        target_info = get_session(target)
+        if target_info is not None:
+            deliver_inbox(target_info)
+    return result
+
+
+def deliver_inbox(user_info):
+    """Send the next batch of offline messages this session has not been sent yet"""
+    if inbox is None:
+        return
+    with user_info.lock:
+        messages = inbox.fetch(user_info.username, INBOX_BATCH, user_info.inbox_sent)
+        if not messages:
+            return
+        user_info.inbox_sent = messages[-1]["id"]
+        queue_json(user_info, {"type": "inbox", "payload": messages})
+    INBOX_DELIVERED.inc(len(messages))
+
+
+def change_user_room(user_info, new_room):
+    """Move a user to another room, return the old room's name"""
+    old_room = user_info.room
+    if old_room.name != new_room:
+        user_info.room = enter_room(new_room, user_info)
+        user_info.acked_seq = None
+        leave_room(old_room, user_info)
+    return old_room.name
 
 
 def get_room_users(room):
     """Get list of users in a specific room"""
-    with clients_lock:
-        return [username for username, info in clients.items() if info['room'] == room]
+    room_obj = get_room(room)
+    return room_obj.member_names() if room_obj is not None else []
 
 
-def send_file_to_user(target_socket, sender, filename, filedata, target_user=None):
-    """Send file to a specific user with header-body protocol"""
-    try:
-        # Send file header as JSON
-        file_header = {
-            "type": "file_incoming",
-            "sender": sender,
-            "filename": filename,
-            "filesize": len(filedata),
-            "target": target_user
-        }
-        header_json = json.dumps(file_header) + "\n"
-        target_socket.send(header_json.encode('utf-8'))
-        
-        # Send file size as 4-byte integer (for binary mode verification)
-        target_socket.send(struct.pack('>I', len(filedata)))
-        
-        # Send raw binary file data in chunks
-        chunk_size = 4096
-        for i in range(0, len(filedata), chunk_size):
-            chunk = filedata[i:i + chunk_size]
-            target_socket.send(chunk)
-        
-        print(f"[FILE SENT] {filename} ({len(filedata)} bytes) to {target_user or 'room'}")
+def send_file_to_user(target_info, sender, filename, filedata, target_user=None, group=None, encoded=None):
+    """Queue file for a specific user with header-body protocol"""
+    # File header as JSON, then file size as 4-byte integer (for binary mode
+    # verification), then the raw binary data. Queued as one bulk item so
+    # nothing else is written in between, unless the client takes the data
+    # in chunk frames.
+    file_header = {
+        "type": "file_incoming",
+        "sender": sender,
+        "filename": filename,
+        "filesize": len(filedata),
+        "target": target_user
+    }
+    if group is not None:
+        file_header["group"] = group
+    
+    # A file uploaded compressed goes on compressed to clients that take it;
+    # the size header then gives the compressed length
+    body = filedata
+    if encoded is not None and target_info.file_compress:
+        file_header["encoding"] = protocol.FILE_ENCODING
+        body = encoded
+    if target_info.file_chunks:
+        transfer_id = next(download_ids) & 0xFFFFFFFF
+        file_header["transfer_id"] = transfer_id
+        file_header["length"] = len(body)
+        item = FileBody(encode_message(file_header), transfer_id, body)
+    else:
+        item = [encode_message(file_header), struct.pack('>I', len(body)), body]
+    
+    if target_info.outbox.put(item, PRIORITY_BULK):
+        FILE_BYTES_RELAYED.inc(len(body))
+        log.info("FILE QUEUED", "%s (%d bytes) to %s", filename, len(filedata), target_user or 'room',
+                 sample=True, sender=sender, size=len(filedata), target=target_user)
         return True
-    except Exception as e:
-        print(f"[ERROR] Failed to send file: {e}")
-        return False
+    
+    log.warning("ERROR", "Failed to queue file %s for %s", filename, target_user)
+    return False
+
+
+def broadcast_file(filedata, filename, sender_info, room, group=None, encoded=None):
+    """Broadcast file to a room (Room or name) except the sender's session, return who it could not be queued for"""
+    room_obj = room if isinstance(room, Room) else get_room(room)
+    if room_obj is None:
+        return []
+    
+    sender = sender_info.username
+    dropped = []
+    for session in room_obj.sessions():
+        if session.id != sender_info.id:
+            if not send_file_to_user(session, sender, filename, filedata, session.username, group, encoded):
+                dropped.append(session.username)
+    return dropped
+
+
+def relay_file(user_info, filename, filedata, target, transfer_id=None, group=None, encoded=None):
+    """Forward a received file to the target or the sender's room, then confirm it to its sender"""
+    username = user_info.username
+    log.info("FILE RECEIVED", "%s (%s bytes) from %s", filename, len(filedata), username,
+             user=username, size=len(filedata))
+    
+    # Forward file to target or room
+    if target:
+        # Private file transfer
+        target_info = get_session(target)
+        
+        if target_info is None:
+            error_msg = {
+                "type": "error",
+                "payload": f"User '{target}' not found"
+            }
+            queue_json(user_info, error_msg)
+            return
+        dropped = [] if send_file_to_user(target_info, username, filename, filedata, target, group, encoded) else [target]
+    else:
+        # Broadcast to room
+        dropped = broadcast_file(filedata, filename, user_info, user_info.room, group, encoded)
+    
+    # Confirmed only once the file is queued for everyone; a full outbox
+    # drops it, and the sender is told who did not get it
+    if dropped:
+        error_msg = {
+            "type": "error",
+            "payload": f"File transfer failed - '{filename}' could not be delivered to {', '.join(dropped)}"
+        }
+        queue_json(user_info, error_msg)
+        return
+    
+    if group is not None:
+        file_group = user_info.groups.get(group) if user_info.groups else None
+        if file_group is not None:
+            file_group.files += 1
+    
+    confirm_msg = {
+        "type": "file_sent_confirm",
+        "transfer_id": transfer_id,
+        "group": group,
+        "payload": f"File '{filename}' sent successfully"
+    }
+    queue_json(user_info, confirm_msg)
+
+
+def send_group_frame(user_info, target, message_dict):
+    """Queue a file group frame for the group's recipients, in order with the group's files"""
+    if target:
+        target_info = get_session(target)
+        recipients = [target_info] if target_info is not None else []
+    else:
+        recipients = [session for session in user_info.room.sessions() if session is not user_info]
+    
+    # Bulk priority, so it is not written ahead of files queued before it
+    fan_out(recipients, encode_message(message_dict), PRIORITY_BULK)
 
 
-def broadcast_file(filedata, filename, sender, room):
-    """Broadcast file to all users in a room except sender"""
+def start_file_group(user_info, group, count, filesize, target):
+    """Open a batch upload and announce it to the recipients"""
+    groups = user_info.groups
+    if groups is None:
+        groups = user_info.groups = {}
+    
+    if group in groups:
+        reason = "Duplicate group id"
+    elif len(groups) >= MAX_ACTIVE_GROUPS:
+        reason = "Too many file groups in progress"
+    elif not 0 < count <= MAX_GROUP_FILES or filesize < 0:
+        reason = "Invalid file group"
+    elif target and get_session(target) is None:
+        reason = f"User '{target}' not found"
+    else:
+        groups[group] = FileGroup(count, filesize, target)
+        log.info("FILE GROUP", "%s sending %d files (%d bytes) as %s", user_info.username, count, filesize, group,
+                 user=user_info.username, count=count, size=filesize, target=target)
+        send_group_frame(user_info, target, {
+            "type": "file_group",
+            "sender": user_info.username,
+            "group": group,
+            "count": count,
+            "filesize": filesize,
+            "target": target
+        })
+        return
+    
+    error_msg = {"type": "error", "group": group, "payload": f"File transfer failed - {reason}"}
+    queue_json(user_info, error_msg)
+
+
+def end_file_group(user_info, group):
+    """Close a batch upload, telling the recipients how many of its files were relayed"""
+    file_group = user_info.groups.pop(group, None) if user_info.groups else None
+    if file_group is None:
+        return
+    
+    send_group_frame(user_info, file_group.target, {
+        "type": "file_group_complete",
+        "sender": user_info.username,
+        "group": group,
+        "count": file_group.files,
+        "target": file_group.target
+    })
+    queue_json(user_info, {
+        "type": "file_group_complete",
+        "group": group,
+        "count": file_group.files,
+        "payload": f"{file_group.files} of {file_group.count} files sent"
+    })
+
+
+def start_upload(user_info, transfer_id, filename, filesize, target, group=None, encoding=None):
+    """Accept or reject the header of a chunked upload"""
+    uploads = user_info.uploads
+    if uploads is None:
+        uploads = user_info.uploads = {}
+    
+    if group is not None and not (user_info.groups and group in user_info.groups):
+        reason = "Unknown file group"
+    elif transfer_id in uploads:
+        reason = "Duplicate transfer id"
+    elif len(uploads) >= MAX_ACTIVE_UPLOADS:
+        reason = "Too many uploads in progress"
+    elif filesize > MAX_UPLOAD_BYTES:
+        reason = f"File too large (at most {MAX_UPLOAD_BYTES // (1024 * 1024)} MB)"
+    elif filesize + sum(upload.remaining() for upload in uploads.values()) > MAX_PENDING_UPLOAD_BYTES:
+        reason = "Too much file data in progress"
+    elif encoding is not None and encoding != protocol.FILE_ENCODING:
+        reason = "Unsupported encoding"
+    elif target and get_session(target) is None:
+        reason = f"User '{target}' not found"
+    else:
+        uploads[transfer_id] = Upload(filename, filesize, target, group, encoding)
+        ready_msg = {"type": "file_transfer_ready", "transfer_id": transfer_id, "payload": "Ready to receive"}
+        queue_json(user_info, ready_msg)
+        return
+    
+    # Chunks already on their way are discarded (but still credited)
+    error_msg = {"type": "error", "transfer_id": transfer_id, "payload": f"File transfer failed - {reason}"}
+    queue_json(user_info, error_msg)
+
+
+def receive_file_chunk(user_info, transfer_id, data):
+    """Store one chunk of an upload, relaying the file once it is complete"""
+    nbytes = len(data)
+    FILE_BYTES_RECEIVED.inc(nbytes)
+    
+    upload = user_info.uploads.get(transfer_id) if user_info.uploads else None
+    if upload is not None and not upload.add(data):
+        del user_info.uploads[transfer_id]
+        upload = None
+        error_msg = {"type": "error", "transfer_id": transfer_id, "payload": "File transfer failed - invalid data"}
+        queue_json(user_info, error_msg)
+    
+    # Credit right away once a file is complete (so the next one can start at
+    # full speed) or its data is being discarded
+    complete = upload is not None and upload.complete()
+    credit_upload(user_info, nbytes, complete or upload is None)
+    
+    if complete:
+        del user_info.uploads[transfer_id]
+        if upload.encoded is not None:
+            FILE_COMPRESSION_SAVED_BYTES.inc(len(upload.data) - len(upload.encoded))
+        relay_file(user_info, upload.filename, upload.data, upload.target, transfer_id, upload.group, upload.encoded)
+
+
+def credit_upload(user_info, nbytes, flush):
+    """Credit consumed upload bytes back to the sender, in batches unless flush.
+
+    Over the sender's file rate limit the credit is withheld until the bytes
+    are paid off, which slows the sender down to match without holding up
+    the reader thread.
+    """
+    wait = user_info.file_bucket.reserve(nbytes)
+    with user_info.lock:
+        user_info.credit_due += nbytes
+        if wait > 0 and user_info.credit_timer is None:
+            user_info.credit_timer = start_credit_timer(user_info, wait)
+        if user_info.credit_timer is not None:
+            return
+        if not flush and user_info.credit_due < UPLOAD_CREDIT_BATCH:
+            return
+        credit, user_info.credit_due = user_info.credit_due, 0
+    queue_json(user_info, {"type": "file_credit", "payload": credit}, PRIORITY_SIGNAL)
+
+
+def start_credit_timer(user_info, wait):
+    """Run release_credit in wait seconds"""
+    timer = threading.Timer(wait, release_credit, (user_info,))
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+def release_credit(user_info):
+    """Send the withheld upload credit, or wait on if more was reserved meanwhile"""
+    wait = user_info.file_bucket.wait_time()
+    with user_info.lock:
+        if wait > 0:
+            user_info.credit_timer = start_credit_timer(user_info, wait)
+            return
+        user_info.credit_timer = None
+        credit, user_info.credit_due = user_info.credit_due, 0
+    if credit:
+        queue_json(user_info, {"type": "file_credit", "payload": credit}, PRIORITY_SIGNAL)
+
+
+def stats_snapshot():
+    """Current session, room and call counts plus running totals, for dashboards"""
     with clients_lock:
-        for username, user_info in list(clients.items()):
-            if username != sender and user_info['room'] == room:
-                send_file_to_user(user_info['socket'], sender, filename, filedata, username)
+        sessions = list(clients.values())
+    with rooms_lock:
+        room_count = len(rooms)
+    
+    return {
+        'sessions': len(sessions),
+        'rooms': room_count,
+        'calls': sum(1 for user_info in sessions if user_info.call_partner is not None) // 2,
+        'connections_accepted': CONNECTIONS_ACCEPTED.value,
+        'messages_received': MESSAGES_RECEIVED.total(),
+        'file_bytes_relayed': FILE_BYTES_RELAYED.value,
+        'voice_bytes_relayed': VOICE_BYTES_RELAYED.value,
+        'outbox_drops': OUTBOX_DROPS.value,
+        'log_records_dropped': chat_logging.LOG_RECORDS_DROPPED.value
+    }
 
 
-def handle_udp_voice():
+def heartbeat_monitor(stop):
+    """Ping idle clients and reap the ones that stopped answering"""
+    check_interval = min(HEARTBEAT_INTERVAL, DEAD_PEER_TIMEOUT / 3)
+    ping_frame = encode_message({"type": "ping", "payload": ""})
+    next_purge = time.monotonic()
+    
+    while not stop.wait(check_interval):
+        now = time.monotonic()
+        
+        if inbox is not None and now >= next_purge:
+            next_purge = now + INBOX_PURGE_INTERVAL
+            expired = inbox.purge_expired()
+            if expired:
+                log.info("INBOX", "Removed %d expired offline messages", expired)
+        
+        with clients_lock:
+            sessions = list(clients.items())
+        
+        for username, user_info in sessions:
+            detached_at = user_info.detached_at
+            if detached_at is not None:
+                if now - detached_at >= RESUME_GRACE:
+                    SESSIONS_EXPIRED.inc()
+                    log.info("EXPIRED", "%s did not resume", username, user=username)
+                    end_session(user_info, expired=True)
+                continue
+            
+            idle = now - user_info.last_seen
+            
+            # A client taking a large file may send nothing until it has it;
+            # the file data it acknowledges shows it is alive
+            if idle >= DEAD_PEER_TIMEOUT and not user_info.outbox.draining(user_info.socket, now):
+                if user_info.reaped:
+                    continue
+                user_info.reaped = True
+                SESSIONS_REAPED.inc()
+                log.info("REAPED", "%s silent for %.0fs", username, idle, user=username)
+                
+                # Wakes the handler thread, which then detaches the session
+                sock = user_info.socket
+                if sock is not None:
+                    user_info.outbox.detach(sock)
+                    try:
+                        sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+            
+            elif idle >= HEARTBEAT_INTERVAL:
+                if user_info.outbox.put(ping_frame, PRIORITY_SIGNAL):
+                    PINGS_SENT.inc()
+
+
+def handle_udp_voice(udp_sock, stop):
     """Handle UDP voice packets and forward them"""
-    global udp_socket
-    print(f"[UDP] Voice server listening on {HOST}:{UDP_PORT}")
+    # Wake up regularly so the thread notices stop_server
+    udp_sock.settimeout(1.0)
     
-    while True:
+    while not stop.is_set():
         try:
             # Receive voice data (username prefix + audio data)
-            data, addr = udp_socket.recvfrom(8192)
+            try:
+                data, addr = udp_sock.recvfrom(8192)
+            except socket.timeout:
+                continue
+            UDP_PACKETS_RECEIVED.inc()
             
             if len(data) < 2:
+                UDP_PACKETS_DROPPED.inc()
                 continue
             
             # First 2 bytes: username length
             username_len = struct.unpack('>H', data[:2])[0]
             
             if len(data) < 2 + username_len:
+                UDP_PACKETS_DROPPED.inc()
                 continue
             
             # Extract username
             username = data[2:2+username_len].decode('utf-8')
             
-            # Update client's UDP address
-            with clients_lock:
-                if username in clients:
-                    clients[username]['udp_addr'] = addr
+            # Update client's UDP address (voice traffic also counts as liveness)
+            user_info = get_session(username)
+            if user_info is None:
+                UDP_PACKETS_DROPPED.inc()
+                continue
+            user_info.udp_addr = addr
+            user_info.last_seen = time.monotonic()
             
-            # Get call partner
-            with calls_lock:
-                target = active_calls.get(username)
+            # Forward audio to call partner
+            partner_info = user_info.call_partner
+            target_addr = partner_info.udp_addr if partner_info is not None else None
             
-            if target:
-                # Forward audio to call partner
-                with clients_lock:
-                    if target in clients and 'udp_addr' in clients[target]:
-                        target_addr = clients[target]['udp_addr']
-                        # Send only the audio data (skip username header)
-                        audio_data = data[2+username_len:]
-                        udp_socket.sendto(audio_data, target_addr)
+            if target_addr is None:
+                UDP_PACKETS_DROPPED.inc()
+                continue
+            
+            # Send only the audio data (skip username header)
+            audio_data = data[2+username_len:]
+            udp_sock.sendto(audio_data, target_addr)
+            UDP_PACKETS_FORWARDED.inc()
+            VOICE_BYTES_RELAYED.inc(len(audio_data))
         
         except Exception as e:
-            print(f"[UDP ERROR] {e}")
+            if stop.is_set():
+                break
+            log.warning("UDP ERROR", "%s", e, sample=True)
             continue
 
 
-def handle_client(client_socket, client_address):
-    """Handle individual client connection"""
-    global active_calls, calls_lock
-    print(f"[NEW CONNECTION] {client_address} connected.")
+def detach_session(user_info, sock):
+    """Keep a session whose connection dropped, so the client can resume it"""
+    with user_info.lock:
+        if user_info.socket is not sock or not user_info.online:
+            return  # Already resumed on another connection, or ended
+        user_info.socket = None
+        user_info.detached_at = time.monotonic()
+    user_info.outbox.detach(sock)
+    log.info("DETACHED", "%s dropped, can resume for %ds", user_info.username, RESUME_GRACE, user=user_info.username)
+
+
+def resume_session(token, sock):
+    """Move the session holding token onto a new connection, return it or None"""
+    with clients_lock:
+        user_info = resume_tokens.get(token)
+    if user_info is None:
+        return None
+    with user_info.lock:
+        if not user_info.online:
+            return None
+        old_sock = user_info.socket
+        user_info.socket = sock
+        user_info.detached_at = None
+    
+    if old_sock is not None:
+        # The old connection has not noticed it is gone yet
+        user_info.outbox.detach(old_sock)
+        try:
+            old_sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    user_info.last_seen = time.monotonic()
+    user_info.reaped = False
+    return user_info
+
+
+def end_session(user_info, expired=False):
+    """Log a session out: end its call, leave its room and tell everyone.
+
+    With expired, only if the session is still waiting for a resume.
+    """
+    username = user_info.username
+    
+    # No new call can be set up with this session from here on
+    with user_info.lock:
+        if not user_info.online or (expired and user_info.socket is not None):
+            return
+        user_info.online = False
+    
+    # End any active call and notify partner
+    partner_info = end_call(user_info)
+    if partner_info is not None:
+        call_ended = {
+            "type": "call_ended",
+            "payload": f"{username} disconnected"
+        }
+        queue_json(partner_info, call_ended, PRIORITY_SIGNAL)
+    
+    if user_info.room is not None:
+        leave_room(user_info.room, user_info)
+    
+    with clients_lock:
+        if clients.get(username) is user_info:
+            del clients[username]
+        resume_tokens.pop(user_info.token, None)
+    user_info.outbox.close()
+    
+    log.info("DISCONNECTED", "%s left the chat.", username, user=username)
+    
+    # Notify other clients
+    leave_msg = {"type": "notification", "payload": f"{username} left the chat!"}
+    broadcast(leave_msg, user_info.id)
+    
+    # Broadcast updated active users list
+    broadcast_active_users()
+
+
+def handle_client(client_socket, client_address, secure=None):
+    """Handle individual client connection, after the TLS handshake if secure is given"""
+    log.info("NEW CONNECTION", "%s connected.", client_address, addr=client_address)
     username = None
+    user_info = None
+    logged_out = False
+    logging_in = True
     
     try:
+        if secure is not None:
+            client_socket = secure(client_socket)
+            TLS_HANDSHAKES.inc()
+            if client_socket.session_reused:
+                TLS_RESUMED.inc()
+        
         # Wait for login message with username
-        client_socket.settimeout(30)  # 30 second timeout for login
-        data = client_socket.recv(1024).decode('utf-8')
+        client_socket.settimeout(LOGIN_TIMEOUT)
+        buffer = bytearray()
+        line = read_frame(client_socket, buffer)
         
-        if not data:
+        if line is None:
             client_socket.close()
             return
         
         # Parse login message
         try:
-            message = json.loads(data.strip())
+            message = protocol.decode(line)
             if message.get("type") == "login":
+                MESSAGES_RECEIVED.labels("login").inc()
                 username = message.get("payload", "").strip()
                 
                 if not username:
@@ -224,91 +1764,179 @@ def handle_client(client_socket, client_address):
                     client_socket.close()
                     return
                 
-                # Check if username already exists
+                # From here on everything sent to this client goes through its outbox
+                new_info = Session(username, client_socket)
+                username = new_info.username  # Interned
+                
+                # Check if username already exists, otherwise claim it
                 with clients_lock:
-                    if username in clients:
-                        error_msg = {"type": "error", "payload": "Username already taken"}
-                        send_json(client_socket, error_msg)
-                        client_socket.close()
-                        return
-                    
-                    # Add client to dictionary with default room
-                    clients[username] = {
-                        'socket': client_socket,
-                        'room': DEFAULT_ROOM
-                    }
+                    taken = username in clients
+                    if not taken:
+                        clients[username] = new_info
+                        resume_tokens[new_info.token] = new_info
+                
+                if taken:
+                    error_msg = {"type": "error", "payload": "Username already taken"}
+                    send_json(client_socket, error_msg)
+                    client_socket.close()
+                    return
+                
+                user_info = new_info
+                features = [f for f in message.get("features") or () if f in protocol.SERVER_FEATURES]
+                user_info.compress = protocol.COMPRESSION_FEATURE in features
+                user_info.file_compress = protocol.FILE_COMPRESSION_FEATURE in features
+                user_info.file_chunks = protocol.FILE_CHUNKS_FEATURE in features
+                user_info.room = enter_room(DEFAULT_ROOM, user_info)
                 
-                print(f"[LOGIN] {username} ({client_address}) logged in.")
+                log.info("LOGIN", "%s (%s) logged in.", username, client_address, user=username, addr=client_address)
                 
                 # Send success message
-                success_msg = {"type": "login_success", "payload": f"Welcome, {username}!"}
-                send_json(client_socket, success_msg)
+                success_msg = {
+                    "type": "login_success",
+                    "payload": f"Welcome, {username}!",
+                    "features": features,
+                    "token": user_info.token,
+                    "resume_grace": RESUME_GRACE,
+                    "upload_window": FILE_UPLOAD_WINDOW
+                }
+                queue_json(user_info, success_msg, PRIORITY_SIGNAL)
                 
-                # Send initial room info to the new user
-                send_room_info(client_socket, username)
+                # Send initial room info to the new user, then anything
+                # that was sent to them while they were offline
+                send_room_info(username)
+                if inbox is not None:
+                    inbox.remember_user(username)
+                    deliver_inbox(user_info)
                 
                 # Notify all clients in the same room about new user
                 join_msg = {"type": "notification", "payload": f"{username} joined the chat!"}
-                broadcast(join_msg, username, DEFAULT_ROOM)
+                broadcast(join_msg, user_info.id, user_info.room)
                 
                 # Broadcast updated active users list
                 broadcast_active_users()
+            
+            elif message.get("type") == "resume":
+                MESSAGES_RECEIVED.labels("resume").inc()
+                user_info = resume_session(message["payload"], client_socket)
+                if user_info is None:
+                    error_msg = {"type": "error", "code": "resume_failed", "payload": "Session expired, please log in again"}
+                    send_json(client_socket, error_msg)
+                    client_socket.close()
+                    return
+                username = user_info.username
+                
+                # Upload data that was in flight is lost with the old
+                # connection; the client starts over with a full window
+                user_info.uploads = None
+                with user_info.lock:
+                    user_info.credit_due = 0
+                
+                # Confirmed before the numbered frames continue, so the
+                # client does not count it
+                send_json(client_socket, {"type": "resume_success", "payload": f"Welcome back, {username}!"})
+                resent = user_info.outbox.attach(client_socket, message["last_seq"])
+                if resent is None:
+                    # Too much was missed, send the current state instead
+                    send_room_info(username)
+                    with clients_lock:
+                        user_list = list(clients.keys())
+                    queue_json(user_info, {"type": "user_list", "payload": user_list})
+                else:
+                    FRAMES_REPLAYED.inc(resent)
+                deliver_inbox(user_info)
+                SESSIONS_RESUMED.inc()
+                log.info("RESUMED", "%s (%s) resumed, %s frames resent", username, client_address,
+                         resent if resent is not None else "no", user=username, addr=client_address)
                 
             else:
                 client_socket.close()
                 return
-        except json.JSONDecodeError:
+        except protocol.ProtocolError:
             client_socket.close()
             return
         
-        # Remove timeout for regular messaging
+        # Remove timeout for regular messaging; liveness is tracked by the
+        # heartbeat monitor instead
         client_socket.settimeout(None)
+        logging_in = False
+        login_finished()
         
-        # Handle messages from client
-        buffer = ""
+        # Handle messages from client; anything read along with the login
+        # frame is already in buffer
         while True:
-            data = client_socket.recv(1024).decode('utf-8')
-            
-            if not data:
-                break
-            
-            buffer += data
-            
-            # Process complete JSON messages (separated by newlines)
-            while "\n" in buffer:
-                line, buffer = buffer.split("\n", 1)
+            # Process complete frames: JSON (newline-terminated or
+            # compressed) and upload chunks
+            while True:
+                try:
+                    if buffer and buffer[0] == protocol.FILE_CHUNK_MARKER:
+                        chunk = protocol.pop_file_chunk(buffer)
+                        if chunk is None:
+                            break
+                        receive_file_chunk(user_info, *chunk)
+                        user_info.last_seen = time.monotonic()
+                        continue
+                    line = protocol.pop_frame(buffer)
+                except protocol.ProtocolError as e:
+                    log.warning("ERROR", "Unreadable frame from %s: %s", username, e)
+                    return
+                if line is None:
+                    break
                 line = line.strip()
                 
                 if not line:
                     continue
                 
                 try:
-                    message = json.loads(line)
+                    message = protocol.decode(line)
                     msg_type = message.get("type")
                     payload = message.get("payload")
+                    MESSAGES_RECEIVED.labels(msg_type if msg_type in protocol.MESSAGE_SCHEMAS else "unknown").inc()
                     
-                    if msg_type == "message" and payload:
+                    # Over-limit chat and control requests are rejected; file
+                    # data is slowed by withholding credit, or refused for a while from older clients
+                    if msg_type in RATE_LIMITED_MESSAGES:
+                        bucket = getattr(user_info, RATE_LIMITED_MESSAGES[msg_type])
+                        if not bucket.consume():
+                            RATE_LIMITED.labels(msg_type).inc()
+                            error_msg = {"type": "error", "payload": "Rate limit exceeded, request dropped"}
+                            queue_json(user_info, error_msg)
+                            continue
+                    
+                    if msg_type == "ping":
+                        queue_json(user_info, {"type": "pong", "payload": payload}, PRIORITY_SIGNAL)
+                    
+                    elif msg_type == "pong":
+                        # Heartbeat answer, last_seen is already updated
+                        pass
+                    
+                    elif msg_type == "message" and payload:
                         # Get user's current room
-                        with clients_lock:
-                            user_room = clients[username]['room']
+                        user_room = user_info.room
                         
-                        print(f"[{username}@{user_room}] {payload}")
+                        if not user_room.bucket.consume():
+                            RATE_LIMITED.labels("room").inc()
+                            error_msg = {"type": "error", "payload": f"Room '{user_room.name}' is busy, message dropped"}
+                            queue_json(user_info, error_msg)
+                            continue
+                        
+                        log.info("CHAT", "%s@%s: %s", username, user_room.name, payload,
+                                 sample=True, user=username, room=user_room.name, size=len(payload))
                         
                         # Broadcast chat message to users in the same room
                         chat_msg = {
                             "type": "message",
                             "sender": username,
-                            "room": user_room,
+                            "room": user_room.name,
                             "payload": payload
                         }
-                        broadcast(chat_msg, username, user_room)
+                        broadcast(chat_msg, user_info.id, user_room)
                     
                     elif msg_type == "private_message":
                         target = message.get("target")
                         msg = message.get("payload")
                         
                         if target and msg:
-                            print(f"[PRIVATE] {username} -> {target}: {msg}")
+                            log.info("PRIVATE", "%s -> %s", username, target, sample=True, user=username, target=target)
                             
                             if send_private_message(username, target, msg):
                                 # Send confirmation to sender
@@ -317,27 +1945,77 @@ def handle_client(client_socket, client_address):
                                     "target": target,
                                     "payload": msg
                                 }
-                                send_json(client_socket, confirm_msg)
+                                queue_json(user_info, confirm_msg)
                             else:
-                                # User not found
-                                error_msg = {
-                                    "type": "error",
-                                    "payload": f"User '{target}' not found or offline"
-                                }
-                                send_json(client_socket, error_msg)
+                                # Offline: keep it for the target's next login
+                                result = store_private_message(username, target, msg)
+                                if result == offline_inbox.STORED:
+                                    confirm_msg = {
+                                        "type": "private_sent",
+                                        "target": target,
+                                        "payload": msg,
+                                        "queued": True
+                                    }
+                                    queue_json(user_info, confirm_msg)
+                                else:
+                                    if result == offline_inbox.INBOX_FULL:
+                                        error_text = f"User '{target}' is offline and their inbox is full"
+                                    else:
+                                        error_text = f"User '{target}' not found"
+                                    error_msg = {"type": "error", "payload": error_text}
+                                    queue_json(user_info, error_msg)
+                    
+                    elif msg_type == "logout":
+                        logged_out = True
+                        return
+                    
+                    elif msg_type == "ack":
+                        # Cumulative: the client has every room message up to payload
+                        if message["room"] == user_info.room.name:
+                            user_info.acked_seq = payload
+                    
+                    elif msg_type == "resend":
+                        user_room = user_info.room
+                        if message["room"] != user_room.name:
+                            continue
+                        seqs = [seq for seq in payload[:MAX_RESEND] if type(seq) is int]
+                        frames, missing = user_room.recent(seqs)
+                        for frame in frames:
+                            user_info.outbox.put(compress_for(user_info, frame), PRIORITY_CHAT)
+                        ROOM_MESSAGES_RESENT.inc(len(frames))
+                        if missing:
+                            unavailable_msg = {"type": "resend_unavailable", "room": user_room.name, "payload": missing}
+                            queue_json(user_info, unavailable_msg)
+                    
+                    elif msg_type == "file_group":
+                        # A batch upload; its files follow as chunked uploads
+                        start_file_group(user_info, message.get("group"), message.get("count"),
+                                         message.get("filesize"), message.get("target"))
+                    
+                    elif msg_type == "file_group_end":
+                        end_file_group(user_info, message.get("group"))
+                    
+                    elif msg_type == "inbox_ack":
+                        # Acks cannot reach past what was actually sent
+                        last_id = min(payload, user_info.inbox_sent)
+                        if inbox is not None and last_id > 0:
+                            inbox.ack(username, last_id)
+                            if last_id == user_info.inbox_sent:
+                                deliver_inbox(user_info)
                     
                     elif msg_type == "join_room":
                         new_room = payload.strip() if payload else DEFAULT_ROOM
                         
                         if not new_room:
                             error_msg = {"type": "error", "payload": "Room name cannot be empty"}
-                            send_json(client_socket, error_msg)
+                            queue_json(user_info, error_msg)
                             continue
                         
-                        old_room = change_user_room(username, new_room)
+                        old_room = change_user_room(user_info, new_room)
                         
                         if old_room:
-                            print(f"[ROOM] {username} moved from '{old_room}' to '{new_room}'")
+                            log.info("ROOM", "%s moved from '%s' to '%s'", username, old_room, new_room,
+                                     user=username, room=new_room)
                             
                             # Notify old room that user left
                             if old_room != new_room:
@@ -345,36 +2023,31 @@ def handle_client(client_socket, client_address):
                                     "type": "notification",
                                     "payload": f"{username} left the room"
                                 }
-                                broadcast(leave_notif, username, old_room)
+                                broadcast(leave_notif, user_info.id, old_room)
                             
                             # Notify new room that user joined
                             join_notif = {
                                 "type": "notification",
                                 "payload": f"{username} joined the room"
                             }
-                            broadcast(join_notif, username, new_room)
+                            broadcast(join_notif, user_info.id, user_info.room)
                             
                             # Send room info to the user who joined
-                            send_room_info(client_socket, username)
+                            send_room_info(username)
                             
                             # Broadcast updated user list to everyone
                             broadcast_active_users()
                     
                     elif msg_type == "list_rooms":
-                        # Get all unique rooms
-                        with clients_lock:
-                            rooms = {}
-                            for uname, info in clients.items():
-                                room = info['room']
-                                if room not in rooms:
-                                    rooms[room] = []
-                                rooms[room].append(uname)
+                        # Get all non-empty rooms
+                        with rooms_lock:
+                            room_objs = list(rooms.values())
                         
                         room_list_msg = {
                             "type": "room_list",
-                            "payload": rooms
+                            "payload": {room.name: room.member_names() for room in room_objs}
                         }
-                        send_json(client_socket, room_list_msg)
+                        queue_json(user_info, room_list_msg)
                     
                     elif msg_type == "call_request":
                         # Handle voice call request
@@ -382,115 +2055,105 @@ def handle_client(client_socket, client_address):
                         
                         if not target:
                             error_msg = {"type": "error", "payload": "Invalid call request"}
-                            send_json(client_socket, error_msg)
+                            queue_json(user_info, error_msg)
                             continue
                         
-                        with clients_lock:
-                            if target not in clients:
-                                error_msg = {"type": "error", "payload": f"User '{target}' not found"}
-                                send_json(client_socket, error_msg)
-                                continue
-                            
-                            target_socket = clients[target]['socket']
+                        target_info = get_session(target)
+                        
+                        if target_info is None:
+                            error_msg = {"type": "error", "payload": f"User '{target}' not found"}
+                            queue_json(user_info, error_msg)
+                            continue
                         
-                        # Check if either user is already in a call
-                        with calls_lock:
-                            if username in active_calls or target in active_calls:
-                                error_msg = {"type": "error", "payload": "User is already in a call"}
-                                send_json(client_socket, error_msg)
-                                continue
+                        # Check if either user is already in a call (call_accept
+                        # checks again when the call is actually set up)
+                        if user_info.call_partner is not None or target_info.call_partner is not None:
+                            error_msg = {"type": "error", "payload": "User is already in a call"}
+                            queue_json(user_info, error_msg)
+                            continue
                         
-                        print(f"[CALL] {username} calling {target}")
+                        log.info("CALL", "%s calling %s", username, target)
                         
                         # Send call request to target
                         call_notif = {
                             "type": "call_incoming",
                             "payload": username
                         }
-                        send_json(target_socket, call_notif)
+                        queue_json(target_info, call_notif, PRIORITY_SIGNAL)
                         
                         # Send confirmation to caller
                         call_confirm = {
                             "type": "call_ringing",
                             "payload": f"Calling {target}..."
                         }
-                        send_json(client_socket, call_confirm)
+                        queue_json(user_info, call_confirm, PRIORITY_SIGNAL)
                     
                     elif msg_type == "call_accept":
                         # Handle call acceptance
                         caller = payload
                         
-                        with clients_lock:
-                            if caller not in clients:
-                                error_msg = {"type": "error", "payload": "Caller not found"}
-                                send_json(client_socket, error_msg)
-                                continue
-                            
-                            caller_socket = clients[caller]['socket']
+                        caller_info = get_session(caller)
+                        
+                        if caller_info is None:
+                            error_msg = {"type": "error", "payload": "Caller not found"}
+                            queue_json(user_info, error_msg)
+                            continue
                         
                         # Establish call
-                        with calls_lock:
-                            active_calls[username] = caller
-                            active_calls[caller] = username
+                        if not start_call(caller_info, user_info):
+                            error_msg = {"type": "error", "payload": "User is already in a call"}
+                            queue_json(user_info, error_msg)
+                            continue
                         
-                        print(f"[CALL] {username} accepted call from {caller}")
+                        log.info("CALL", "%s accepted call from %s", username, caller)
                         
                         # Notify both users
                         call_started = {
                             "type": "call_started",
                             "payload": username
                         }
-                        send_json(caller_socket, call_started)
+                        queue_json(caller_info, call_started, PRIORITY_SIGNAL)
                         
                         call_started_self = {
                             "type": "call_started",
                             "payload": caller
                         }
-                        send_json(client_socket, call_started_self)
+                        queue_json(user_info, call_started_self, PRIORITY_SIGNAL)
                     
                     elif msg_type == "call_reject":
                         # Handle call rejection
                         caller = payload
                         
-                        with clients_lock:
-                            if caller in clients:
-                                caller_socket = clients[caller]['socket']
-                                call_rejected = {
-                                    "type": "call_rejected",
-                                    "payload": f"{username} declined the call"
-                                }
-                                send_json(caller_socket, call_rejected)
+                        caller_info = get_session(caller)
+                        
+                        if caller_info is not None:
+                            call_rejected = {
+                                "type": "call_rejected",
+                                "payload": f"{username} declined the call"
+                            }
+                            queue_json(caller_info, call_rejected, PRIORITY_SIGNAL)
                         
-                        print(f"[CALL] {username} rejected call from {caller}")
+                        log.info("CALL", "%s rejected call from %s", username, caller)
                     
                     elif msg_type == "call_end":
                         # Handle call termination
-                        with calls_lock:
-                            partner = active_calls.get(username)
-                            if partner:
-                                del active_calls[username]
-                                if username in active_calls.values():
-                                    # Remove reverse mapping
-                                    active_calls = {k: v for k, v in active_calls.items() if v != username}
-                        
-                        if partner:
-                            with clients_lock:
-                                if partner in clients:
-                                    partner_socket = clients[partner]['socket']
-                                    call_ended = {
-                                        "type": "call_ended",
-                                        "payload": f"{username} ended the call"
-                                    }
-                                    send_json(partner_socket, call_ended)
+                        partner_info = end_call(user_info)
+                        
+                        if partner_info is not None:
+                            call_ended = {
+                                "type": "call_ended",
+                                "payload": f"{username} ended the call"
+                            }
+                            queue_json(partner_info, call_ended, PRIORITY_SIGNAL)
                             
-                            print(f"[CALL] Call ended between {username} and {partner}")
+                            log.info("CALL", "Call ended between %s and %s", username, partner_info.username)
                         
                         # Confirm to sender
                         call_ended_self = {
                             "type": "call_ended",
                             "payload": "Call ended"
                         }
-                        send_json(client_socket, call_ended_self)
+                        queue_json(user_info, call_ended_self, PRIORITY_SIGNAL)
                     
                     elif msg_type == "file_transfer":
                         # Handle file transfer with header-body protocol
@@ -498,175 +2161,511 @@ def handle_client(client_socket, client_address):
                         filesize = message.get("filesize")
                         target = message.get("target")  # None for room, username for private
                         
-                        if not filename or not filesize:
-                            error_msg = {"type": "error", "payload": "Invalid file transfer request"}
-                            send_json(client_socket, error_msg)
+                        if not filename or filesize <= 0:
+                            error_msg = {"type": "error", "transfer_id": message.get("transfer_id"),
+                                         "payload": "Invalid file transfer request"}
+                            queue_json(user_info, error_msg)
                             continue
                         
-                        print(f"[FILE TRANSFER] {username} sending {filename} ({filesize} bytes)")
+                        log.info("FILE TRANSFER", "%s sending %s (%s bytes)", username, filename, filesize,
+                                 user=username, size=filesize, target=target)
+                        
+                        transfer_id = message.get("transfer_id")
+                        if transfer_id is not None:
+                            # Chunked upload, the data follows as chunk frames
+                            start_upload(user_info, transfer_id, filename, filesize, target,
+                                         message.get("group"), message.get("encoding"))
+                            continue
                         
-                        # Send acknowledgment to start binary transfer
+                        # Older clients: the raw data follows the header
+                        # directly. Send acknowledgment to start binary transfer
                         ack_msg = {"type": "file_transfer_ready", "payload": "Ready to receive"}
-                        send_json(client_socket, ack_msg)
+                        queue_json(user_info, ack_msg)
                         
-                        # Read binary file size header (4 bytes)
-                        size_data = client_socket.recv(4)
-                        if len(size_data) != 4:
-                            print(f"[ERROR] Invalid file size header from {username}")
+                        # Read binary file size header (4 bytes), which may
+                        # already have been read along with the JSON header
+                        while len(buffer) < 4:
+                            data = client_socket.recv(RECV_SIZE)
+                            if not data:
+                                break
+                            buffer += data
+                        
+                        if len(buffer) < 4:
+                            log.warning("ERROR", "Invalid file size header from %s", username)
                             continue
                         
+                        size_data = bytes(buffer[:4])
+                        del buffer[:4]
                         expected_size = struct.unpack('>I', size_data)[0]
                         
                         if expected_size != filesize:
-                            print(f"[ERROR] File size mismatch from {username}")
+                            log.warning("ERROR", "File size mismatch from %s", username)
                             continue
                         
-                        # Receive raw binary data in chunks
-                        filedata = b''
-                        remaining = filesize
+                        # Receive raw binary data in chunks. The buffer grows as
+                        # data arrives; a file over the size limit, or sent
+                        # while the sender's earlier files are still over its
+                        # file rate limit, is read and discarded, which keeps
+                        # the stream in step
+                        too_large = filesize > MAX_UPLOAD_BYTES
+                        retry_after = 0
+                        if not too_large:
+                            retry_after = math.ceil(user_info.file_bucket.wait_time())
+                            if not retry_after:
+                                user_info.file_bucket.reserve(filesize)
+                        discard = too_large or retry_after
+                        filedata = bytearray()
                         
-                        while remaining > 0:
-                            chunk_size = min(4096, remaining)
-                            chunk = client_socket.recv(chunk_size)
+                        # Start with whatever is already buffered
+                        received = min(len(buffer), filesize)
+                        if not discard:
+                            filedata += buffer[:received]
+                        del buffer[:received]
+                        
+                        while received < filesize:
+                            data = client_socket.recv(min(FILE_CHUNK_SIZE, filesize - received))
                             
-                            if not chunk:
-                                print(f"[ERROR] Connection lost during file transfer from {username}")
+                            if not data:
+                                log.warning("ERROR", "Connection lost during file transfer from %s", username)
                                 break
                             
-                            filedata += chunk
-                            remaining -= len(chunk)
+                            received += len(data)
+                            if not discard:
+                                filedata += data
+                            user_info.last_seen = time.monotonic()
                         
-                        if len(filedata) == filesize:
-                            print(f"[FILE RECEIVED] {filename} ({len(filedata)} bytes) from {username}")
-                            
-                            # Send confirmation to sender
-                            confirm_msg = {
-                                "type": "file_sent_confirm",
-                                "payload": f"File '{filename}' sent successfully"
+                        FILE_BYTES_RECEIVED.inc(received)
+                        if retry_after:
+                            RATE_LIMITED.labels("file_transfer").inc()
+                            error_msg = {
+                                "type": "error",
+                                "payload": f"File transfer failed - Rate limit exceeded, try again in {retry_after} seconds",
+                                "retry_after": retry_after
                             }
-                            send_json(client_socket, confirm_msg)
-                            
-                            # Forward file to target or room
-                            if target:
-                                # Private file transfer
-                                with clients_lock:
-                                    if target in clients:
-                                        send_file_to_user(
-                                            clients[target]['socket'],
-                                            username,
-                                            filename,
-                                            filedata,
-                                            target
-                                        )
-                                    else:
-                                        error_msg = {
-                                            "type": "error",
-                                            "payload": f"User '{target}' not found"
-                                        }
-                                        send_json(client_socket, error_msg)
-                            else:
-                                # Broadcast to room
-                                with clients_lock:
-                                    user_room = clients[username]['room']
-                                broadcast_file(filedata, filename, username, user_room)
+                            queue_json(user_info, error_msg)
+                        elif too_large:
+                            error_msg = {
+                                "type": "error",
+                                "payload": f"File transfer failed - File too large (at most {MAX_UPLOAD_BYTES // (1024 * 1024)} MB)"
+                            }
+                            queue_json(user_info, error_msg)
+                        elif received == filesize:
+                            relay_file(user_info, filename, filedata, target)
                         else:
-                            print(f"[ERROR] File transfer incomplete from {username}")
+                            log.warning("ERROR", "File transfer incomplete from %s", username)
                             error_msg = {
                                 "type": "error",
                                 "payload": "File transfer failed - incomplete data"
                             }
-                            send_json(client_socket, error_msg)
+                            queue_json(user_info, error_msg)
                         
-                except json.JSONDecodeError:
-                    print(f"[ERROR] Invalid JSON from {username}")
+                except protocol.ProtocolError as e:
+                    log.warning("ERROR", "Invalid message from %s: %s", username, e, sample=True)
+                    error_msg = {"type": "error", "payload": "Invalid message"}
+                    queue_json(user_info, error_msg)
                     continue
-                
+            
+            data = client_socket.recv(RECV_SIZE)
+            
+            if not data:
+                break
+            
+            user_info.last_seen = time.monotonic()
+            buffer += data
+    
     except socket.timeout:
-        print(f"[TIMEOUT] {client_address} did not login in time.")
+        log.info("TIMEOUT", "%s did not login in time.", client_address)
     except Exception as e:
-        print(f"[ERROR] {client_address}: {e}")
+        log.error("ERROR", "%s: %s", client_address, e)
     
     finally:
-        # Remove client from dictionary and close connection
-        if username:
-            # End any active call
-            with calls_lock:
-                partner = active_calls.get(username)
-                if partner:
-                    del active_calls[username]
-                    if partner in active_calls:
-                        del active_calls[partner]
-                    
-                    # Notify partner
-                    with clients_lock:
-                        if partner in clients:
-                            partner_socket = clients[partner]['socket']
-                            call_ended = {
-                                "type": "call_ended",
-                                "payload": f"{username} disconnected"
-                            }
-                            send_json(partner_socket, call_ended)
-            
-            with clients_lock:
-                if username in clients:
-                    del clients[username]
-            
-            print(f"[DISCONNECTED] {username} ({client_address}) left the chat.")
-            
-            # Notify other clients
-            leave_msg = {"type": "notification", "payload": f"{username} left the chat!"}
-            broadcast(leave_msg, username)
-            
-            # Broadcast updated active users list
-            broadcast_active_users()
+        # A dropped connection leaves the session waiting for a resume; an
+        # explicit logout or a server shutdown ends it right away
+        if user_info is not None:
+            if logged_out or (stop_event is not None and stop_event.is_set()):
+                end_session(user_info)
+            else:
+                detach_session(user_info, client_socket)
         
         try:
             client_socket.close()
         except:
             pass
+        if logging_in:
+            login_finished()
+        connection_closed()
+
+
+def admit_connection():
+    """Count a new connection in, or return (reason, retry_after) if it has to be turned away"""
+    global open_connections, pending_logins
+    bucket = accept_bucket
+    if bucket is not None and not bucket.consume():
+        reason = "rate"
+    else:
+        with admission_lock:
+            if open_connections >= MAX_CONNECTIONS:
+                reason = "connections"
+            elif pending_logins >= MAX_PENDING_LOGINS:
+                reason = "logins"
+            else:
+                open_connections += 1
+                pending_logins += 1
+                return None
+    CONNECTIONS_REJECTED.labels(reason).inc()
+    return reason, round(BUSY_RETRY_AFTER * random.uniform(1, 2), 1)
+
+
+def login_finished():
+    global pending_logins
+    with admission_lock:
+        pending_logins -= 1
+
 
+def connection_closed():
+    global open_connections
+    with admission_lock:
+        open_connections -= 1
+
+
+def busy_message(reason, retry_after):
+    return {
+        "type": "error",
+        "code": "server_busy",
+        "payload": f"Server busy ({reason}), try again in {retry_after:g} seconds",
+        "retry_after": retry_after
+    }
+
+
+def reject_connection(sock, reason, retry_after, plaintext=True):
+    """Close a connection that was not admitted, telling a plaintext client when to come back.
+
+    Nothing here blocks the accept loop: the error is sent only if it fits
+    the socket buffer, and what the client already sent is read first so
+    the close does not reset the connection before the error arrives.
+    """
+    log.info("BUSY", "Turned away a connection (%s), retry after %ss", reason, retry_after, sample=True)
+    try:
+        if plaintext:
+            sock.setblocking(False)
+            try:
+                sock.recv(RECV_SIZE)
+            except BlockingIOError:
+                pass
+            sock.send(encode_message(busy_message(reason, retry_after)))
+            sock.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+    sock.close()
 
-def start_server():
-    """Initialize and start the TCP server"""
-    global udp_socket
+
+def post_bot_messages(bot, batch):
+    """Deliver a bot API batch of (room, sender, text), return the response body.
+
+    Bots have their own rate limit instead of the rooms' one. Messages for
+    rooms nobody is in are not kept, like room messages nobody receives.
+    """
+    if not bot_buckets[bot].consume(len(batch)):
+        RATE_LIMITED.labels("bot").inc()
+        raise bot_api.BotApiError(429, "Rate limit exceeded, batch dropped",
+                                  retry_after=int(len(batch) / BOT_MESSAGE_RATE[0]) + 1)
     
-    # Setup TCP server
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind((HOST, PORT))
-    server.listen()
+    # Per room in order, so each room's members get the batch in one go
+    by_room = {}
+    for room_name, sender, text in batch:
+        by_room.setdefault(room_name, []).append({
+            "type": "message",
+            "sender": f"{sender} [{bot}]" if sender else bot,
+            "bot": bot,
+            "payload": text
+        })
     
-    print(f"[LISTENING] TCP Server is listening on {HOST}:{PORT}")
+    delivered = {}
+    missing = []
+    for room_name, message_dicts in by_room.items():
+        room = get_room(room_name)
+        if room is None:
+            missing.append(room_name)
+        else:
+            delivered[room_name] = broadcast_batch(room, message_dicts)
     
-    # Setup UDP server for voice
-    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_socket.bind((HOST, UDP_PORT))
+    BOT_MESSAGES.labels(bot).inc(len(batch))
+    log.info("BOT", "%s posted %d messages to %d rooms", bot, len(batch), len(by_room), sample=True, user=bot)
+    return {"accepted": len(batch), "recipients": delivered, "missing_rooms": missing}
+
+
+def open_bot_api(host, port):
+    """Start the bot API for the configured bots, return it or None if it cannot be started"""
+    global bot_buckets
+    bot_buckets = {name: TokenBucket(*BOT_MESSAGE_RATE) for name in BOT_TOKENS.values()}
+    try:
+        httpd = bot_api.start_bot_api(host, port, BOT_TOKENS, post_bot_messages)
+    except OSError as e:
+        log.warning("BOT API", "Endpoint disabled: %s", e)
+        return None
+    log.info("BOT API", "Serving http://%s:%s%s for %d bots", host, port, bot_api.BOT_PATH, len(bot_buckets))
+    return httpd
+
+
+def handle_websocket(connection, client_address):
+    """Handle a browser connected through the WebSocket gateway, like any other client.
+
+    The connection was admitted when the gateway accepted it and still
+    counts as logging in.
+    """
+    enable_keepalive(connection.sock)
+    WEBSOCKET_CONNECTIONS.inc()
+    handle_client(connection, client_address)
+
+
+def admit_gateway_connection():
+    """Admission control for a socket the gateway accepted, before it gets a thread"""
+    CONNECTIONS_ACCEPTED.inc()
+    rejected = admit_connection()
+    if rejected is not None:
+        log.info("BUSY", "Turned away a gateway connection (%s), retry after %ss", *rejected, sample=True)
+    return rejected
+
+
+def release_gateway_connection():
+    """An admitted gateway connection ended without becoming a WebSocket"""
+    login_finished()
+    connection_closed()
+
+
+def open_gateway(host, port):
+    """Start the WebSocket gateway, return it or None if it cannot be started"""
+    try:
+        ssl_context = transport.server_context(TLS_CERTFILE, TLS_KEYFILE) if TLS_CERTFILE else None
+        gateway = ws_gateway.start_gateway(host, port, handle_websocket, ssl_context,
+                                           admit_gateway_connection, release_gateway_connection)
+    except OSError as e:
+        # Like the metrics endpoint, a busy port should not keep the chat server down
+        log.warning("GATEWAY", "WebSocket gateway disabled: %s", e)
+        return None
+    scheme = "https" if ssl_context else "http"
+    log.info("GATEWAY", "Serving browsers on %s://%s:%s", scheme, host, port)
+    return gateway
+
+
+def open_listeners(urls):
+    """Open a transport.Listener for each URL, closing them all if one fails"""
+    ssl_context = None
+    opened = []
+    try:
+        for url in urls:
+            if transport.parse_url(url)[0] == transport.TLS and ssl_context is None:
+                if not TLS_CERTFILE:
+                    raise ValueError(f"{url} needs a certificate (TLS_CERTFILE)")
+                ssl_context = transport.server_context(TLS_CERTFILE, TLS_KEYFILE)
+            opened.append(transport.Listener(url, ssl_context, LISTEN_BACKLOG))
+    except:
+        for listener in opened:
+            listener.close()
+        raise
+    return opened
+
+
+def open_server(host=HOST, port=PORT, udp_port=UDP_PORT, listen_urls=None):
+    """Bind the listening and UDP sockets and start the background threads, return the TCP listener.
+
+    Listeners for listen_urls (default LISTEN_URLS) are served on threads of
+    their own; the TCP listener is left to serve().
+    """
+    global server_socket, udp_socket, listeners, web_gateway, bot_server, fanout_queues, stop_event, metrics_server, inbox
+    global accept_bucket
+    
+    chat_logging.setup_logging()
+    
+    # Setup TCP server, and any further transports
+    server = transport.Listener(transport.format_url(transport.TCP, (host, port)), backlog=LISTEN_BACKLOG)
+    try:
+        extra = open_listeners(LISTEN_URLS if listen_urls is None else listen_urls)
+        
+        # Setup UDP server for voice
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            udp.bind((host, udp_port))
+        except OSError:
+            udp.close()
+            for listener in extra:
+                listener.close()
+            raise
+    except:
+        server.close()
+        raise
+    
+    server_socket, udp_socket, listeners = server, udp, extra
+    stop_event = threading.Event()
+    accept_bucket = TokenBucket(*ACCEPT_RATE)
+    
+    # Like the metrics endpoint, the inbox stays open across restarts
+    if inbox is None:
+        inbox = offline_inbox.OfflineInbox(INBOX_FILE)
+    
+    log.info("LISTENING", "TCP Server is listening on %s:%s", host, port)
+    for listener in extra:
+        log.info("LISTENING", "Also listening on %s", listener.url)
+        threading.Thread(target=serve, args=(listener,), daemon=True).start()
+    log.info("UDP", "Voice server listening on %s:%s", host, udp_port)
     
     # Start UDP handler thread
-    udp_thread = threading.Thread(target=handle_udp_voice, daemon=True)
+    udp_thread = threading.Thread(target=handle_udp_voice, args=(udp, stop_event), daemon=True)
     udp_thread.start()
     
-    try:
-        while True:
-            # Accept new connection
+    # Start heartbeat / dead peer reaper thread
+    heartbeat_thread = threading.Thread(target=heartbeat_monitor, args=(stop_event,), daemon=True)
+    heartbeat_thread.start()
+    
+    # Fan-out workers for large rooms
+    fanout_queues = [queue.SimpleQueue() for _ in range(FANOUT_WORKERS)]
+    for jobs in fanout_queues:
+        threading.Thread(target=fanout_worker, args=(jobs,), daemon=True).start()
+    
+    if WEB_PORT is not None:
+        web_gateway = open_gateway(WEB_HOST, WEB_PORT)
+    if BOT_TOKENS:
+        bot_server = open_bot_api(BOT_API_HOST, BOT_API_PORT)
+    
+    # Metrics are optional, a busy port should not keep the chat server down;
+    # the endpoint outlives stop_server so restarts keep their counters
+    if metrics_server is None and METRICS_PORT is not None:
+        try:
+            metrics_server = metrics.start_metrics_server(METRICS_HOST, METRICS_PORT)
+            log.info("METRICS", "Serving http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            log.warning("METRICS", "Endpoint disabled: %s", e)
+    
+    return server
+
+
+def serve(server):
+    """Accept connections on a transport.Listener until stop_server closes it"""
+    secure = server.secure if server.scheme == transport.TLS else None
+    while True:
+        # Accept new connection
+        try:
             client_socket, client_address = server.accept()
-            
-            # Create new thread for this client
-            thread = threading.Thread(target=handle_client, args=(client_socket, client_address))
-            thread.daemon = True
-            thread.start()
-            
-            print(f"[ACTIVE CONNECTIONS] {threading.active_count() - 1}")
+        except OSError:
+            if stop_event is not None and stop_event.is_set():
+                return
+            raise
+        
+        CONNECTIONS_ACCEPTED.inc()
+        rejected = admit_connection()
+        if rejected is not None:
+            reject_connection(client_socket, *rejected, plaintext=secure is None)
+            continue
+        if transport.is_tcp(client_socket):
+            enable_keepalive(client_socket)
+        
+        # Create new thread for this client; it does the TLS handshake itself
+        thread = threading.Thread(target=handle_client, args=(client_socket, client_address, secure))
+        thread.daemon = True
+        thread.start()
+        
+        log.info("ACTIVE CONNECTIONS", "%d", open_connections, sample=True)
+
+
+def stop_server():
+    """Stop accepting connections, stop the voice relay and disconnect every client"""
+    global server_socket, udp_socket, listeners, web_gateway, bot_server, fanout_queues
     
-    except KeyboardInterrupt:
-        print("\n[SHUTDOWN] Server is shutting down...")
-    finally:
-        server.close()
+    if stop_event is None or stop_event.is_set():
+        return
+    stop_event.set()
+    log.info("SHUTDOWN", "Server is shutting down...")
+    
+    for sock in [server_socket, udp_socket] + listeners:
+        # shutdown() is what wakes a thread blocked in accept() on Linux
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+    server_socket = udp_socket = None
+    listeners = []
+    if web_gateway is not None:
+        ws_gateway.stop_gateway(web_gateway)
+        web_gateway = None
+    if bot_server is not None:
+        bot_api.stop_bot_api(bot_server)
+        bot_server = None
+    
+    # Workers finish the jobs already queued, broadcasts from now on are inline
+    workers, fanout_queues = fanout_queues, None
+    for jobs in workers or ():
+        jobs.put(None)
+    
+    # Handler threads notice the closed sockets and clean up their sessions;
+    # sessions waiting for a resume have no handler and are ended here
+    with clients_lock:
+        sessions = list(clients.values())
+    for user_info in sessions:
+        user_info.outbox.close()
+        sock = user_info.socket
+        if sock is None:
+            end_session(user_info, expired=True)
+            continue
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
 
-if __name__ == "__main__":
+def print_banner(server):
+    """Show the addresses the server is bound to"""
+    host, port = server.address
+    udp_host, udp_port = udp_socket.getsockname()[:2]
     print("=" * 50)
     print("Multi-Threaded Chat Server with Voice Calling")
-    print("TCP Port: 5555 | UDP Port: 5556")
+    print(f"TCP: {host}:{port} | UDP: {udp_host}:{udp_port}")
+    for listener in listeners:
+        print(f"Also on {listener.url}")
+    if web_gateway is not None:
+        web_host, web_port = web_gateway.server_address[:2]
+        print(f"Browsers: {'https' if TLS_CERTFILE else 'http'}://{web_host}:{web_port}/")
+    if metrics_server is not None:
+        metrics_host, metrics_port = metrics_server.server_address[:2]
+        print(f"Metrics: http://{metrics_host}:{metrics_port}/metrics")
     print("=" * 50)
-    start_server()
+
+
+def start_server(host=HOST, port=PORT, udp_port=UDP_PORT):
+    """Initialize and run the server until Ctrl+C"""
+    server = open_server(host, port, udp_port)
+    print_banner(server)
+    try:
+        serve(server)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_server()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Multi-threaded chat server with voice calling")
+    parser.add_argument('--host', default=HOST, help=f"Address of the TCP and UDP ports (default {HOST})")
+    parser.add_argument('--port', type=int, default=PORT, help=f"TCP port for clients (default {PORT})")
+    parser.add_argument('--udp-port', type=int, default=UDP_PORT, help=f"UDP port for voice (default {UDP_PORT})")
+    parser.add_argument('--listen', action='append', default=[], metavar='URL',
+                        help="Also listen on unix:///path or tls://host:port (repeatable)")
+    parser.add_argument('--certfile', help="TLS certificate chain (PEM)")
+    parser.add_argument('--keyfile', help="TLS private key, if not in the certificate file")
+    parser.add_argument('--web-port', type=int, default=WEB_PORT,
+                        help=f"Port of the WebSocket gateway for browsers (default {WEB_PORT})")
+    parser.add_argument('--no-web', action='store_true', help="Do not start the WebSocket gateway")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help=f"Port of the metrics endpoint on {METRICS_HOST} (default {METRICS_PORT})")
+    parser.add_argument('--no-metrics', action='store_true', help="Do not serve metrics")
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                        help=f"Open connections at most, beyond that clients are told to retry (default {MAX_CONNECTIONS})")
+    args = parser.parse_args()
+    LISTEN_URLS = args.listen
+    TLS_CERTFILE = args.certfile
+    TLS_KEYFILE = args.keyfile
+    WEB_PORT = None if args.no_web else args.web_port
+    METRICS_PORT = None if args.no_metrics else args.metrics_port
+    MAX_CONNECTIONS = args.max_connections
+    
+    start_server(args.host, args.port, args.udp_port)
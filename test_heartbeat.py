@@ -0,0 +1,94 @@
+# test_heartbeat.py
+# Dead peer reaping against a server running in this process, with short
+# timeouts. Run with: python -m unittest test_heartbeat
+
+import os
+import socket
+import struct
+import threading
+import time
+import unittest
+
+import protocol
+import server
+
+HEARTBEAT_INTERVAL = 0.5
+DEAD_PEER_TIMEOUT = 1.5
+
+
+def login(address, username):
+    sock = socket.create_connection(address)
+    sock.sendall(protocol.encode({"type": "login", "payload": username}))
+    return sock
+
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return condition()
+
+
+class HeartbeatTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.saved = {name: getattr(server, name) for name in (
+            'HEARTBEAT_INTERVAL', 'DEAD_PEER_TIMEOUT', 'INBOX_FILE', 'WEB_PORT', 'USER_FILE_BYTE_RATE')}
+        server.HEARTBEAT_INTERVAL = HEARTBEAT_INTERVAL
+        server.DEAD_PEER_TIMEOUT = DEAD_PEER_TIMEOUT
+        server.INBOX_FILE = ':memory:'
+        server.WEB_PORT = None
+        server.USER_FILE_BYTE_RATE = (1e10, 1e10)
+        cls.listener = server.open_server('127.0.0.1', 0, 0, [])
+        cls.address = cls.listener.address
+        threading.Thread(target=server.serve, args=(cls.listener,), daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        server.stop_server()
+        for name, value in cls.saved.items():
+            setattr(server, name, value)
+
+    def test_silent_client_is_reaped(self):
+        # Logs in, then neither reads nor sends; the pings fit its socket buffer
+        sock = login(self.address, "silent")
+        self.addCleanup(sock.close)
+        self.assertTrue(wait_for(lambda: server.get_session("silent") is not None, 2))
+        session = server.get_session("silent")
+
+        started = time.monotonic()
+        self.assertTrue(wait_for(lambda: session.reaped, DEAD_PEER_TIMEOUT + 2 * HEARTBEAT_INTERVAL + 1))
+        self.assertLess(time.monotonic() - started, DEAD_PEER_TIMEOUT + 2 * HEARTBEAT_INTERVAL + 1)
+
+    def test_client_taking_a_file_is_kept(self):
+        # A client without chunked downloads cannot answer pings until it
+        # has the whole file, which here takes several DEAD_PEER_TIMEOUTs
+        sender = login(self.address, "sender")
+        self.addCleanup(sender.close)
+        receiver = socket.socket()
+        receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 64 * 1024)
+        receiver.connect(self.address)
+        self.addCleanup(receiver.close)
+        receiver.sendall(protocol.encode({"type": "login", "payload": "receiver"}))
+        self.assertTrue(wait_for(lambda: server.get_session("receiver") is not None, 2))
+        session = server.get_session("receiver")
+
+        data = os.urandom(8 * 1024 * 1024)
+        header = {"type": "file_transfer", "filename": "big.bin", "filesize": len(data)}
+        sender.sendall(protocol.encode(header) + struct.pack('>I', len(data)) + data)
+
+        buffer = bytearray()
+        receiver.settimeout(5)
+        while len(buffer) < len(data) or data not in buffer:
+            chunk = receiver.recv(64 * 1024)
+            self.assertTrue(chunk, "connection closed during the download")
+            buffer += chunk
+            time.sleep(0.05)
+        self.assertFalse(session.reaped)
+
+
+if __name__ == "__main__":
+    unittest.main()
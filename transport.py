@@ -0,0 +1,322 @@
+# transport.py
+# Stream transports for chat connections: plain TCP, Unix domain sockets (for
+# bots on the same host, no TCP/IP stack in between) and TLS. Addresses are
+# written as URLs: tcp://host:port, unix:///path/to/socket, tls://host:port.
+#
+# Whatever the transport, a connection is an ordinary socket object (a
+# TLSSocket for TLS), so the server and client code above it is the same.
+# TLS servers issue session tickets, and connect() offers the last session
+# for an address again, so reconnects resume instead of doing a full
+# handshake.
+#
+# One thread reads a connection while another writes it. An SSLSocket must
+# not be used that way: OpenSSL keeps one state for both directions, and with
+# TLS 1.3 a read may write too (answering a key update, for one). TLSSocket
+# makes every SSL call under one lock and never blocks while holding it.
+
+import errno
+import io
+import os
+import select
+import socket
+import ssl
+import threading
+import time
+
+TCP = "tcp"
+UNIX = "unix"
+TLS = "tls"
+SCHEMES = (TCP, UNIX, TLS)
+
+HANDSHAKE_TIMEOUT = 10    # Seconds a TLS handshake may take
+TLS_TICKETS = 2           # Session tickets a TLS 1.3 server issues per handshake
+
+# Last TLS (context, session) per (host, port), offered again on the next
+# connect with the same context
+_sessions = {}
+_sessions_lock = threading.Lock()
+_default_context = None
+
+
+def parse_url(url, default_scheme=TCP):
+    """Split an address URL into (scheme, address); address is (host, port) or a path"""
+    scheme, sep, rest = url.partition("://")
+    if not sep:
+        scheme, rest = default_scheme, url
+    if scheme not in SCHEMES:
+        raise ValueError(f"Unknown transport '{scheme}' (use {', '.join(SCHEMES)})")
+    if scheme == UNIX:
+        if not rest:
+            raise ValueError("Unix socket URL needs a path")
+        return scheme, rest
+
+    host, sep, port = rest.rpartition(":")
+    if not sep or not port.isdigit():
+        raise ValueError(f"Address '{rest}' needs a port")
+    return scheme, (host.strip("[]") or "0.0.0.0", int(port))
+
+
+def format_url(scheme, address):
+    if scheme == UNIX:
+        return f"{scheme}://{address}"
+    return f"{scheme}://{address[0]}:{address[1]}"
+
+
+def server_context(certfile, keyfile=None):
+    """TLS context for listening, issuing session tickets for resumption"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    context.num_tickets = TLS_TICKETS
+    return context
+
+
+def client_context(cafile=None, verify=True):
+    """TLS context for connecting, verifying the server against cafile or the system CAs"""
+    context = ssl.create_default_context(cafile=cafile)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def _wait(sock, writing, timeout):
+    """Wait at most timeout seconds (None: no limit) until sock is readable, or writable"""
+    if sock.fileno() < 0:
+        raise OSError(errno.EBADF, "Socket is closed")
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT if writing else select.POLLIN)
+        poller.poll(None if timeout is None else timeout * 1000)
+    elif writing:
+        select.select([], [sock], [], timeout)
+    else:
+        select.select([sock], [], [], timeout)
+
+
+class TLSSocket:
+    """An SSLSocket that one thread may read while another writes.
+
+    The SSLSocket is non-blocking and each SSL call is made under the lock. A
+    call that has to wait for the network lets go of the lock and waits with
+    poll, so a reader waiting for data does not hold up a writer. A write
+    that had to wait must be retried with the same data, so writes also hold
+    send_lock until they are done. Timeouts work as on a blocking socket;
+    other attributes are the SSLSocket's.
+    """
+
+    def __init__(self, tls_sock):
+        self.tls = tls_sock
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.timeout = tls_sock.gettimeout()
+        tls_sock.setblocking(False)
+
+    def __getattr__(self, name):
+        # family, setsockopt, session, context and the like
+        return getattr(self.tls, name)
+
+    def _call(self, method, *args):
+        """Make an SSL call under the lock, waiting for the socket as often as it asks"""
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            with self.lock:
+                try:
+                    return method(*args)
+                except ssl.SSLWantReadError:
+                    writing = False
+                except ssl.SSLWantWriteError:
+                    writing = True
+            
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout("timed out")
+            _wait(self.tls, writing, remaining)
+
+    def recv(self, bufsize):
+        return self._call(self.tls.recv, bufsize)
+
+    def recv_into(self, buffer, nbytes=0):
+        return self._call(self.tls.recv_into, buffer, nbytes)
+
+    def send(self, data):
+        with self.send_lock:
+            return self._call(self.tls.send, data)
+
+    def sendall(self, data):
+        with self.send_lock, memoryview(data) as view, view.cast("B") as byte_view:
+            sent = 0
+            while sent < len(byte_view):
+                sent += self._call(self.tls.send, byte_view[sent:])
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def setblocking(self, flag):
+        self.timeout = None if flag else 0.0
+
+    def makefile(self, mode="r", buffering=None):
+        """Binary file on the connection, as the HTTP server's request handlers use"""
+        raw = socket.SocketIO(self, mode.replace("b", "") + "b")
+        if buffering == 0:
+            return raw
+        if buffering is None or buffering < 0:
+            buffering = io.DEFAULT_BUFFER_SIZE
+        if "r" in mode:
+            return io.BufferedReader(raw, buffering)
+        return io.BufferedWriter(raw, buffering)
+
+    def _decref_socketios(self):
+        # Called by SocketIO.close; the connection is closed by its owner
+        pass
+
+    def shutdown(self, how):
+        with self.lock:
+            self.tls.shutdown(how)
+
+    def close(self):
+        with self.lock:
+            self.tls.close()
+
+
+def is_tcp(sock):
+    """True for sockets that take TCP options (TCP and TLS, not Unix sockets)"""
+    return sock.family in (socket.AF_INET, socket.AF_INET6)
+
+
+def set_nodelay(sock):
+    """Turn off Nagle's algorithm on a TCP socket.
+
+    Both ends batch their own frames before writing, and with Nagle a TLS
+    server's session tickets hold up the first reply until the peer's
+    delayed ACK (about 40 ms per connection).
+    """
+    if is_tcp(sock):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class Listener:
+    """A listening socket for one transport"""
+
+    def __init__(self, url, ssl_context=None, backlog=socket.SOMAXCONN):
+        self.scheme, self.address = parse_url(url)
+        if self.scheme == TLS and ssl_context is None:
+            raise ValueError("TLS listener needs an ssl_context")
+        self.ssl_context = ssl_context
+
+        if self.scheme == UNIX:
+            # A socket file left behind by a previous run would make bind fail
+            try:
+                os.unlink(self.address)
+            except FileNotFoundError:
+                pass
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.sock.bind(self.address)
+            self.sock.listen(backlog)
+        except OSError:
+            self.sock.close()
+            raise
+        if self.scheme != UNIX:
+            self.address = self.sock.getsockname()[:2]  # Port 0 picks a free port
+
+    @property
+    def url(self):
+        return format_url(self.scheme, self.address)
+
+    def accept(self):
+        """Accept a connection, return (socket, address); TLS is set up later by secure()"""
+        sock, address = self.sock.accept()
+        if self.scheme == UNIX:
+            address = self.address  # Unix peers have no address of their own
+        else:
+            set_nodelay(sock)
+        return sock, address
+
+    def secure(self, sock):
+        """Do the server side of the TLS handshake on an accepted socket, return the socket to use.
+
+        Called on the connection's own thread, so a slow handshake does not
+        hold up accept(). Raises OSError (ssl.SSLError) if the handshake fails.
+        """
+        if self.ssl_context is None:
+            return sock
+        sock.settimeout(HANDSHAKE_TIMEOUT)
+        tls_sock = self.ssl_context.wrap_socket(sock, server_side=True)
+        tls_sock.settimeout(None)
+        return TLSSocket(tls_sock)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def shutdown(self, how):
+        self.sock.shutdown(how)
+
+    def close(self):
+        self.sock.close()
+        if self.scheme == UNIX:
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+
+def connect(url, timeout=None, ssl_context=None, server_hostname=None):
+    """Open a connection to a server URL, resuming the last TLS session to it if there is one"""
+    scheme, address = parse_url(url)
+    if scheme == UNIX:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(address)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    sock = socket.create_connection(address, timeout=timeout)
+    set_nodelay(sock)
+    if scheme == TCP:
+        return sock
+
+    global _default_context
+    with _sessions_lock:
+        if ssl_context is None:
+            if _default_context is None:
+                _default_context = client_context()
+            ssl_context = _default_context
+        # A session can only be resumed with the context it came from
+        cached_context, session = _sessions.get(address, (None, None))
+        if cached_context is not ssl_context:
+            session = None
+    try:
+        if timeout is None:
+            sock.settimeout(HANDSHAKE_TIMEOUT)
+        tls_sock = ssl_context.wrap_socket(sock, server_hostname=server_hostname or address[0], session=session)
+        tls_sock.settimeout(timeout)
+    except OSError:
+        sock.close()
+        raise
+    return TLSSocket(tls_sock)
+
+
+def remember_session(sock, url):
+    """Keep a TLS connection's session for the next connect to the same server URL.
+
+    TLS 1.3 servers send their tickets after the handshake, so call this once
+    something has been received on the connection.
+    """
+    session = getattr(sock, 'session', None)
+    if session is None:
+        return
+    with _sessions_lock:
+        _sessions[parse_url(url)[1]] = (sock.context, session)
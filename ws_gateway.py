@@ -0,0 +1,344 @@
+# ws_gateway.py
+# WebSocket gateway for browsers: serves the chat pages over HTTP and carries
+# the chat protocol over a WebSocket (RFC 6455) at /ws, so a browser talks to
+# the server directly instead of through client_gui.py and Eel.
+#
+# The WebSocket does not change the protocol: the browser sends the bytes a
+# TCP client would (newline-terminated JSON and upload chunks) and whatever
+# the server writes goes out unchanged as binary messages. A
+# WebSocketConnection looks like a socket to the connection handler, so a
+# browser session is logged in, rate limited and resumed like any other.
+#
+# The pages are served as they are; /eel.js is eel_ws.js, which implements
+# the calls client_gui.py exposes to them on top of the WebSocket.
+#
+# Every accepted socket goes through the chat server's admission control
+# before it gets a thread, so a reconnect storm through the gateway is turned
+# away as cheaply as one on the chat port.
+
+import base64
+import hashlib
+import os
+import socket
+import ssl
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import transport
+
+WS_PATH = "/ws"
+WS_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+MAX_FRAME_PAYLOAD = 2 * 1024 * 1024  # Longest WebSocket frame accepted from a browser
+SEND_COALESCE_BYTES = 64 * 1024      # Smaller writes are sent together with their frame header
+REQUEST_TIMEOUT = 30                 # Seconds for a TLS handshake or an HTTP request, until the upgrade
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+CLOSE_NORMAL = 1000
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_TOO_BIG = 1009
+
+# Files served next to this module: {lower-case URL path: (file, content type)}
+WEB_ROOT = os.path.dirname(os.path.abspath(__file__))
+WEB_FILES = {
+    "/": ("login.html", "text/html; charset=utf-8"),
+    "/login.html": ("login.html", "text/html; charset=utf-8"),
+    "/chat.html": ("chat.html", "text/html; charset=utf-8"),
+    "/chat.js": ("Chat.js", "text/javascript; charset=utf-8"),
+    "/style.css": ("style.css", "text/css; charset=utf-8"),
+    "/eel.js": ("eel_ws.js", "text/javascript; charset=utf-8"),
+}
+
+
+class WebSocketConnection:
+    """Socket-like view of a server side WebSocket, a byte stream in both directions.
+
+    recv() returns the payload of the browser's data frames as one stream,
+    answering pings and close frames on the way; sendall() sends each write
+    as one binary message. Sends are serialized, since the handler thread
+    and the outbox writer both write.
+    """
+
+    def __init__(self, sock, rfile):
+        self.sock = sock
+        self.rfile = rfile  # Reads go through the HTTP request's buffer
+        self.send_lock = threading.Lock()
+        self.remaining = 0  # Payload bytes left in the current data frame
+        self.mask = b"\0\0\0\0"
+        self.mask_offset = 0
+        self.close_sent = False
+
+    def recv(self, bufsize):
+        while not self.remaining:
+            if not self._next_data_frame():
+                return b""
+        data = self.rfile.read1(min(bufsize, self.remaining))
+        if not data:
+            return b""
+        self.remaining -= len(data)
+        return self._unmask(data)
+
+    def recv_into(self, buffer, nbytes=0):
+        data = self.recv(nbytes or len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def sendall(self, data):
+        self._send_frame(OP_BINARY, data)
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def shutdown(self, how):
+        self.sock.shutdown(how)
+
+    def close(self):
+        """Say goodbye with a close frame unless a send is in progress, then close the socket"""
+        if not self.close_sent and self.send_lock.acquire(blocking=False):
+            try:
+                self._write_frame(OP_CLOSE, struct.pack('>H', CLOSE_NORMAL))
+            except OSError:
+                pass
+            finally:
+                self.send_lock.release()
+        self.sock.close()
+
+    def _read_exact(self, count):
+        data = self.rfile.read(count)
+        if len(data) < count:
+            raise ConnectionResetError("WebSocket closed in the middle of a frame")
+        return data
+
+    def _unmask(self, data):
+        # XOR as one big integer operation rather than byte by byte
+        count = len(data)
+        offset = self.mask_offset
+        key = self.mask[offset:] + self.mask[:offset]
+        self.mask_offset = (offset + count) % 4
+        mask = (key * (count // 4 + 1))[:count]
+        return (int.from_bytes(data, 'little') ^ int.from_bytes(mask, 'little')).to_bytes(count, 'little')
+
+    def _next_data_frame(self):
+        """Read frames until a data frame starts, return False when the WebSocket is closed"""
+        while True:
+            header = self.rfile.read(2)
+            if len(header) < 2:
+                return False
+            opcode = header[0] & 0x0F
+            length = header[1] & 0x7F
+            if length == 126:
+                length = struct.unpack('>H', self._read_exact(2))[0]
+            elif length == 127:
+                length = struct.unpack('>Q', self._read_exact(8))[0]
+            if not header[1] & 0x80:
+                # Browsers always mask their frames
+                self._fail(CLOSE_PROTOCOL_ERROR)
+                return False
+            self.mask = self._read_exact(4)
+            self.mask_offset = 0
+
+            if opcode in (OP_CONTINUATION, OP_TEXT, OP_BINARY):
+                if length > MAX_FRAME_PAYLOAD:
+                    self._fail(CLOSE_TOO_BIG)
+                    return False
+                self.remaining = length
+                if length:
+                    return True
+                continue
+
+            if opcode not in (OP_CLOSE, OP_PING, OP_PONG) or length > 125:
+                self._fail(CLOSE_PROTOCOL_ERROR)
+                return False
+            payload = self._unmask(self._read_exact(length)) if length else b""
+            if opcode == OP_PING:
+                self._send_frame(OP_PONG, payload)
+            elif opcode == OP_CLOSE:
+                self._fail(CLOSE_NORMAL)
+                return False
+
+    def _fail(self, code):
+        """Send a close frame with code; nothing is sent after it"""
+        try:
+            self._send_frame(OP_CLOSE, struct.pack('>H', code))
+        except OSError:
+            pass
+
+    def _send_frame(self, opcode, payload):
+        with self.send_lock:
+            self._write_frame(opcode, payload)
+
+    def _write_frame(self, opcode, payload):
+        # Called with send_lock held
+        if self.close_sent:
+            raise BrokenPipeError("WebSocket is closed")
+        if opcode == OP_CLOSE:
+            self.close_sent = True
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('>BB', 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack('>BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('>BBQ', 0x80 | opcode, 127, length)
+        if length < SEND_COALESCE_BYTES:
+            self.sock.sendall(b"".join((header, payload)))
+        else:
+            self.sock.sendall(header)
+            self.sock.sendall(payload)
+
+
+def accept_key(key):
+    """Sec-WebSocket-Accept for a client's Sec-WebSocket-Key"""
+    return base64.b64encode(hashlib.sha1(key.encode('ascii') + WS_GUID).digest()).decode('ascii')
+
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = REQUEST_TIMEOUT
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == WS_PATH:
+            self.upgrade()
+            return
+
+        entry = WEB_FILES.get(path.lower())
+        if entry is None:
+            self.send_error(404)
+            return
+        filename, content_type = entry
+        try:
+            with open(os.path.join(WEB_ROOT, filename), 'rb') as f:
+                body = f.read()
+        except OSError:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def upgrade(self):
+        """Switch to the WebSocket protocol and hand the connection to the chat server"""
+        key = self.headers.get("Sec-WebSocket-Key")
+        if (self.headers.get("Upgrade", "").lower() != "websocket"
+                or "upgrade" not in self.headers.get("Connection", "").lower()
+                or not key):
+            self.send_error(400, "Expected a WebSocket upgrade")
+            return
+        if self.headers.get("Sec-WebSocket-Version") != "13":
+            self.send_response(426)
+            self.send_header("Sec-WebSocket-Version", "13")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept_key(key))
+        self.end_headers()
+        self.close_connection = True
+        # From here on the chat server accounts for the connection
+        self.server.upgraded.add(self.request)
+        self.server.handle_connection(WebSocketConnection(self.connection, self.rfile), self.client_address)
+
+    def log_message(self, format, *args):
+        # Page loads are not worth a log line each; connections are logged by the chat server
+        pass
+
+
+def reject_request(sock, retry_after, plaintext):
+    """Close a connection that was not admitted, with a 503 for a plaintext client if it fits the socket buffer"""
+    try:
+        if plaintext:
+            sock.setblocking(False)
+            try:
+                sock.recv(4096)
+            except BlockingIOError:
+                pass
+            sock.send((f"HTTP/1.1 503 Service Unavailable\r\nRetry-After: {max(1, round(retry_after))}\r\n"
+                       "Content-Length: 0\r\nConnection: close\r\n\r\n").encode('ascii'))
+            sock.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+    sock.close()
+
+
+class GatewayServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = socket.SOMAXCONN  # Browsers reconnect all at once after an outage too
+
+    def __init__(self, address, handle_connection, ssl_context=None, admit=None, release=None):
+        super().__init__(address, GatewayHandler)
+        self.handle_connection = handle_connection
+        self.admit = admit
+        self.release = release
+        self.upgraded = set()  # Requests handed to handle_connection, which releases them
+        if ssl_context is not None:
+            # The handshake happens on the connection's own thread, at its first read
+            self.socket = ssl_context.wrap_socket(self.socket, server_side=True, do_handshake_on_connect=False)
+
+    def get_request(self):
+        sock, address = super().get_request()
+        transport.set_nodelay(sock)
+        if isinstance(sock, ssl.SSLSocket):
+            # A WebSocket is read by its handler thread and written by the outbox writer
+            sock = transport.TLSSocket(sock)
+        return sock, address
+
+    def process_request(self, request, client_address):
+        # Runs on the accept thread, before the request gets a thread of its own
+        if self.admit is not None:
+            rejected = self.admit()
+            if rejected is not None:
+                reject_request(request, rejected[1], not isinstance(request, transport.TLSSocket))
+                return
+        super().process_request(request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            if request in self.upgraded:
+                self.upgraded.discard(request)
+            elif self.release is not None:
+                # Page loads, failed handshakes and refused upgrades
+                self.release()
+
+    def handle_error(self, request, client_address):
+        # Failed TLS handshakes and abandoned page loads are routine; the chat
+        # server handles its own errors
+        pass
+
+
+def start_gateway(host, port, handle_connection, ssl_context=None, admit=None, release=None):
+    """Serve the pages and /ws from a daemon thread, return the HTTP server.
+
+    handle_connection(connection, address) is called on the connection's
+    thread with each WebSocketConnection and runs it until it ends.
+    admit() is called for each accepted socket and returns None to let it in
+    or (reason, retry_after) to turn it away; release() is called for an
+    admitted socket that ends without becoming a WebSocket.
+    """
+    httpd = GatewayServer((host, port), handle_connection, ssl_context, admit, release)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd
+
+
+def stop_gateway(httpd):
+    """Stop serving and close the listening socket; open WebSockets are left to their handlers"""
+    httpd.shutdown()
+    httpd.server_close()